@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Measures the peak resident memory of encoding a chunk with the node
+# heartbeat, for increasing chunk sizes.  Each size is encoded in a fresh
+# process so that its peak RSS is measured on its own.
+#
+# The shipped heartbeats read chunks in pieces of at most 64 KB, so the peak
+# should not grow with the chunk size.  --buffer sets ENCODE_BUFFER_SIZE, to
+# check heartbeats that read in larger pieces.  Exits with a non zero status
+# if the peak for the largest chunk exceeds the peak for the smallest one by
+# more than --tolerance MB.
+#
+#   python benchmarks/encode_memory.py
+#   python benchmarks/encode_memory.py --sizes 32 256 1024 --buffer 65536
+
+import os
+import sys
+import time
+import argparse
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+MB = 1024 * 1024
+
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if (sys.platform == 'darwin'):
+        # bytes on os x, kilobytes elsewhere
+        return rss / float(MB)
+    return rss / 1024.0
+
+
+def child(size, buffer_size):
+    from downstream_node.startup import app  # NOQA
+    from downstream_node import node  # NOQA
+
+    app.config['ENCODE_BUFFER_SIZE'] = buffer_size
+
+    baseline = max_rss_mb()
+    start = time.time()
+    stream = node.open_chunk_stream('encode memory benchmark', size)
+    app.heartbeat.encode(stream, filesz=size)
+    elapsed = time.time() - start
+    print('{0} {1} {2}'.format(baseline, max_rss_mb(), elapsed))
+
+
+def run(size, buffer_size):
+    args = [sys.executable, __file__, '--child', str(size)]
+    if (buffer_size is not None):
+        args.extend(['--buffer', str(buffer_size)])
+    output = subprocess.check_output(args).decode('utf-8')
+    (baseline, peak, elapsed) = output.strip().split('\n')[-1].split()
+    return (float(baseline), float(peak), float(elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser('encode_memory')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[32, 256, 1024],
+                        help='chunk sizes to encode, in MB')
+    parser.add_argument('--buffer', type=int, default=0,
+                        help='ENCODE_BUFFER_SIZE to encode with.  0 to '
+                        'read unbounded')
+    parser.add_argument('--tolerance', type=float, default=16,
+                        help='allowed growth of the peak RSS from the '
+                        'smallest to the largest chunk, in MB')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    buffer_size = args.buffer if args.buffer > 0 else None
+
+    if (args.child is not None):
+        child(args.child, buffer_size)
+        return
+
+    print('{0:>8} {1:>12} {2:>12} {3:>10} {4:>10}'.format(
+        'size MB', 'baseline MB', 'peak RSS MB', 'seconds', 'MB/s'))
+    peaks = list()
+    for size in args.sizes:
+        (baseline, peak, elapsed) = run(size * MB, buffer_size)
+        peaks.append(peak)
+        print('{0:>8} {1:>12.1f} {2:>12.1f} {3:>10.2f} {4:>10.1f}'.format(
+            size, baseline, peak, elapsed, size / max(elapsed, 1e-6)))
+
+    growth = peaks[-1] - peaks[0]
+    print('peak RSS growth: {0:.1f} MB'.format(growth))
+    if (growth > args.tolerance):
+        print('FAIL: peak RSS grew by more than {0} MB'.format(
+            args.tolerance))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
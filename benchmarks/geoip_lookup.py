@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compares the per lookup latency of opening a new maxminddb reader for
+# every lookup against the shared, memory mapped GeoIPReader.
+#
+#   python benchmarks/geoip_lookup.py data/GeoLite2-City.mmdb
+
+import argparse
+import random
+import socket
+import struct
+import os
+import sys
+import timeit
+
+import maxminddb
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from downstream_node.geoip import GeoIPReader  # NOQA
+
+
+def random_ips(count):
+    return [socket.inet_ntoa(struct.pack('>I', random.getrandbits(32)))
+            for i in range(0, count)]
+
+
+def per_call_lookup(path, ips):
+    for ip in ips:
+        reader = maxminddb.Reader(path)
+        reader.get(ip)
+        reader.close()
+
+
+def shared_lookup(reader, ips):
+    for ip in ips:
+        reader.get(ip)
+
+
+def main():
+    parser = argparse.ArgumentParser('geoip_lookup')
+    parser.add_argument('path', nargs='?', default='data/GeoLite2-City.mmdb',
+                        help='path to the .mmdb database')
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    ips = random_ips(args.lookups)
+    reader = GeoIPReader(args.path)
+    # open the shared reader before timing, as the server would have
+    reader.get(ips[0])
+
+    cases = [('per call reader', lambda: per_call_lookup(args.path, ips)),
+             ('shared reader', lambda: shared_lookup(reader, ips))]
+
+    for (name, func) in cases:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print('{0:>16}: {1:8.2f} us/lookup'.format(
+            name, best / args.lookups * 1e6))
+
+
+if __name__ == '__main__':
+    main()
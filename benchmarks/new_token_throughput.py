@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Measures signed /new throughput for increasing numbers of signature
+# verification workers, while a separate thread measures the latency of
+# /challenge and /answer requests running at the same time.
+#
+# With verification inline, /new holds the GIL and the probe latency grows
+# with the /new load.  With a process pool, /new throughput should scale
+# with the number of cores while the probe latency stays flat.
+#
+# Every /new request posts the same signed message, so the signature cache is
+# disabled unless --cached is given, otherwise every request after the first
+# would be a cache hit and no verification work would be measured.
+#
+# This creates tokens in the configured database, so point
+# SQLALCHEMY_DATABASE_URI at a scratch database first.
+#
+#   python benchmarks/new_token_throughput.py --threads 8 --duration 10
+#   python benchmarks/new_token_throughput.py --cached
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from downstream_node.startup import app, db  # NOQA
+from downstream_node.models import Address  # NOQA
+from downstream_node.workers import WorkerPool  # NOQA
+from downstream_node.cache import LRUCache  # NOQA
+from downstream_node.whitelist import bump_whitelist_version  # NOQA
+from downstream_node import node  # NOQA
+
+# a known good signature, also used by the unit tests
+ADDRESS = '19qVgG8C6eXwKMMyvVegsi3xCsKyk3Z3jV'
+SIGNATURE = ('HyzVUenXXo4pa+kgm1vS8PNJM83eIXFC5r0q86FGbqFcdl'
+             'a6rcw72/ciXiEPfjli3ENfwWuESHhv6K9esI0dl5I=')
+MESSAGE = 'test message'
+
+
+def setup():
+    db.create_all()
+    if (Address.query.filter(Address.address == ADDRESS).first() is None):
+        db.session.add(Address(address=ADDRESS,
+                               crowdsale_balance=app.config[
+                                   'MIN_SJCX_BALANCE']))
+        db.session.commit()
+        bump_whitelist_version()
+    app.whitelist.load()
+    app.config['REQUIRE_SIGNATURE'] = True
+    app.config['MAX_TOKENS_PER_IP'] = None
+    return node.create_token(ADDRESS, '127.0.0.1').token
+
+
+def new_worker(stop, counts, index):
+    client = app.test_client()
+    data = json.dumps({'message': MESSAGE, 'signature': SIGNATURE})
+    while (not stop.is_set()):
+        r = client.post('/new/{0}'.format(ADDRESS),
+                        data=data,
+                        content_type='application/json')
+        if (r.status_code == 200):
+            counts[index] += 1
+
+
+def probe_worker(stop, token, latencies):
+    client = app.test_client()
+    answer = json.dumps({'proofs': []})
+    while (not stop.is_set()):
+        start = time.time()
+        client.get('/challenge/{0}'.format(token))
+        client.post('/answer/{0}'.format(token),
+                    data=answer,
+                    content_type='application/json')
+        latencies.append(time.time() - start)
+        time.sleep(0.05)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if (len(values) == 0):
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(workers, threads, duration, token, cached):
+    app.signature_pool.close()
+    app.signature_pool = WorkerPool(workers)
+    app.caches['signatures'] = LRUCache(
+        app.config['SIGNATURE_CACHE_SIZE'] if cached else 0)
+    # start the worker processes before timing.  with the cache enabled,
+    # this also caches the signature that every request posts
+    node.verify_signature(MESSAGE, SIGNATURE, ADDRESS)
+
+    stop = threading.Event()
+    counts = [0] * threads
+    latencies = list()
+    pool = [threading.Thread(target=new_worker, args=(stop, counts, i))
+            for i in range(0, threads)]
+    pool.append(threading.Thread(target=probe_worker,
+                                 args=(stop, token, latencies)))
+    for t in pool:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in pool:
+        t.join()
+
+    print('{0:>7} {1:>10.1f} {2:>14.1f} {3:>14.1f}'.format(
+        workers,
+        sum(counts) / float(duration),
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.95) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser('new_token_throughput')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='number of concurrent /new clients')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run each configuration')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        help='signature worker counts to try')
+    parser.add_argument('--cached', action='store_true',
+                        help='keep the signature cache enabled, measuring '
+                        'cache hits instead of verifications')
+    args = parser.parse_args()
+
+    workers = args.workers
+    if (workers is None):
+        workers = [0]
+        n = 1
+        while (n <= multiprocessing.cpu_count()):
+            workers.append(n)
+            n *= 2
+
+    token = setup()
+
+    print('signature cache: {0}'.format(
+        'enabled' if args.cached else 'disabled'))
+    print('{0:>7} {1:>10} {2:>14} {3:>14}'.format(
+        'workers', '/new req/s', 'probe p50 ms', 'probe p95 ms'))
+    for w in workers:
+        run(w, args.threads, args.duration, token, args.cached)
+
+    app.signature_pool.close()
+
+
+if __name__ == '__main__':
+    main()
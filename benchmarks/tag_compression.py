@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compares the ways tags can be stored (TAG_JSON, TAG_COMPRESSION and
+# TAG_COMPRESSION_LEVEL) for heartbeat tags of chunks of typical sizes.
+#
+# For each chunk size a chunk is generated and encoded once, and its tag is
+# then stored with each codec.  Reported are the bytes stored in the tag
+# store, which are also the bytes sent over the wire when tags are served
+# from REMOTE_TAGS_PATH, and the time to store and to read back the tag.
+#
+#   python benchmarks/tag_compression.py
+#   python benchmarks/tag_compression.py --sizes 1 32 --check-fraction 0.01
+
+import io
+import os
+import sys
+import time
+import argparse
+
+import heartbeat
+from RandomIO import RandomIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from downstream_node import tagcodec  # NOQA
+from downstream_node.tagcodec import dump_tag, dump_tag_json, load_tag  # NOQA
+
+MB = 1024 * 1024
+
+CODECS = [(None, None),
+          ('zlib', 1), ('zlib', 6), ('zlib', 9),
+          ('lzma', 0), ('lzma', 6)]
+
+# TAG_JSON False and True
+FORMATS = dict(pickle=dump_tag, json=dump_tag_json)
+
+
+def time_per_call(func, repeat):
+    start = time.time()
+    for i in range(0, repeat):
+        result = func()
+    return (result, (time.time() - start) / repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser('tag_compression')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 32, 100],
+                        help='chunk sizes to encode, in MB')
+    parser.add_argument('--check-fraction', type=float, default=0.01,
+                        help='heartbeat check fraction')
+    parser.add_argument('--repeat', type=int, default=100,
+                        help='number of times each tag is stored and read '
+                        'back')
+    args = parser.parse_args()
+
+    beat = heartbeat.Merkle.Merkle(args.check_fraction)
+
+    print('{0:>8} {1:>16} {2:>12} {3:>8} {4:>10} {5:>10}'.format(
+        'size MB', 'format', 'bytes', 'ratio', 'store ms', 'read ms'))
+    for size in args.sizes:
+        stream = RandomIO('tag compression benchmark').read(size * MB)
+        (tag, state) = beat.encode(io.BytesIO(stream), filesz=size * MB)
+        plain = len(dump_tag(tag))
+        for (dump, (compression, level)) in [(d, c) for d in FORMATS
+                                             for c in CODECS]:
+            if (compression == 'lzma' and tagcodec.lzma is None):
+                continue
+            (data, store) = time_per_call(
+                lambda: FORMATS[dump](tag, compression, level), args.repeat)
+            (loaded, read) = time_per_call(lambda: load_tag(data),
+                                           args.repeat)
+            name = dump if compression is None else \
+                '{0}-{1}-{2}'.format(dump, compression, level)
+            print('{0:>8} {1:>16} {2:>12} {3:>8.3f} {4:>10.3f} '
+                  '{5:>10.3f}'.format(size, name, len(data),
+                                      len(data) / float(plain),
+                                      store * 1000, read * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    """A thread safe, size bounded, least recently used cache whose entries
+    expire after a fixed time to live.
+
+    Hits, misses, evictions (entries pushed out because the cache was full)
+    and expirations are counted so that the cache can be tuned.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """Initialization method
+
+        :param maxsize: the maximum number of entries to hold.  if 0, nothing
+            is cached
+        :param ttl: the number of seconds an entry stays valid.  if None,
+            entries never expire and are only evicted when the cache is full
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if it is not cached
+        or has expired.
+
+        :param key: the key to look up
+        :param default: the value to return on a miss
+        """
+        with self._lock:
+            try:
+                (value, expires) = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if (expires is not None and expires <= time.time()):
+                self.expirations += 1
+                self.misses += 1
+                return default
+            # reinsert to mark as most recently used
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Stores value under key, evicting the least recently used entry
+        if the cache is full.
+
+        :param key: the key to store
+        :param value: the value to store
+        """
+        if (self.maxsize == 0):
+            return
+        if (self.ttl is not None):
+            expires = time.time() + self.ttl
+        else:
+            expires = None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while (len(self._data) > self.maxsize):
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Removes key from the cache if it is present
+
+        :param key: the key to remove
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Removes all entries from the cache.  Statistics are kept."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Returns the cache statistics as a dictionary"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._data),
+                    'maxsize': self.maxsize,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'hit_rate': (float(self.hits) / lookups
+                                 if lookups > 0 else 0.0)}
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import time
+import select
+import socket
+import threading
+
+from .utils import Distribution
+
+
+class ChunkPoolNotifier(object):
+
+    """Tells the chunk pool maintainer (runapp.py --maintain) which chunks
+    have been taken from the pool, with a UDP datagram to the address it
+    listens on.
+
+    Notifications are best effort.  If nothing is listening they are simply
+    dropped, and the maintainer catches up when it next counts the pool.
+    """
+
+    def __init__(self, address=None):
+        """Initialization method
+
+        :param address: the (host, port) the maintainer listens on.  if None,
+            no notifications are sent
+        """
+        self.address = address
+        self._socket = None
+        self._lock = threading.Lock()
+
+    def notify(self, consumed):
+        """Sends a notification that chunks were taken from the pool
+
+        :param consumed: a dictionary mapping chunk sizes to the number of
+            chunks of that size that were taken
+        """
+        if (self.address is None or len(consumed) == 0):
+            return
+        try:
+            with self._lock:
+                if (self._socket is None):
+                    self._socket = socket.socket(socket.AF_INET,
+                                                 socket.SOCK_DGRAM)
+                    self._socket.setblocking(False)
+                self._socket.sendto(json.dumps(consumed).encode('utf-8'),
+                                    self.address)
+        except socket.error:
+            pass
+
+    def close(self):
+        with self._lock:
+            if (self._socket is not None):
+                self._socket.close()
+            self._socket = None
+
+
+class ChunkPoolMaintainer(object):
+
+    """Keeps track of the number of available chunks of each size in the
+    pool, so that they can be replenished as soon as they run low.
+
+    The counts are taken from the database by resync() and then kept up to
+    date with the notifications sent by ChunkPoolNotifier when chunks are
+    taken, and with generated() as chunks are added.  Since notifications
+    may be lost, and other processes may add chunks, the counts should be
+    resynced every so often, see needs_resync().
+
+    When the count for a size drops below the low water mark, a fraction of
+    its target count, deficits() asks for it to be refilled to the target.
+    """
+
+    def __init__(self, targets, low_water=0.5, address=None,
+                 resync_interval=60):
+        """Initialization method
+
+        :param targets: a dictionary mapping chunk sizes to the number of
+            chunks of that size to keep in the pool
+        :param low_water: the fraction of a size's target count below which
+            it is refilled
+        :param address: the (host, port) to listen for notifications on.  if
+            None, the counts are only updated by resyncing
+        :param resync_interval: the number of seconds between resyncs
+        """
+        self.targets = dict(targets)
+        self.low_water = low_water
+        self.resync_interval = resync_interval
+        self.counts = dict()
+        self._last_resync = None
+        self._socket = None
+        if (address is not None):
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setsockopt(socket.SOL_SOCKET,
+                                    socket.SO_REUSEADDR, 1)
+            self._socket.bind(address)
+            self._socket.setblocking(False)
+
+    @property
+    def address(self):
+        """The address notifications are received on, or None"""
+        if (self._socket is None):
+            return None
+        return self._socket.getsockname()
+
+    def resync(self, inventory):
+        """Replaces the counts with a fresh count of the pool
+
+        :param inventory: a dictionary mapping chunk sizes to the number of
+            available chunks of that size
+        """
+        self.counts = dict(inventory)
+        self._last_resync = time.time()
+
+    def needs_resync(self):
+        """Returns True if the counts have never been synced, or were last
+        synced more than resync_interval seconds ago"""
+        return (self._last_resync is None or
+                time.time() - self._last_resync >= self.resync_interval)
+
+    def consumed(self, consumed):
+        """Records that chunks were taken from the pool
+
+        :param consumed: a dictionary mapping chunk sizes to the number of
+            chunks of that size that were taken
+        """
+        for (size, n) in consumed.items():
+            self.counts[size] = max(0, self.counts.get(size, 0) - n)
+
+    def generated(self, sizes):
+        """Records that chunks were added to the pool
+
+        :param sizes: a list of the sizes of the chunks added
+        """
+        for size in sizes:
+            self.counts[size] = self.counts.get(size, 0) + 1
+
+    def deficits(self):
+        """Returns a list of the sizes of the chunks to generate to refill
+        the sizes that are below the low water mark, alternating between
+        sizes so that they are refilled evenly.
+        """
+        missing = dict()
+        for (size, target) in self.targets.items():
+            count = self.counts.get(size, 0)
+            if (count < target * self.low_water):
+                missing[size] = target - count
+        return Distribution(from_counts=missing).get_alternating_list()
+
+    def wait(self, timeout=None):
+        """Waits for notifications until timeout or the next resync is due,
+        whichever comes first, and applies any that arrive.
+
+        :param timeout: the maximum number of seconds to wait
+        :returns: True if any notifications were received
+        """
+        if (self._last_resync is not None):
+            until_resync = max(0, self._last_resync + self.resync_interval -
+                               time.time())
+            if (timeout is None or until_resync < timeout):
+                timeout = until_resync
+
+        if (self._socket is None):
+            time.sleep(timeout if timeout is not None else 0)
+            return False
+
+        (readable, writable, errored) = select.select([self._socket], [],
+                                                      [], timeout)
+        if (len(readable) == 0):
+            return False
+
+        received = False
+        while (True):
+            try:
+                data = self._socket.recv(65536)
+            except socket.error:
+                # drained
+                break
+            try:
+                consumed = json.loads(data.decode('utf-8'))
+                self.consumed(dict((int(size), int(n))
+                                   for (size, n) in consumed.items()))
+                received = True
+            except (ValueError, AttributeError):
+                # not a notification
+                pass
+        return received
+
+    def close(self):
+        if (self._socket is not None):
+            self._socket.close()
+        self._socket = None
@@ -19,12 +19,67 @@ SQLALCHEMY_DATABASE_URI = 'mysql+pymysql://localhost/downstream?charset=utf8'  #
 FILES_PATH = 'tmp/'
 """Where tags are placed"""
 TAGS_PATH = 'tags/'
+"""Size in bytes of the pack files tags are appended to in TAGS_PATH"""
+TAG_SEGMENT_SIZE = 64 * 1024 * 1024
+"""Number of seconds between compactions of the tag store, which reclaim the
+space of the tags that were handed out.  The serving process starts them on
+its first request.  If None, the store is only compacted by
+runapp.py --compact-tags"""
+TAG_COMPACT_INTERVAL = 3600
+"""Fraction of the bytes of a pack file that must still be live for it to be
+left alone by compaction"""
+TAG_COMPACT_THRESHOLD = 0.5
+"""Codec new tags are compressed with when they are stored, 'zlib' or 'lzma'
+(python 3 only).  If None, tags are stored as plain pickles.  Tags are read
+back whichever way they were stored, so this can be changed at any time.
+See benchmarks/tag_compression.py"""
+TAG_COMPRESSION = None
+"""Compression level for TAG_COMPRESSION, or None for the codec default"""
+TAG_COMPRESSION_LEVEL = None
+"""Whether new tags are stored as the JSON sent to farmers by /chunk, which
+is spliced into the response as is, rather than pickled.  Nodes serving
+tags from REMOTE_TAGS_PATH must be able to read them"""
+TAG_JSON = True
+"""Maximum number of bytes of a chunk read at once while encoding it, for
+heartbeats that read chunks in large pieces.  The heartbeat must tolerate
+short reads.  The Merkle, PySwizzle and OneHash heartbeats already read in
+pieces of at most 64 KB, so they do not need it.  If None, the heartbeat
+reads as much as it asks for"""
+ENCODE_BUFFER_SIZE = None
+"""Number of worker processes runapp.py uses to encode generated chunks.
+If 0, chunks are encoded in the runapp.py process"""
+GENERATION_WORKERS = 0
+"""Address that runapp.py --maintain listens on for notifications that
+chunks were taken from the pool.  If None, the pool is only recounted every
+CHUNK_POOL_RESYNC_INTERVAL seconds"""
+CHUNK_POOL_NOTIFY_ADDRESS = ('127.0.0.1', 5101)
+"""Fraction of its target count below which runapp.py --maintain refills the
+chunks of a size"""
+CHUNK_POOL_LOW_WATER = 0.75
+"""Number of seconds between recounts of the chunk pool by runapp.py
+--maintain"""
+CHUNK_POOL_RESYNC_INTERVAL = 60
 """Where tags are retrieved from.  If none, indicates tags are stored locally.
 Otherwise, provide an http url to retrieve tags from."""
 REMOTE_TAGS_PATH = None
+"""Maximum number of connections kept alive to the REMOTE_TAGS_PATH server"""
+TAG_HTTP_POOL_SIZE = 10
+"""Maximum number of tags that can be fetched at once from /tag/<key>"""
+TAG_MULTI_GET_MAX = 100
+"""Number of tags /chunk reads ahead of the chunk being sent.  The tags are
+fetched in groups of this many, and the next group is fetched while the
+current one is sent.  If 0, all the tags are fetched before sending"""
+TAG_PREFETCH_DEPTH = 2
+"""Number of threads that fetch tags ahead for /chunk.  If 0, the tags are
+fetched in the thread serving the request, without overlapping"""
+TAG_PREFETCH_THREADS = 4
 """The path to the MMDB database used for locating IP addresses
 geographically"""
 MMDB_PATH = 'data/GeoLite2-City.mmdb'
+"""Maximum number of IP address locations to keep cached"""
+GEOIP_CACHE_SIZE = 4096
+"""Number of seconds a cached IP address location stays valid"""
+GEOIP_CACHE_TTL = 3600
 
 """The type of heartbeat to use
 The heartbeat we use should probably eventually be associated with
@@ -43,18 +98,70 @@ PROFILE = False
 
 """The default chunk size that will be returned if no size is specified"""
 DEFAULT_CHUNK_SIZE = 33554432
+"""Maximum number of tokens to keep in the token resolution cache"""
+TOKEN_CACHE_SIZE = 16384
+"""Number of seconds a cached token stays valid.  Tokens changed by other
+processes (such as runapp.py --whitelist) may be stale for this long"""
+TOKEN_CACHE_TTL = 60
+"""Number of seconds before a challenge is due that runapp.py --precompute
+generates the next one"""
+CHALLENGE_PRECOMPUTE_LOOKAHEAD = 60
+"""Maximum number of challenges runapp.py --precompute generates at once"""
+CHALLENGE_PRECOMPUTE_BATCH = 1000
 """Maximum number of tokens allowed per IP address"""
 MAX_TOKENS_PER_IP = 5
+"""Per IP request rate limits, by route.  Each limit is a (rate, burst)
+tuple, where rate is the sustained number of requests per second and burst
+is the number of requests that may be made at once.  Routes set to None or
+left out are not limited.  For example, dict(new=(0.1, 5), chunk=(1, 10))"""
+RATE_LIMITS = dict(new=None,
+                   heartbeat=None,
+                   chunk=None,
+                   challenge=None,
+                   answer=None)
+"""If set, the path of a file through which the rate limits are shared by
+all node processes on this host.  Otherwise each process limits separately"""
+RATE_LIMIT_SHARED_PATH = None
+"""Maximum number of rate limit buckets (route and IP address pairs) to keep"""
+RATE_LIMIT_SLOTS = 65536
 """Minimum crowdsale_balance value in the whitelist"""
 MIN_SJCX_BALANCE = 10000
+"""Minimum number of seconds between checks for whitelist changes.  The
+in memory whitelist is reloaded when runapp.py --whitelist has changed it"""
+WHITELIST_REFRESH_INTERVAL = 10
 """Maximum number of characters in the signature message"""
 MAX_SIG_MESSAGE_SIZE = 1024
 """Whether a signature is required to prove whitelist authority"""
 REQUIRE_SIGNATURE = True
+"""Number of worker processes used to verify signatures.  If 0,
+signatures are verified in the request thread"""
+SIGNATURE_WORKERS = 0
+"""Maximum number of seconds to wait for a signature verification worker"""
+SIGNATURE_TIMEOUT = 10
+"""Maximum number of successfully verified signatures to remember"""
+SIGNATURE_CACHE_SIZE = 4096
+"""Number of worker processes used to verify the proofs posted to /answer.
+If 0, proofs are verified in the request thread"""
+PROOF_WORKERS = 0
+"""Maximum number of seconds to wait for a batch of proofs to be verified"""
+PROOF_TIMEOUT = 30
+"""Number of seconds between writes of the buffered heartbeat counts to the
+database.  If 0, they are written after each /answer request"""
+HBCOUNT_FLUSH_INTERVAL = 5
 """The default interval for test files"""
 DEFAULT_INTERVAL = 300
 """Maximum number of chunks each /chunk/ request will return"""
 MAX_CHUNKS_PER_REQUEST = 10
+"""How concurrent /chunk requests keep from taking the same chunks.
+'skip_locked' locks them with SELECT ... FOR UPDATE SKIP LOCKED, which needs
+MySQL 8.0.1, MariaDB 10.6 or PostgreSQL 9.5.  'update' claims them with an
+UPDATE setting a claim token.  'lock' locks them with SELECT ... FOR UPDATE,
+making requests for the same chunks wait for each other.  If None,
+'skip_locked' is used where the database supports it and 'update' otherwise"""
+CHUNK_CLAIM_STRATEGY = None
+"""Number of seconds after which chunks claimed by a request that never
+handed them out are returned to the pool by runapp.py --cleandb"""
+CHUNK_CLAIM_TIMEOUT = 600
 """Maximum size that an address can be farming on this prototype node"""
 MAX_SIZE_PER_ADDRESS = 1073741824
 
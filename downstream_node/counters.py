@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import traceback
+
+
+class CounterBuffer(object):
+
+    """A write behind buffer of increments to counters.
+
+    Increments are collected in memory by key and handed to a flush function
+    as a single dictionary of totals, either whenever the owner commits or
+    periodically from a background thread.  Since the totals are additive,
+    buffers in several processes can flush to the same counters.  If the
+    flush function fails, the totals are kept and retried on the next flush.
+    """
+
+    def __init__(self, flush_func, interval=None):
+        """Initialization method
+
+        :param flush_func: function called with a dictionary mapping keys to
+            the totals to add to them
+        :param interval: the number of seconds between periodic flushes.  if
+            None or 0, the buffer is flushed by committed() instead
+        """
+        self.flush_func = flush_func
+        self.interval = interval
+        self._counts = dict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, key, n=1):
+        """Adds n to the counter for key
+
+        :param key: the counter to increment
+        :param n: the amount to add
+        """
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + n
+            if (self.interval and self._thread is None):
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def pending(self):
+        """Returns a copy of the totals that have not been flushed yet"""
+        with self._lock:
+            return dict(self._counts)
+
+    def flush(self):
+        """Hands the buffered totals to the flush function
+
+        :returns: the number of counters flushed
+        """
+        with self._flush_lock:
+            with self._lock:
+                counts = self._counts
+                self._counts = dict()
+            if (len(counts) == 0):
+                return 0
+            try:
+                self.flush_func(counts)
+            except:
+                # keep them for the next flush
+                with self._lock:
+                    for (key, n) in counts.items():
+                        self._counts[key] = self._counts.get(key, 0) + n
+                raise
+            return len(counts)
+
+    def committed(self, counts=None):
+        """Should be called after the owner commits, with the increments
+        made by the committed transaction.  Flushes the buffer unless it is
+        flushed periodically.
+
+        :param counts: a dictionary mapping keys to the amounts to add to
+            them
+        """
+        if (counts is not None):
+            for (key, n) in counts.items():
+                self.add(key, n)
+        if (not self.interval):
+            self.flush()
+
+    def _run(self):
+        while (not self._stop.wait(self.interval)):
+            try:
+                self.flush()
+            except:
+                traceback.print_exc()
+
+    def close(self):
+        """Stops the periodic flushes and flushes whatever is left"""
+        self._stop.set()
+        if (self._thread is not None):
+            self._thread.join()
+        self.flush()
@@ -10,6 +10,14 @@ class InvalidParameterError(Exception):
     pass
 
 
+class ServiceUnavailableError(Exception):
+    pass
+
+
+class RateLimitError(Exception):
+    pass
+
+
 class HttpHandler(object):
 
     def __init__(self, logger=None, context=dict()):
@@ -45,6 +53,16 @@ class HttpHandler(object):
                                     message=str(value))
             self.response.status_code = 400
             return True
+        elif (type is ServiceUnavailableError):
+            self.response = jsonify(status='error',
+                                    message=str(value))
+            self.response.status_code = 503
+            return True
+        elif (type is RateLimitError):
+            self.response = jsonify(status='error',
+                                    message=str(value))
+            self.response.status_code = 429
+            return True
         elif (type is not None):
             self.response = jsonify(status='error',
                                     message='Internal Server Error')
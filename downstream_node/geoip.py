@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+import maxminddb
+
+
+class GeoIPReader(object):
+
+    """A process wide, memory mapped MaxMind DB reader.
+
+    The underlying reader is opened lazily on the first lookup and shared by
+    all threads.  If the modification time of the database file changes, the
+    reader is reopened so that an updated database is picked up without
+    restarting the node.
+    """
+
+    def __init__(self, path):
+        """Initialization method
+
+        :param path: the path to the .mmdb database file
+        """
+        self.path = path
+        self._reader = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _get_reader(self):
+        """Returns the current reader, opening or reopening it if the
+        database file has not been opened yet or has changed on disk.
+        """
+        mtime = os.path.getmtime(self.path)
+        reader = self._reader
+        if (reader is not None and mtime == self._mtime):
+            return reader
+
+        with self._lock:
+            # another thread may have reopened it while we were waiting
+            if (self._reader is None or mtime != self._mtime):
+                # the old reader is not closed here, since other threads may
+                # still be reading from it.  its memory map is released when
+                # the last reference to it goes away.
+                self._reader = maxminddb.Reader(self.path,
+                                                maxminddb.MODE_MMAP)
+                self._mtime = mtime
+            return self._reader
+
+    def get(self, remote_addr):
+        """Looks up the given ip address in the database
+
+        :param remote_addr: the ip address to look up
+        :returns: the raw database record, or None if there is none
+        """
+        return self._get_reader().get(remote_addr)
+
+    def close(self):
+        """Closes the reader.  It will be reopened on the next lookup."""
+        with self._lock:
+            if (self._reader is not None):
+                self._reader.close()
+            self._reader = None
+            self._mtime = None
@@ -32,6 +32,9 @@ class Address(db.Model):
     address = db.Column(
         db.String(128), nullable=False, unique=True, index=True)
     crowdsale_balance = db.Column(db.BigInteger(), nullable=True)
+    # the total size of the files in contracts held by the address's tokens,
+    # kept up to date by the node functions that create and delete contracts
+    allocated_bytes = db.Column(db.BigInteger(), nullable=False, default=0)
 
     __table_args__ = (
         db.Index('ix_addresses_address_crowdsale_balance',
@@ -39,6 +42,30 @@ class Address(db.Model):
                  'crowdsale_balance'), )
 
 
+class WhitelistVersion(db.Model):
+
+    """A single row counter that is incremented whenever the whitelist in
+    the addresses table changes, so that nodes know to reload their in
+    memory whitelist.
+    """
+    __tablename__ = 'whitelist_version'
+
+    id = db.Column(db.Integer(), primary_key=True)
+    version = db.Column(db.Integer(), nullable=False, default=0)
+
+
+class IPTokenCount(db.Model):
+
+    """The number of tokens using each ip address.  This is kept up to date
+    by create_token, delete_token and process_token_ip_address so that the
+    tokens per ip address limit can be checked without counting tokens.
+    """
+    __tablename__ = 'ip_token_counts'
+
+    ip_address = db.Column(db.String(32), primary_key=True)
+    token_count = db.Column(db.Integer(), nullable=False, default=0)
+
+
 class Token(db.Model):
     __tablename__ = 'tokens'
 
@@ -155,6 +182,10 @@ class Chunk(db.Model):
     file_id = db.Column(db.ForeignKey('files.id'), index=True)
     state = db.Column(db.PickleType(), nullable=False)
     tag_path = db.Column(db.String(128), unique=True)
+    # the token of the request that claimed the chunk, and when, see
+    # node.reserve_chunks()
+    claim = db.Column(db.String(32), index=True)
+    claimed = db.Column(db.DateTime())
 
     file = db.relationship('File',
                            backref=db.backref('chunks',
@@ -176,6 +207,12 @@ class Contract(db.Model):
     due = db.Column(db.DateTime())
     answered = db.Column(db.Boolean(), default=False)
     cached = db.Column(db.Boolean(), default=False, index=True)
+    # the next challenge and the state it leaves behind, generated ahead of
+    # time by precompute_challenges() from the state the contract had when
+    # its challenge was due at next_for
+    next_state = db.Column(db.PickleType())
+    next_challenge = db.Column(db.PickleType())
+    next_for = db.Column(db.DateTime())
 
     token = db.relationship('Token',
                             backref=db.backref('contracts',
@@ -315,3 +352,21 @@ def update_uptime_summary():
                    upsum=bindparam('upsum'))
 
         db.engine.execute(s, new_summary)
+
+
+def add_hbcounts(counts):
+    """Adds buffered heartbeat counts to the tokens they belong to, with
+    one additive update per token, so that concurrent writers do not
+    overwrite each other.
+
+    :param counts: a dictionary mapping token ids to the number of
+        heartbeats to add
+    """
+    tokens = Token.__table__
+
+    stmt = tokens.update().\
+        where(tokens.c.id == bindparam('b_id')).\
+        values(hbcount=tokens.c.hbcount + bindparam('b_count'))
+
+    db.engine.execute(stmt, [dict(b_id=id, b_count=count)
+                             for (id, count) in counts.items()])
@@ -1,41 +1,131 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
-import pickle
+import json
 import binascii
-import maxminddb
+import siggy
 import base58
 import traceback
 import requests
+import multiprocessing
 
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
 from Crypto.Hash import SHA256
 from RandomIO import RandomIO
-from sqlalchemy import and_, desc, func
+from sqlalchemy import and_, or_, func, bindparam, union_all, event
+from sqlalchemy.sql import select, text
+from sqlalchemy.sql.expression import true
+from sqlalchemy.orm.attributes import set_committed_value
 from heartbeat import HeartbeatError
 
 from .startup import db, app
-from .models import Address, Token, File, Contract, Chunk
-from .exc import InvalidParameterError
-from .types import MutableTypeUnwrapper
+from .models import Address, Token, File, Contract, Chunk, IPTokenCount
+from .exc import (InvalidParameterError, ServiceUnavailableError,
+                  RateLimitError)
+from .types import MutableTypeWrapper, MutableTypeUnwrapper
+from .workers import verify_proof_task
+from .utils import BoundedReadStream, plan_chunk_reservation
+from .tagcodec import dump_tag, dump_tag_json, load_tag, unpack_tags
 
 __all__ = ['create_token',
            'delete_token',
+           'resolve_token',
+           'verify_signature',
            'get_chunk_contracts',
            'add_file',
            'remove_file',
-           'verify_proof',
-           'update_contract']
+           'verify_proofs',
+           'update_contract',
+           'generate_challenges']
+
+
+TokenInfo = namedtuple('TokenInfo',
+                       ['id',
+                        'token',
+                        'address_id',
+                        'ip_address',
+                        'farmer_id'])
+
+
+def resolve_token(token):
+    """Resolves a token string to the token's id, address id, ip address
+    and farmer id without loading the token object.  Results are cached in
+    app.caches['tokens'], so any change to these fields must call
+    invalidate_token, or invalidate_token_on_commit if the change is not
+    committed yet.
+
+    :param token: the token string
+    :returns: a TokenInfo tuple, or None if the token does not exist
+    """
+    cache = app.caches['tokens']
+    token_info = cache.get(token)
+    if (token_info is not None):
+        return token_info
+
+    tokens = Token.__table__
+    row = db.session.execute(
+        select([tokens.c.id,
+                tokens.c.address_id,
+                tokens.c.ip_address,
+                tokens.c.farmer_id]).where(tokens.c.token == token)).first()
+
+    if (row is None):
+        return None
+
+    token_info = TokenInfo(id=row.id,
+                           token=token,
+                           address_id=row.address_id,
+                           ip_address=row.ip_address,
+                           farmer_id=row.farmer_id)
+
+    cache.put(token, token_info)
+
+    return token_info
+
+
+def invalidate_token(token):
+    """Removes the token from the token resolution cache
+
+    :param token: the token string
+    """
+    app.caches['tokens'].invalidate(token)
+
+
+def invalidate_token_on_commit(token):
+    """Removes the token from the token resolution cache once the current
+    transaction commits.  Invalidating before then would let a concurrent
+    resolve_token cache the old values again until TOKEN_CACHE_TTL.
+
+    :param token: the token string
+    """
+    db.session().info.setdefault('invalidate_tokens', set()).add(token)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed_tokens(session):
+    for token in session.info.pop('invalidate_tokens', ()):
+        invalidate_token(token)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_token_invalidations(session):
+    # the cached values are still current
+    session.info.pop('invalidate_tokens', None)
 
 
 def get_ip_location(remote_addr):
-    """Gets the location of the specified remote_addr
+    """Gets the location of the specified remote_addr.  Locations are
+    cached by ip address in app.caches['geoip'].
 
     :param remote_addr: the ip address to get the location of
     :returns: the location as a dictionary
     """
-    # this code may need to be rethought for scalability, but for now,
-    # we're going with just opening a reader each time we get a location
+    cache = app.caches['geoip']
+    location = cache.get(remote_addr)
+    if (location is not None):
+        # copy so that callers cannot modify the cached location
+        return dict(location)
 
     location = {'country': None,
                 'state': None,
@@ -44,8 +134,7 @@ def get_ip_location(remote_addr):
                 'lat': None,
                 'lon': None}
 
-    reader = maxminddb.Reader(app.config['MMDB_PATH'])
-    mmloc = reader.get(remote_addr)
+    mmloc = app.geoip.get(remote_addr)
     if (mmloc is not None):
         if ('country' in mmloc):
             location['country'] = mmloc['country']['names']['en']
@@ -58,11 +147,139 @@ def get_ip_location(remote_addr):
         if ('location' in mmloc):
             location['lat'] = mmloc['location']['latitude']
             location['lon'] = mmloc['location']['longitude']
-    reader.close()
+
+    cache.put(remote_addr, dict(location))
 
     return location
 
 
+def get_ip_token_count(remote_addr):
+    """Gets the number of tokens using the given ip address from the
+    ip_token_counts table
+
+    :param remote_addr: the ip address
+    :returns: the number of tokens using the ip address
+    """
+    count = db.session.query(IPTokenCount.token_count).filter(
+        IPTokenCount.ip_address == remote_addr).scalar()
+
+    if (count is None):
+        return 0
+
+    return count
+
+
+def adjust_ip_token_count(remote_addr, delta):
+    """Adds delta to the number of tokens using the given ip address.
+    This is executed in the current session, so it is committed along
+    with the token changes that it accounts for.
+
+    :param remote_addr: the ip address
+    :param delta: the number of tokens to add, negative to remove
+    """
+    counts = IPTokenCount.__table__
+
+    if (delta > 0):
+        # a single statement, so that concurrent requests for an ip address
+        # that has no row yet do not both try to insert it
+        db.session.execute(
+            text('INSERT INTO {0} (ip_address, token_count) '
+                 'VALUES (:ip_address, :delta) '
+                 'ON DUPLICATE KEY UPDATE '
+                 'token_count = token_count + :delta'.format(counts.name)),
+            dict(ip_address=remote_addr, delta=delta))
+    else:
+        db.session.execute(
+            counts.update().where(counts.c.ip_address == remote_addr).
+            values(token_count=counts.c.token_count + delta))
+
+
+def rebuild_ip_token_counts():
+    """Rebuilds the ip_token_counts table from the tokens table.  Use this
+    if tokens have been modified outside of the node functions.
+    """
+    counts = IPTokenCount.__table__
+    tokens = Token.__table__
+
+    db.session.execute(counts.delete())
+    db.session.execute(
+        counts.insert().from_select(
+            ['ip_address', 'token_count'],
+            select([tokens.c.ip_address, func.count(tokens.c.id)]).
+            group_by(tokens.c.ip_address)))
+    db.session.commit()
+
+
+def adjust_allocated_bytes(deltas):
+    """Adds to the number of bytes allocated to addresses.  This is
+    executed in the current session, so it is committed along with the
+    contract changes that it accounts for.
+
+    :param deltas: a dictionary mapping address ids to the number of bytes
+        to add, negative to remove
+    """
+    addresses = Address.__table__
+
+    params = [dict(b_id=id, b_delta=delta)
+              for (id, delta) in deltas.items() if delta != 0]
+    if (len(params) == 0):
+        return
+
+    db.session.execute(
+        addresses.update().
+        where(addresses.c.id == bindparam('b_id')).
+        values(allocated_bytes=addresses.c.allocated_bytes +
+               bindparam('b_delta')), params)
+
+
+def release_allocated_bytes(condition):
+    """Subtracts the sizes of the contracts matching condition from the
+    bytes allocated to their addresses.  Call this in the same transaction
+    as, and before, deleting the contracts.
+
+    :param condition: a where clause on the contracts table
+    """
+    contracts = Contract.__table__
+    tokens = Token.__table__
+    files = File.__table__
+
+    rows = db.session.execute(
+        select([tokens.c.address_id, func.sum(files.c.size)]).
+        select_from(contracts.join(tokens).join(files)).
+        where(condition).
+        group_by(tokens.c.address_id)).fetchall()
+
+    adjust_allocated_bytes(dict((address_id, -int(size))
+                                for (address_id, size) in rows))
+
+
+def reconcile_allocated_bytes():
+    """Recounts the bytes allocated to each address from its contracts and
+    corrects the addresses whose count has drifted.  Use this if contracts
+    have been modified outside of the node functions.
+
+    :returns: the number of addresses corrected
+    """
+    addresses = Address.__table__
+    contracts = Contract.__table__
+    tokens = Token.__table__
+    files = File.__table__
+
+    size = func.coalesce(
+        select([func.sum(files.c.size)]).
+        select_from(contracts.join(tokens).join(files)).
+        where(tokens.c.address_id == addresses.c.id).
+        as_scalar(), 0)
+
+    result = db.session.execute(
+        addresses.update().
+        where(addresses.c.allocated_bytes != size).
+        values(allocated_bytes=size))
+    db.session.commit()
+
+    return result.rowcount
+
+
 def assert_ip_allowed_one_more_token(remote_addr):
     """This function enforces the max token per IP count rule for
     existing tokens.  If the ip address already has the MAX_TOKENS_PER_IP,
@@ -70,8 +287,7 @@ def assert_ip_allowed_one_more_token(remote_addr):
 
     :param remote_addr: The address to check.
     """
-    conflicting_tokens = Token.query.filter(
-        Token.ip_address == remote_addr).count()
+    conflicting_tokens = get_ip_token_count(remote_addr)
 
     if (app.config['MAX_TOKENS_PER_IP'] is not None and
             conflicting_tokens >= app.config['MAX_TOKENS_PER_IP']):
@@ -82,6 +298,20 @@ def assert_ip_allowed_one_more_token(remote_addr):
             format(app.config['MAX_TOKENS_PER_IP']))
 
 
+def assert_rate_limit(route, remote_addr):
+    """This function enforces the per IP request rate limit configured for
+    the given route in RATE_LIMITS.  It does not touch the database, so it
+    should be called before any other work is done for a request.  If
+    remote_addr has exceeded the limit, raises a RateLimitError.  Otherwise
+    returns None
+
+    :param route: the name of the route in RATE_LIMITS
+    :param remote_addr: the address making the request
+    """
+    if (not app.rate_limiter.allow(route, remote_addr)):
+        raise RateLimitError('Too many requests, please slow down.')
+
+
 def process_token_ip_address(db_token, remote_addr, change=False):
     """This function enforces the max token per IP count rule for
     existing tokens.
@@ -90,7 +320,8 @@ def process_token_ip_address(db_token, remote_addr, change=False):
     isn't, it checks to make sure that the ip address is allowed an
     additional token.  if it is, then if change==True, switches token
     over to remote_addr.
-    :param db_token: the database token object
+    :param db_token: the database token object.  if change is False, this
+        may also be a TokenInfo from resolve_token
     :param remote_addr: the ip address
     :param change: whether to change the token's ip address in the event
         that it is valid
@@ -103,8 +334,11 @@ def process_token_ip_address(db_token, remote_addr, change=False):
         # we should be good to go with the new ip
         if (change):
             location = get_ip_location(remote_addr)
+            adjust_ip_token_count(db_token.ip_address, -1)
+            adjust_ip_token_count(remote_addr, 1)
             db_token.location = location
             db_token.ip_address = remote_addr
+            invalidate_token_on_commit(db_token.token)
 
 
 def contract_insert_next_challenge(db_contract):
@@ -133,6 +367,133 @@ def contract_insert_next_challenge(db_contract):
     return True
 
 
+def contract_swap_next_challenge(db_contract):
+    """This swaps the challenge precomputed by precompute_challenges() into
+    the contract, if there is one and it was generated from the contract's
+    current state.
+
+    :param db_contract: database contract object
+    :returns: True if the precomputed challenge was swapped in, False if
+        there was none or it is stale
+    """
+    if (db_contract.next_challenge is None or
+            db_contract.next_for != db_contract.due):
+        return False
+
+    db_contract.state = db_contract.next_state
+    db_contract.challenge = db_contract.next_challenge
+    db_contract.due = db_contract.expiration
+    db_contract.answered = False
+    db_contract.next_state = None
+    db_contract.next_challenge = None
+    db_contract.next_for = None
+
+    return True
+
+
+def precompute_challenges(lookahead, limit=1000):
+    """This generates the next challenge ahead of time for answered
+    contracts whose current challenge is due within lookahead seconds, and
+    stores it with the resulting state in the contract's pending slot, so
+    that update_contract() only has to swap it in.  The pending slot is
+    tagged with the due time it was generated for, and is ignored if the
+    contract has moved on by the time it is used.
+
+    :param lookahead: the number of seconds before a challenge is due that
+        the next one may be generated
+    :param limit: the maximum number of contracts to process
+    :returns: the number of contracts processed
+    """
+    beat = app.heartbeat
+    now = datetime.utcnow()
+    contracts = Contract.__table__
+
+    s = select([contracts.c.id, contracts.c.state, contracts.c.due]).\
+        select_from(contracts.join(File.__table__)).\
+        where(and_(contracts.c.answered == true(),
+                   contracts.c.due <= now + timedelta(seconds=lookahead),
+                   Contract.expiration > now,
+                   or_(contracts.c.next_for.is_(None),
+                       contracts.c.next_for != contracts.c.due))).\
+        limit(limit)
+
+    pending = list()
+    for row in db.engine.execute(s).fetchall():
+        # the state is unpickled fresh, so it can be advanced without
+        # touching the contract's current state
+        state = row.state
+        if (isinstance(state, MutableTypeWrapper)):
+            state = state.__getstate__()
+        try:
+            chal = beat.gen_challenge(state)
+        except HeartbeatError:
+            # no more challenges.  an empty slot tagged with the due time
+            # keeps it from being picked up again, and update_contract()
+            # will find out for itself
+            state = None
+            chal = None
+        pending.append(dict(b_id=row.id,
+                            b_due=row.due,
+                            b_next_state=state,
+                            b_next_challenge=chal,
+                            b_next_for=row.due))
+
+    if (len(pending) > 0):
+        # only fill the slot if the contract has not moved on while the
+        # challenges were being generated
+        stmt = contracts.update().\
+            where(and_(contracts.c.id == bindparam('b_id'),
+                       contracts.c.due == bindparam('b_due'))).\
+            values(next_state=bindparam('b_next_state',
+                                        type_=contracts.c.next_state.type),
+                   next_challenge=bindparam(
+                       'b_next_challenge',
+                       type_=contracts.c.next_challenge.type),
+                   next_for=bindparam('b_next_for'))
+        db.engine.execute(stmt, pending)
+
+    return len(pending)
+
+
+def verify_signature(message, signature, sjcx_address):
+    """Verifies that signature is a valid signature of message by the owner
+    of sjcx_address.  If SIGNATURE_WORKERS is set, the verification is run
+    in app.signature_pool so that it does not hold the GIL in the server.
+    Successful verifications are remembered in app.caches['signatures'], so
+    resubmitting the same signed message is not verified again.
+
+    :param message: the message that was signed
+    :param signature: the base64 encoded signature
+    :param sjcx_address: the address that signed the message
+    :returns: True if the signature is valid, False otherwise
+    """
+    # each field is prefixed with its length, so that no two different
+    # triples hash the same data
+    h = SHA256.new()
+    for field in (sjcx_address, signature, message):
+        data = field.encode('utf-8')
+        h.update('{0}:'.format(len(data)).encode('utf-8'))
+        h.update(data)
+    key = h.hexdigest()
+
+    cache = app.caches['signatures']
+    if (cache.get(key) is not None):
+        return True
+
+    try:
+        valid = app.signature_pool.apply(siggy.verify_signature,
+                                         (message, signature, sjcx_address),
+                                         app.config['SIGNATURE_TIMEOUT'])
+    except multiprocessing.TimeoutError:
+        raise ServiceUnavailableError(
+            'Signature verification timed out, please try again.')
+
+    if (valid):
+        cache.put(key, True)
+
+    return valid
+
+
 def create_token(sjcx_address, remote_addr, message=None, signature=None):
     """Creates a token for the given address. Address must be in the white
     list of addresses.
@@ -144,9 +505,6 @@ def create_token(sjcx_address, remote_addr, message=None, signature=None):
     :returns: the token database object
     """
 
-    # make sure that the currnet ip has not excceeded it's token count
-    assert_ip_allowed_one_more_token(remote_addr)
-
     # make sure the address is valid
     try:
         base58.b58decode_check(sjcx_address)
@@ -154,9 +512,17 @@ def create_token(sjcx_address, remote_addr, message=None, signature=None):
         raise InvalidParameterError(
             'Invalid address given: address is not a valid SJCX address.')
 
+    # addresses that are not in the in memory whitelist snapshot are
+    # rejected without going to the database
+    if (sjcx_address not in app.whitelist):
+        raise InvalidParameterError(
+            'Invalid address given: address must be in whitelist.')
+
+    # make sure that the currnet ip has not excceeded it's token count
+    assert_ip_allowed_one_more_token(remote_addr)
+
     # confirm that sjcx_address is in the list of addresses
-    # and meets balance requirements
-    # for now we have a white list
+    # and meets balance requirements, in case the snapshot is stale
     db_address = Address.query.filter(
         and_(Address.address == sjcx_address,
              Address.crowdsale_balance >= app.config['MIN_SJCX_BALANCE'])).\
@@ -181,6 +547,7 @@ def create_token(sjcx_address, remote_addr, message=None, signature=None):
                      signature=signature)
 
     db.session.add(db_token)
+    adjust_ip_token_count(remote_addr, 1)
     db.session.commit()
 
     return db_token
@@ -197,9 +564,13 @@ def delete_token(token):
     if (db_token is None):
         raise InvalidParameterError('Nonexistent token.')
 
+    adjust_ip_token_count(db_token.ip_address, -1)
+    release_allocated_bytes(Contract.token_id == db_token.id)
     db.session.delete(db_token)
     db.session.commit()
 
+    invalidate_token(token)
+
 
 def generate_test_file(size):
     """This generates a test file and prepares it
@@ -216,36 +587,199 @@ def generate_test_file(size):
     return db_chunk
 
 
-def get_local_tag_path(hash):
-    return os.path.join(app.config['TAGS_PATH'], hash)
+def generate_test_files(sizes, pool, batch_size=100):
+    """This generates test files of the given sizes and prepares them.  The
+    files are encoded and their tags stored by encode_chunk() in the worker
+    pool, a batch at a time, and the files and chunks of each batch are
+    inserted in bulk.
+
+    :param sizes: a list of the file sizes to generate
+    :param pool: the WorkerPool to encode the files in
+    :param batch_size: the number of files to encode between inserts
+    :returns: the number of chunks generated
+    """
+    count = 0
+    for i in range(0, len(sizes), batch_size):
+        tasks = [(binascii.hexlify(os.urandom(16)).decode(), size)
+                 for size in sizes[i:i + batch_size]]
+
+        insert_test_files(pool.map(encode_chunk, tasks))
+
+        count += len(tasks)
+
+    return count
+
+
+def insert_test_files(encoded):
+    """This inserts the files and chunks for a batch of files encoded by
+    encode_chunk(), with one multiple row insert for each, in a single
+    transaction.
+
+    :param encoded: a list of (seed, size, state, tag hash) tuples
+    """
+    if (len(encoded) == 0):
+        return
+
+    files = File.__table__
+    now = datetime.utcnow()
+
+    # we'll cheat for speed and just give each file a random name
+    names = [binascii.hexlify(os.urandom(16)).decode() for e in encoded]
+
+    with db.engine.begin() as conn:
+        conn.execute(files.insert(),
+                     [dict(hash=name,
+                           redundancy=1,
+                           interval=app.config['DEFAULT_INTERVAL'],
+                           added=now,
+                           seed=seed,
+                           size=size)
+                      for (name, (seed, size, state, tag_hash))
+                      in zip(names, encoded)])
+
+        ids = dict(conn.execute(select([files.c.hash, files.c.id]).
+                                where(files.c.hash.in_(names))).fetchall())
+
+        conn.execute(Chunk.__table__.insert(),
+                     [dict(file_id=ids[name],
+                           state=state,
+                           tag_path=tag_hash)
+                      for (name, (seed, size, state, tag_hash))
+                      in zip(names, encoded)])
+
+
+def open_chunk_stream(seed, size):
+    """Opens the stream of a generated chunk for encoding.  If
+    ENCODE_BUFFER_SIZE is set, no sized read from it returns more than that
+    many bytes, for heartbeats that would otherwise read the chunk in
+    pieces that grow with its size.
+
+    :param seed: the seed of the chunk
+    :param size: the size of the chunk
+    :returns: a stream that supports `read()`, `seek()` and `tell()`
+    """
+    chunk_stream = RandomIO(seed, size)
+
+    if (app.config['ENCODE_BUFFER_SIZE'] is None):
+        return chunk_stream
+
+    return BoundedReadStream(chunk_stream, app.config['ENCODE_BUFFER_SIZE'])
+
+
+def encode_chunk(args):
+    """This encodes a chunk with the node heartbeat and stores its tag.  It
+    does not touch the database, so it can be run in a worker process.
+
+    :param args: a (seed, size) tuple describing the chunk
+    :returns: a (seed, size, state, tag hash) tuple
+    """
+    (seed, size) = args
+
+    chunk_stream = open_chunk_stream(seed, size)
+
+    (tag, state) = app.heartbeat.encode(chunk_stream, filesz=size)
+
+    return (seed, size, state, put_tag(tag))
+
+
+# keeps connections to the REMOTE_TAGS_PATH server alive between requests
+tag_session = requests.Session()
+tag_session.verify = False
+for prefix in ['http://', 'https://']:
+    tag_session.mount(prefix, requests.adapters.HTTPAdapter(
+        pool_maxsize=app.config['TAG_HTTP_POOL_SIZE']))
 
 
 def get_tag(hash):
     if (app.config['REMOTE_TAGS_PATH'] is None):
-        tag = None
-        tag_path = get_local_tag_path(hash)
-        with open(tag_path, 'rb') as f:
-            tag = pickle.load(f)
-        os.remove(tag_path)
-        return tag
+        # tags are only handed out once, so they are removed from the store
+        return load_tag(app.tag_store.pop(hash))
     else:
         # this route deletes the tag
         url = app.config['REMOTE_TAGS_PATH'] + '/' + hash
-        response = requests.get(url, verify=False)
+        response = tag_session.get(url)
         response.raise_for_status()
         binary_tag = response.content
-        return pickle.loads(binary_tag)
+        return load_tag(binary_tag)
 
 
-def put_tag(tag):
-    bin_tag = pickle.dumps(tag, pickle.HIGHEST_PROTOCOL)
+def get_tags(hashes):
+    """Gets several tags at once.  When tags are retrieved from
+    REMOTE_TAGS_PATH, they are fetched with a single request.  Like
+    get_tag(), this removes the tags from the store.
+
+    :param hashes: a list of the hashes of the tags
+    :returns: a dictionary mapping hashes to tags.  tags that were not found
+        are left out
+    """
+    if (len(hashes) == 0):
+        return dict()
+    if (app.config['REMOTE_TAGS_PATH'] is None):
+        binary_tags = dict()
+        for hash in hashes:
+            try:
+                binary_tags[hash] = app.tag_store.pop(hash)
+            except KeyError:
+                pass
+    else:
+        # this route deletes the tags
+        response = tag_session.post(
+            app.config['REMOTE_TAGS_PATH'],
+            data=json.dumps(dict(hashes=list(hashes))),
+            headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+        binary_tags = unpack_tags(response.content)
+    return dict((hash, load_tag(binary_tag))
+                for (hash, binary_tag) in binary_tags.items())
+
+
+def prefetch_tags(hashes, depth=None):
+    """Generates the tags for hashes, in order, reading ahead.  The tags are
+    fetched with get_tags() in groups of depth hashes on app.tag_pool, and
+    the next group is fetched while the tags of the current one are being
+    used.
+
+    :param hashes: a list of the hashes of the tags
+    :param depth: the number of tags in each group.  defaults to
+        TAG_PREFETCH_DEPTH.  if 0, all the tags are fetched at once
+    :returns: a generator of the tags, with None for the tags that were not
+        found
+    """
+    if (depth is None):
+        depth = app.config['TAG_PREFETCH_DEPTH']
+    if (depth == 0):
+        depth = max(1, len(hashes))
+    groups = [hashes[i:i + depth] for i in range(0, len(hashes), depth)]
+    pending = None
+    for (i, group) in enumerate(groups):
+        if (pending is None):
+            pending = app.tag_pool.apply_async(get_tags, (group, ))
+        result = pending
+        pending = None
+        if (i + 1 < len(groups)):
+            pending = app.tag_pool.apply_async(get_tags, (groups[i + 1], ))
+        try:
+            tags = result.get()
+        except Exception:
+            traceback.print_exc()
+            tags = dict()
+        for hash in group:
+            yield tags.get(hash)
 
-    hash = SHA256.new(bin_tag).hexdigest()
 
-    with open(get_local_tag_path(hash), 'wb') as f:
-        f.write(bin_tag)
+def put_tag(tag):
+    if (app.config['TAG_JSON']):
+        # stored as it is sent to farmers, so that /chunk does not have to
+        # load and encode it
+        bin_tag = dump_tag_json(tag,
+                                app.config['TAG_COMPRESSION'],
+                                app.config['TAG_COMPRESSION_LEVEL'])
+    else:
+        bin_tag = dump_tag(tag,
+                           app.config['TAG_COMPRESSION'],
+                           app.config['TAG_COMPRESSION_LEVEL'])
 
-    return hash
+    return app.tag_store.put(bin_tag)
 
 
 def prepare_contract(db_file):
@@ -254,13 +788,7 @@ def prepare_contract(db_file):
 
     :param db_file: the file database object to prepare
     """
-    beat = app.heartbeat
-
-    chunk_stream = RandomIO(db_file.seed, db_file.size)
-
-    (tag, state) = beat.encode(chunk_stream, filesz=db_file.size)
-
-    hash = put_tag(tag)
+    (seed, size, state, hash) = encode_chunk((db_file.seed, db_file.size))
 
     db_chunk = Chunk(file=db_file,
                      state=state,
@@ -276,10 +804,11 @@ def calculate_size_to_return(db_token, desired_size, max_size_per_address):
     """Calculates the size to return to the farmer, given
     current size, desired size and size restrictions"""
 
-    current_size = db.session.query(func.sum(File.size))\
-        .select_from(File)\
-        .join(Contract).join(Token).join(Address)\
-        .filter(Address.id == db_token.address_id).scalar()
+    addresses = Address.__table__
+
+    current_size = db.session.execute(
+        select([addresses.c.allocated_bytes]).
+        where(addresses.c.id == db_token.address_id)).scalar()
 
     if (current_size is None):
         current_size = 0
@@ -301,13 +830,15 @@ def get_chunk_contracts(db_token,
     """In the final version, this function should analyze currently available
     file chunks and disburse contracts for files that need higher redundancy
     counts.
-    In this prototype, returns an iterable of contracts that will fulfill the
-    size requirements requested
+    In this prototype, returns contracts for pregenerated chunks that will
+    fulfill the size requirements requested.  The chunks are reserved
+    together by reserve_chunks(), and the contracts are created with their
+    first challenge with a single insert.
 
-    :param db_token: the database token
+    :param db_token: the database token, or a TokenInfo from resolve_token
     :param size: the requested total contracts size
     :param max_chunk_count: maximum number of chunks to retrieve
-    :returns: an iterable of contracts from the database
+    :returns: a list of contracts from the database, largest first
     """
     # first, we need to find all the files that are not meeting their
     # redundancy requirements once we have found a candidate list, we sort
@@ -329,9 +860,6 @@ def get_chunk_contracts(db_token,
     # pick the best candidate
     # file = candidates[0]
 
-    contract_count = 0
-    total_size = 0
-
     if (max_chunk_count is None):
         max_chunk_count = app.config['MAX_CHUNKS_PER_REQUEST']
 
@@ -340,54 +868,310 @@ def get_chunk_contracts(db_token,
 
     size = calculate_size_to_return(db_token, size, max_size_per_address)
 
-    while ((max_chunk_count == 0 or
-            contract_count < max_chunk_count) and
-            total_size < size):
-        size_to_pull = size - total_size
-        # now we pull from pregenerated chunks
-        # we need a chunk that is smaller than the requested size
-        db_chunk = Chunk.query.with_for_update()\
-            .filter(File.size <= size_to_pull)\
-            .join(File).order_by(desc(File.size)).first()
-
-        if (db_chunk is None):
-            # no more of the appropriate size, we're done
-            break
+    rows = reserve_chunks(size, max_chunk_count)
 
-        db_contract = Contract(token=db_token,
-                               file=db_chunk.file,
-                               state=db_chunk.state,
-                               tag_path=db_chunk.tag_path,
-                               # due time and answered and challenge will be
-                               # inserted when we call update_contract() below
-                               start=datetime.utcnow(),
-                               due=datetime.utcnow(),
-                               answered=True)
-
-        db.session.add(db_contract)
-
-        # remove the chunk from the database since it has now been used.
-        db.session.delete(db_chunk)
-
-        if (not contract_insert_next_challenge(db_contract)):
-            # we were not able to insert the next challenge
+    beat = app.heartbeat
+    now = datetime.utcnow()
+    # sizes of the chunks taken from the pool, for the pool maintainer
+    consumed = dict()
+    values = list()
+    used = list()
+    allocated = 0
+    for row in sorted(rows, key=lambda r: r.size, reverse=True):
+        state = row.state
+        try:
+            chal = beat.gen_challenge(state)
+        except:
+            traceback.print_exc()
             # this is an issue at this stage, since the heartbeat should
-            # just have been generated
-            # raise an internal server error
+            # just have been generated.  the chunk is removed from the pool
+            # along with the used ones, since it would fail again
             print('Unable to initialize challenge for contract. '
                   'It is likely that the node heartbeat was '
                   'regenerated but the available chunks were not '
                   'which would leave inconsistencies in the '
                   'state objects.  Please regenerate any chunks '
                   'in the database.')
+            used.append(row.id)
+            consumed[row.size] = consumed.get(row.size, 0) + 1
+            continue
+
+        values.append(dict(token_id=db_token.id,
+                           file_id=row.file_id,
+                           state=MutableTypeWrapper(state),
+                           challenge=chal,
+                           tag_path=row.tag_path,
+                           start=now,
+                           due=now + timedelta(seconds=row.interval),
+                           answered=False,
+                           cached=False))
+        used.append(row.id)
+        consumed[row.size] = consumed.get(row.size, 0) + 1
+        allocated += row.size
+
+    if (len(values) > 0):
+        db.session.execute(Contract.__table__.insert(), values)
+        adjust_allocated_bytes({db_token.address_id: allocated})
+
+    if (len(used) > 0):
+        # remove the chunks from the database since they have now been used
+        chunks = Chunk.__table__
+        db.session.execute(chunks.delete().where(chunks.c.id.in_(used)))
+
+    db.session.commit()
+
+    app.chunk_notifier.notify(consumed)
+
+    if (len(values) == 0):
+        return []
+
+    db_contracts = Contract.query.filter(
+        Contract.tag_path.in_([v['tag_path'] for v in values])).all()
+    db_contracts.sort(key=lambda c: c.file.size, reverse=True)
+    return db_contracts
+
+
+def supports_skip_locked(engine):
+    """Returns True if the database behind engine supports SELECT ... FOR
+    UPDATE SKIP LOCKED, which MySQL does from 8.0.1, MariaDB from 10.6 and
+    PostgreSQL from 9.5.  The engine must have connected at least once.
+
+    :param engine: the database engine
+    """
+    try:
+        select([Chunk.__table__.c.id]).with_for_update(skip_locked=True)
+    except TypeError:
+        # sqlalchemy before 1.1
+        return False
+    dialect = engine.dialect
+    info = dialect.server_version_info or ()
+    version = tuple(v for v in info if isinstance(v, int))
+    if (dialect.name == 'postgresql'):
+        return version >= (9, 5)
+    if (dialect.name == 'mysql'):
+        if ('MariaDB' in info or getattr(dialect, '_is_mariadb', False)):
+            return version >= (10, 6)
+        return version >= (8, 0, 1)
+    return False
+
+
+def chunk_claim_strategy():
+    """Returns how reserve_chunks() keeps concurrent requests from taking
+    the same chunks: CHUNK_CLAIM_STRATEGY if it is set, otherwise
+    'skip_locked' if the database supports it and 'update' if not.
+    """
+    strategy = app.config['CHUNK_CLAIM_STRATEGY']
+    if (strategy is not None):
+        return strategy
+    if (supports_skip_locked(db.engine)):
+        return 'skip_locked'
+    return 'update'
+
+
+def reserve_chunks(size, max_chunk_count=0, attempts=3, strategy=None):
+    """Selects chunks from the pool to fill size and reserves them for the
+    current transaction.  Which chunks to take is planned greedily from the
+    counts of available chunks of each size.  Chunks taken by concurrent
+    requests are replaced, up to attempts times.
+
+    How the chunks are reserved depends on the strategy:
+
+    'skip_locked': the chunks of each size are selected and locked with
+    SELECT ... FOR UPDATE SKIP LOCKED, so concurrent requests take
+    different chunks without waiting for each other.
+
+    'update': the chunks are claimed with an UPDATE setting their claim
+    column to a random token, committed straight away, so that concurrent
+    requests only wait for each other for the duration of that statement.
+    Claims left behind by failed requests are released by
+    release_stale_claims().
+
+    'lock': candidates of every size are selected with a single query and
+    locked with a single SELECT ... FOR UPDATE, which waits for concurrent
+    requests holding the same chunks to finish.
+
+    :param size: the total size to fill
+    :param max_chunk_count: maximum number of chunks to take.  0 for no
+        limit
+    :param attempts: the number of times to plan and reserve chunks
+    :param strategy: 'skip_locked', 'update' or 'lock'.  defaults to
+        chunk_claim_strategy()
+    :returns: a list of rows with the id, file_id, state, tag_path, size and
+        interval of each reserved chunk
+    """
+    if (strategy is None):
+        strategy = chunk_claim_strategy()
+    reserve = dict(skip_locked=lock_chunks_skip_locked,
+                   update=claim_chunks,
+                   lock=lock_chunks)[strategy]
+
+    rows = list()
+    inventory = get_chunk_inventory()
+    for attempt in range(0, attempts):
+        remaining_count = 0
+        if (max_chunk_count > 0):
+            remaining_count = max_chunk_count - len(rows)
+            if (remaining_count <= 0):
+                break
+        plan = plan_chunk_reservation(inventory,
+                                      size - sum(r.size for r in rows),
+                                      remaining_count)
+        if (len(plan) == 0):
             break
 
-        yield db_contract
+        reserved = reserve(plan, [r.id for r in rows])
+        rows.extend(reserved)
 
-        total_size += db_contract.file.size
-        contract_count += 1
+        if (len(reserved) == sum(plan.values())):
+            break
 
-    db.session.commit()
+        # some were taken by another request.  recount, leaving out the
+        # chunks held by this one.  chunks claimed by update are not
+        # counted as available already
+        inventory = get_chunk_inventory()
+        if (strategy != 'update'):
+            for r in rows:
+                inventory[r.size] = inventory.get(r.size, 0) - 1
+
+    return rows
+
+
+def select_chunk_rows(claim=None):
+    """Returns a select of the columns that reserve_chunks() returns
+
+    :param claim: the claim token of the chunks to select.  if None, only
+        unclaimed chunks are selected
+    """
+    files = File.__table__
+    chunks = Chunk.__table__
+    s = select([chunks.c.id,
+                chunks.c.file_id,
+                chunks.c.state,
+                chunks.c.tag_path,
+                files.c.size,
+                files.c.interval]).\
+        select_from(chunks.join(files))
+    if (claim is None):
+        s = s.where(chunks.c.claim.is_(None))
+    else:
+        s = s.where(chunks.c.claim == claim)
+    return s
+
+
+def lock_chunks(plan, held):
+    """Reserves chunks for reserve_chunks() with the 'lock' strategy
+
+    :param plan: a dictionary mapping chunk sizes to the number of chunks
+        of that size to take
+    :param held: the ids of the chunks already held by this request
+    :returns: the rows of the chunks locked
+    """
+    files = File.__table__
+    chunks = Chunk.__table__
+
+    candidates = list()
+    for (chunk_size, count) in plan.items():
+        s = select([chunks.c.id]).\
+            select_from(chunks.join(files)).\
+            where(files.c.size == chunk_size).\
+            where(chunks.c.claim.is_(None))
+        if (len(held) > 0):
+            s = s.where(~chunks.c.id.in_(held))
+        # wrapped so that each limit applies to its own select
+        s = s.limit(count).alias()
+        candidates.append(select([s.c.id]))
+    if (len(candidates) > 1):
+        candidates = [union_all(*candidates)]
+    ids = [id for (id, ) in db.session.execute(candidates[0]).fetchall()]
+    if (len(ids) == 0):
+        return []
+
+    return db.session.execute(
+        select_chunk_rows().
+        where(chunks.c.id.in_(ids)).
+        with_for_update()).fetchall()
+
+
+def lock_chunks_skip_locked(plan, held):
+    """Reserves chunks for reserve_chunks() with the 'skip_locked' strategy
+
+    :param plan: a dictionary mapping chunk sizes to the number of chunks
+        of that size to take
+    :param held: the ids of the chunks already held by this request
+    :returns: the rows of the chunks locked
+    """
+    files = File.__table__
+    chunks = Chunk.__table__
+
+    rows = list()
+    for (chunk_size, count) in plan.items():
+        s = select_chunk_rows().where(files.c.size == chunk_size)
+        if (len(held) > 0):
+            s = s.where(~chunks.c.id.in_(held))
+        s = s.limit(count).with_for_update(skip_locked=True)
+        rows.extend(db.session.execute(s).fetchall())
+    return rows
+
+
+def claim_chunks(plan, held):
+    """Reserves chunks for reserve_chunks() with the 'update' strategy
+
+    :param plan: a dictionary mapping chunk sizes to the number of chunks
+        of that size to take
+    :param held: the ids of the chunks already held by this request, which
+        are claimed already
+    :returns: the rows of the chunks claimed
+    """
+    files = File.__table__
+    chunks = Chunk.__table__
+    claim = binascii.hexlify(os.urandom(16)).decode()
+    now = datetime.utcnow()
+
+    for (chunk_size, count) in plan.items():
+        # autocommitted outside of the session, so the rows are only locked
+        # while the update runs
+        db.engine.execute(
+            chunks.update(mysql_limit=count).
+            where(chunks.c.claim.is_(None)).
+            where(chunks.c.file_id.in_(select([files.c.id]).
+                                       where(files.c.size == chunk_size))).
+            values(claim=claim, claimed=now))
+
+    # read outside of the session as well, since a snapshot taken by the
+    # session before the claims were committed would not see them
+    return db.engine.execute(select_chunk_rows(claim)).fetchall()
+
+
+def release_stale_claims(timeout):
+    """Releases the claims on chunks that were claimed more than timeout
+    seconds ago, by requests that failed before handing them out
+
+    :param timeout: the number of seconds after which a claim is stale
+    :returns: the number of chunks released
+    """
+    chunks = Chunk.__table__
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    result = db.engine.execute(chunks.update().
+                               where(chunks.c.claimed < cutoff).
+                               values(claim=None, claimed=None))
+    return result.rowcount
+
+
+def get_chunk_inventory():
+    """Counts the chunks available in the pool
+
+    :returns: a dictionary mapping chunk sizes to the number of available
+        chunks of that size
+    """
+    files = File.__table__
+    chunks = Chunk.__table__
+
+    s = select([files.c.size, func.count(chunks.c.id)]).\
+        select_from(chunks.join(files)).\
+        where(chunks.c.claim.is_(None)).\
+        group_by(files.c.size)
+
+    return dict(db.engine.execute(s).fetchall())
 
 
 # def add_file(chunk_path, redundancy=3, interval=60):
@@ -449,6 +1233,7 @@ def remove_file(hash):
         raise InvalidParameterError(
             'File does not exist.  Cannot remove non existant file')
 
+    release_allocated_bytes(Contract.file_id == db_file.id)
     db.session.delete(db_file)
     db.session.commit()
 
@@ -469,6 +1254,9 @@ def update_contract(db_contract):
             datetime.utcnow() < db_contract.due):
         return db_contract
 
+    if (contract_swap_next_challenge(db_contract)):
+        return db_contract
+
     contract_still_valid = contract_insert_next_challenge(db_contract)
 
     if (not contract_still_valid):
@@ -478,34 +1266,137 @@ def update_contract(db_contract):
     return db_contract
 
 
-def verify_proof(db_contract, proof, received):
-    """This queries the DB to retrieve the heartbeat, state and challenge for
-    the contract id, and then checks the given proof.  Returns true if the
-    proof is valid.  Can also return false if the contract is expired or if
-    an ip address change has been rejected
-
-    :param db_contract: the contract to verify
-    :param proof: a heartbeat proof object that has been returned by the farmer
-    :param received: the time the proof was received
-    :returns: boolean true if the proof is valid, false otherwise
-    """
+def generate_challenges(db_contracts):
+    """This brings the challenges of a batch of contracts up to date, like
+    update_contract() does for a single contract.  Contracts whose challenge
+    is still current are left alone.  The others get the challenge
+    precomputed by precompute_challenges() if it is still valid, or a newly
+    generated one otherwise.
 
-    if (received >= db_contract.expiration):
-        raise InvalidParameterError('Answer failed: contract expired.')
+    The states are advanced in place, without going through the mutable
+    type snapshots, and the new state, challenge, due time and answered flag
+    of every contract are written with a single executemany UPDATE in the
+    current session.  The contract objects are updated to match without
+    being marked as modified.
 
+    :param db_contracts: a list of contracts that have not expired
+    :returns: a list with, for each contract, True if it has a current
+        challenge or False if it has run out of challenges
+    """
+    beat = app.heartbeat
+    now = datetime.utcnow()
+    contracts = Contract.__table__
+
+    results = list()
+    updates = list()
+    for db_contract in db_contracts:
+        if (db_contract.challenge is not None and now < db_contract.due):
+            results.append(True)
+            continue
+
+        state = db_contract.state.__getstate__()
+        if (db_contract.next_challenge is not None and
+                db_contract.next_for == db_contract.due):
+            state = db_contract.next_state
+            chal = db_contract.next_challenge
+        else:
+            try:
+                chal = beat.gen_challenge(state)
+            except HeartbeatError as ex:
+                print(ex)
+                results.append(False)
+                continue
+            except:
+                traceback.print_exc()
+                results.append(False)
+                continue
+
+        due = db_contract.expiration
+        db_contract.state.__setstate__(state)
+        set_committed_value(db_contract, 'challenge', chal)
+        set_committed_value(db_contract, 'due', due)
+        set_committed_value(db_contract, 'answered', False)
+        set_committed_value(db_contract, 'next_state', None)
+        set_committed_value(db_contract, 'next_challenge', None)
+        set_committed_value(db_contract, 'next_for', None)
+
+        updates.append(dict(b_id=db_contract.id,
+                            b_state=db_contract.state,
+                            b_challenge=chal,
+                            b_due=due))
+        results.append(True)
+
+    if (len(updates) > 0):
+        stmt = contracts.update().\
+            where(contracts.c.id == bindparam('b_id')).\
+            values(state=bindparam('b_state',
+                                   type_=contracts.c.state.type),
+                   challenge=bindparam('b_challenge',
+                                       type_=contracts.c.challenge.type),
+                   due=bindparam('b_due'),
+                   answered=False,
+                   next_state=None,
+                   next_challenge=None,
+                   next_for=None)
+        db.session.execute(stmt, updates)
+
+    return results
+
+
+def verify_proofs(pairs, received):
+    """This checks a batch of proofs against the challenges and states of
+    their contracts, and marks the contracts of the valid ones answered.
+    Proofs for expired or already answered contracts are not checked.  If
+    PROOF_WORKERS is set, the proofs are checked in parallel in
+    app.proof_pool.  Either way, the contracts are updated in the calling
+    thread.  The heartbeat counts of the tokens of valid proofs are left to
+    the caller to hand to app.hbcounts.committed() once the contract updates
+    have been committed.
+
+    :param pairs: a list of (db_contract, proof) pairs
+    :param received: the time the proofs were received
+    :returns: a list with, for each pair, True if the proof is valid, False
+        if it is not, or an InvalidParameterError explaining why it could
+        not be checked
+    """
     beat = app.heartbeat
-    chal = db_contract.challenge
 
-    if (not db_contract.answered):
-        # this is a massive pain with sqlalchemy the way it is...
-        # it does not play well with c++ python objects.
-        with MutableTypeUnwrapper(db_contract.state) as state:
-            valid = beat.verify(proof, chal, state)
+    results = [None] * len(pairs)
+    tasks = list()
+    indexes = list()
+    for (i, (db_contract, proof)) in enumerate(pairs):
+        if (received >= db_contract.expiration):
+            results[i] = InvalidParameterError(
+                'Answer failed: contract expired.')
+        elif (db_contract.answered):
+            results[i] = InvalidParameterError('Challenge already answered.')
+        else:
+            tasks.append((proof,
+                          db_contract.challenge,
+                          db_contract.state.__getstate__()))
+            indexes.append(i)
+
+    if (len(tasks) == 0):
+        return results
+
+    if (app.proof_pool.processes == 0):
+        valid = [verify_proof_task(t, beat) for t in tasks]
     else:
-        raise InvalidParameterError('Challenge already answered.')
-
-    if (valid):
-        db_contract.token.hbcount += 1
-        db_contract.answered = True
-
-    return valid
+        try:
+            valid = app.proof_pool.map(verify_proof_task,
+                                       tasks,
+                                       app.config['PROOF_TIMEOUT'])
+        except multiprocessing.TimeoutError:
+            for i in indexes:
+                results[i] = InvalidParameterError(
+                    'Answer failed: verification timed out, please try '
+                    'again.')
+            return results
+
+    for (i, v) in zip(indexes, valid):
+        results[i] = v
+        if (v):
+            db_contract = pairs[i][0]
+            db_contract.answered = True
+
+    return results
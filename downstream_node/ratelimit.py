@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+
+def take_token(tokens, last, now, rate, burst):
+    """Refills a token bucket for the time elapsed since it was last
+    updated and tries to take one token from it.
+
+    :param tokens: the number of tokens in the bucket at time last
+    :param last: the time the bucket was last updated
+    :param now: the current time
+    :param rate: the number of tokens added per second
+    :param burst: the capacity of the bucket
+    :returns: a tuple of whether a token was taken and the number of tokens
+        left in the bucket
+    """
+    tokens = min(float(burst), tokens + max(0.0, now - last) * rate)
+    if (tokens >= 1.0):
+        return (True, tokens - 1.0)
+    return (False, tokens)
+
+
+class LocalBucketTable(object):
+
+    """Token buckets held in memory by this process only.
+
+    At most maxsize buckets are kept.  When the table is full the least
+    recently used bucket is dropped, which amounts to giving that key a full
+    bucket the next time it is seen.
+    """
+
+    def __init__(self, maxsize=65536):
+        """Initialization method
+
+        :param maxsize: the maximum number of buckets to keep
+        """
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, rate, burst, now):
+        """Tries to take a token from the bucket for key
+
+        :param key: the bucket key
+        :param rate: the number of tokens added per second
+        :param burst: the capacity of the bucket
+        :param now: the current time
+        :returns: True if a token was taken, False if the bucket is empty
+        """
+        with self._lock:
+            (tokens, last) = self._buckets.pop(key, (burst, now))
+            (allowed, tokens) = take_token(tokens, last, now, rate, burst)
+            self._buckets[key] = (tokens, now)
+            while (len(self._buckets) > self.maxsize):
+                self._buckets.popitem(last=False)
+            return allowed
+
+
+class SharedBucketTable(object):
+
+    """Token buckets held in a memory mapped file, so that every worker
+    process serving the node on this host shares them.
+
+    The file is a fixed size table of slots, each holding a 64 bit key hash,
+    the number of tokens and the time of the last update.  A key is stored in
+    the slot its hash points to.  If two keys share a slot, the newer one
+    takes it over and the other starts from a full bucket, so collisions can
+    only make the limiter more lenient.  Access is serialized with an
+    exclusive lock on the file.
+    """
+
+    slot = struct.Struct('<Qdd')
+
+    def __init__(self, path, slots=65536):
+        """Initialization method.  The file is created if it does not exist
+        and grown to the size of the table if it is too small.
+
+        :param path: the path of the table file
+        :param slots: the number of slots in the table
+        """
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        size = slots * self.slot.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if (os.fstat(self._fd).st_size < size):
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+
+    @staticmethod
+    def hash_key(key):
+        """Returns a non zero 64 bit hash of key.  Zero marks an empty slot.
+
+        :param key: the bucket key
+        """
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        return struct.unpack('<Q', digest[:8])[0] or 1
+
+    def take(self, key, rate, burst, now):
+        """Tries to take a token from the bucket for key
+
+        :param key: the bucket key
+        :param rate: the number of tokens added per second
+        :param burst: the capacity of the bucket
+        :param now: the current time
+        :returns: True if a token was taken, False if the bucket is empty
+        """
+        h = self.hash_key(key)
+        offset = (h % self.slots) * self.slot.size
+        # the file lock is held per process, so threads in this process
+        # also need to be serialized
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                (slot_hash, tokens, last) = \
+                    self.slot.unpack_from(self._map, offset)
+                if (slot_hash != h):
+                    (tokens, last) = (burst, now)
+                (allowed, tokens) = take_token(tokens, last, now, rate, burst)
+                self.slot.pack_into(self._map, offset, h, tokens, now)
+                return allowed
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        """Unmaps and closes the table file"""
+        with self._lock:
+            self._map.close()
+            os.close(self._fd)
+
+
+class RateLimiter(object):
+
+    """Per route, per client token bucket rate limiter.
+
+    Each route has its own rate and burst, and each client address gets its
+    own bucket for each route.  Routes that are not configured, or are
+    configured with None, are not limited.
+    """
+
+    def __init__(self, limits=None, shared_path=None, slots=65536):
+        """Initialization method
+
+        :param limits: a dictionary mapping route names to a (rate, burst)
+            tuple, where rate is the sustained number of requests allowed per
+            second and burst is the number of requests allowed at once
+        :param shared_path: if given, the path of a file in which to share
+            buckets with other processes.  otherwise buckets are kept in
+            memory by this process
+        :param slots: the maximum number of buckets to keep
+        """
+        self.limits = dict(limits or dict())
+        if (shared_path is not None):
+            self.table = SharedBucketTable(shared_path, slots)
+        else:
+            self.table = LocalBucketTable(slots)
+
+    def allow(self, route, remote_addr, now=None):
+        """Takes a token from the bucket of remote_addr for route
+
+        :param route: the name of the route being requested
+        :param remote_addr: the address of the client
+        :param now: the current time, defaults to time.time()
+        :returns: True if the request is allowed, False if it should be
+            rejected
+        """
+        limit = self.limits.get(route)
+        if (limit is None):
+            return True
+        (rate, burst) = limit
+        if (now is None):
+            now = time.time()
+        return self.table.take('{0} {1}'.format(route, remote_addr),
+                               rate, burst, now)
@@ -1,25 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
 import siggy
 import ijson
 import pickle
 import traceback
 
-from flask import jsonify, request, Response, stream_with_context
+from flask import jsonify, request, Response, stream_with_context, json
 from flask import make_response
+from werkzeug.wsgi import wrap_file
 from sqlalchemy import func, desc
 from sqlalchemy.sql import select
 from datetime import datetime
 
 from .startup import app, db
 from .node import (create_token, get_chunk_contracts,
-                   verify_proof, update_contract,
-                   process_token_ip_address, get_tag)
+                   verify_proofs, generate_challenges,
+                   process_token_ip_address, prefetch_tags,
+                   resolve_token, verify_signature,
+                   assert_rate_limit)
 from .models import Token, Address, Contract, File, update_uptime_summary
 from .exc import InvalidParameterError, NotFoundError, HttpHandler
-from .streamencoder import JSONEncoder as StreamEncoder
+from .streamencoder import JSONEncoder as StreamEncoder, RawJSON
+from .tagcodec import pack_tags
+
+
+@app.before_request
+def start_tag_compaction():
+    if (app.config['TAG_COMPACT_INTERVAL']):
+        app.tag_store.start_compaction(app.config['TAG_COMPACT_INTERVAL'],
+                                       app.config['TAG_COMPACT_THRESHOLD'])
 
 
 @app.route('/')
@@ -157,6 +167,16 @@ def api_downstream_status_show(farmer_id):
     return handler.response
 
 
+def public_heartbeat_response(token):
+    """builds the response to /new and /heartbeat, splicing in the
+    precomputed encoding of the public heartbeat.
+    """
+    pub_beat = app.public_heartbeat
+    body = '{{"heartbeat": {0}, "token": {1}, "type": {2}}}'.format(
+        pub_beat.json, json.dumps(token), json.dumps(pub_beat.type))
+    return Response(body, mimetype='application/json')
+
+
 @app.route('/new/<sjcx_address>', methods=['GET', 'POST'])
 def api_downstream_new_token(sjcx_address):
     # generate a new token
@@ -164,6 +184,8 @@ def api_downstream_new_token(sjcx_address):
         handler.context['sjcx_address'] = sjcx_address
         handler.context['remote_addr'] = request.remote_addr
 
+        assert_rate_limit('new', request.remote_addr)
+
         message = None
         signature = None
         if (app.config['REQUIRE_SIGNATURE']):
@@ -195,9 +217,9 @@ def api_downstream_new_token(sjcx_address):
                 signature = d['signature']
 
                 # parse the signature and message
-                if (not siggy.verify_signature(message,
-                                               signature,
-                                               sjcx_address)):
+                if (not verify_signature(message,
+                                         signature,
+                                         sjcx_address)):
                     raise InvalidParameterError('Signature invalid.')
             else:
                 raise InvalidParameterError(
@@ -206,18 +228,16 @@ def api_downstream_new_token(sjcx_address):
 
         db_token = create_token(
             sjcx_address, request.remote_addr, message, signature)
-        beat = app.heartbeat
-        pub_beat = beat.get_public()
-
-        response = dict(token=db_token.token,
-                        type=type(beat).__name__,
-                        heartbeat=pub_beat.todict())
 
         if (app.mongo_logger is not None):
+            pub_beat = app.public_heartbeat
+            response = dict(token=db_token.token,
+                            type=pub_beat.type,
+                            heartbeat=pub_beat.heartbeat)
             app.mongo_logger.log_event('new', {'context': handler.context,
                                                'response': response})
 
-        return jsonify(response)
+        return public_heartbeat_response(db_token.token)
 
     return handler.response
 
@@ -230,27 +250,41 @@ def api_downstream_heartbeat(token):
     Provided for nodes that need to recover their heartbeat.
     The heartbeat does not contain any private information,
     so having someone else's heartbeat does not help you.
+    The response carries a strong ETag, so that clients that already
+    have it can revalidate it with If-None-Match.
     """
     with HttpHandler(app.mongo_logger) as handler:
         handler.context['token'] = token
         handler.context['remote_addr'] = request.remote_addr
-        db_token = Token.query.filter(Token.token == token).first()
 
-        if (db_token is None):
+        assert_rate_limit('heartbeat', request.remote_addr)
+
+        token_info = resolve_token(token)
+
+        if (token_info is None):
             raise NotFoundError('Nonexistent token.')
 
-        beat = app.heartbeat
-        pub_beat = beat.get_public()
-        response = dict(token=db_token.token,
-                        type=type(beat).__name__,
-                        heartbeat=pub_beat.todict())
+        pub_beat = app.public_heartbeat
 
         if (app.mongo_logger is not None):
+            response = dict(token=token_info.token,
+                            type=pub_beat.type,
+                            heartbeat=pub_beat.heartbeat)
             app.mongo_logger.log_event('heartbeat',
                                        {'context': handler.context,
                                         'response': response})
 
-        return jsonify(response)
+        # the response only depends on the heartbeat and the token
+        etag = '{0}-{1}'.format(pub_beat.digest, token_info.token)
+
+        if (request.if_none_match.contains(etag)):
+            response = Response(status=304)
+        else:
+            response = public_heartbeat_response(token_info.token)
+
+        response.set_etag(etag)
+
+        return response
 
     return handler.response
 
@@ -264,34 +298,44 @@ def api_downstream_chunk_contract(token, size):
         handler.context['size'] = size
         handler.context['remote_addr'] = request.remote_addr
 
+        assert_rate_limit('chunk', request.remote_addr)
+
         # verify the token
-        db_token = Token.query.filter(Token.token == token).first()
+        token_info = resolve_token(token)
 
-        if (db_token is None):
+        if (token_info is None):
             raise InvalidParameterError('Nonexistent token.')
 
-        process_token_ip_address(db_token, request.remote_addr, True)
-
-        db_contracts = get_chunk_contracts(db_token, size)
+        if (token_info.ip_address != request.remote_addr):
+            # the ip address may change, so we need the full token object
+            db_token = Token.query.get(token_info.id)
+            process_token_ip_address(db_token, request.remote_addr, True)
+
+        # reserve all the contracts first, so that their tags can be
+        # fetched ahead
+        contracts = [(db_contract.file.seed,
+                      db_contract.file.size,
+                      db_contract.id,
+                      db_contract.challenge,
+                      db_contract.tag_path,
+                      db_contract.due)
+                     for db_contract in get_chunk_contracts(token_info, size)]
 
         def get_chunks():
-            for db_contract in db_contracts:
-                chal = db_contract.challenge
-
-                try:
-                    tag = get_tag(db_contract.tag_path)
-                except:
+            tags = prefetch_tags([c[4] for c in contracts])
+            for (seed, chunk_size, id, chal, tag_path, due) in contracts:
+                tag = next(tags)
+                if (tag is None):
                     print('Tag was not found, skipping contract.')
                     continue
 
-                db.session.flush()
-
-                chunk = dict(seed=db_contract.file.seed,
-                             size=db_contract.file.size,
-                             file_hash=db_contract.id,
+                chunk = dict(seed=seed,
+                             size=chunk_size,
+                             file_hash=id,
                              challenge=chal.todict(),
-                             tag=tag.todict(),
-                             due=(db_contract.due - datetime.utcnow()).
+                             tag=tag if isinstance(tag, RawJSON)
+                             else tag.todict(),
+                             due=(due - datetime.utcnow()).
                              total_seconds())
 
                 yield chunk
@@ -311,13 +355,13 @@ def api_downstream_chunk_contract(token, size):
     return handler.response
 
 
-def get_contract_iter(hash_iterable, key=None, bufsz=100):
+def get_contract_batches(hash_iterable, key=None, bufsz=100):
     """calls next() on hash_iterable until at most bufsz hashes have
     been retrieved, at which point it queries the database and
     retrieves all the contracts associated with those hashes.
-    then it yields each contract associated with the hashes in
-    hash_iterable, or None if a contract was not found associated with
-    the hash specified.  yields a list [contract, hash_iterable_item]
+    then it yields a list of pairs [contract, hash_iterable_item], one for
+    each hash in the batch, where contract is None if a contract was not
+    found associated with the hash specified.
     """
     done = False
     while (not done):
@@ -343,41 +387,49 @@ def get_contract_iter(hash_iterable, key=None, bufsz=100):
         contracts = Contract.query.filter(Contract.id.in_(map.keys())).all()
         for c in contracts:
             map[c.id][0] = c
-        for pair in map.values():
-            yield pair
+        yield list(map.values())
 
 
-def get_challenges(pair_iterator, token_id):
-    for (db_contract, item) in pair_iterator:
-        if (db_contract is None or
-                db_contract.token_id != token_id):
-            challenge = dict(
-                file_hash=item, error='contract not found')
-            yield challenge
-            continue
-
-        challenge = dict(file_hash=db_contract.id)
+def get_challenges(batch_iterator, token_id):
+    """brings the challenges of each batch of contracts up to date
+    with generate_challenges() and yields a challenge, or an error, for
+    each of them.  each batch is committed before it is yielded so that
+    the contracts are not locked while the response is streamed.
+    """
+    for batch in batch_iterator:
+        now = datetime.utcnow()
+        live = [db_contract for (db_contract, item) in batch
+                if (db_contract is not None and
+                    db_contract.token_id == token_id and
+                    now < db_contract.expiration)]
+        valid = dict(zip([c.id for c in live], generate_challenges(live)))
+
+        challenges = list()
+        for (db_contract, item) in batch:
+            if (db_contract is None or
+                    db_contract.token_id != token_id):
+                challenges.append(dict(
+                    file_hash=item, error='contract not found'))
+                continue
 
-        try:
-            db_contract = update_contract(db_contract)
-        except InvalidParameterError:
-            challenge['error'] = 'contract expired'
-            yield challenge
-            continue
+            challenge = dict(file_hash=db_contract.id)
 
-        if (db_contract is None):
-            challenge['status'] = 'no more challenges'
-            yield challenge
-            continue
+            if (db_contract.id not in valid):
+                challenge['error'] = 'contract expired'
+            elif (not valid[db_contract.id]):
+                challenge['status'] = 'no more challenges'
+            else:
+                challenge['challenge'] = db_contract.challenge.todict()
+                challenge['due'] = (db_contract.due - datetime.utcnow())\
+                    .total_seconds()
+                challenge['answered'] = db_contract.answered
 
-        challenge['challenge'] = db_contract.challenge.todict()
-        challenge['due'] = (db_contract.due - datetime.utcnow())\
-            .total_seconds()
-        challenge['answered'] = db_contract.answered
+            challenges.append(challenge)
 
-        yield challenge
+        db.session.commit()
 
-    db.session.commit()
+        for challenge in challenges:
+            yield challenge
 
 
 @app.route('/challenge/<token>', methods=['GET', 'POST'])
@@ -393,24 +445,26 @@ def api_downstream_chunk_contract_status(token):
         handler.context['token'] = token
         handler.context['remote_addr'] = request.remote_addr
 
-        db_token = Token.query.filter(Token.token == token).first()
+        assert_rate_limit('challenge', request.remote_addr)
+
+        token_info = resolve_token(token)
 
-        if (db_token is None):
+        if (token_info is None):
             raise InvalidParameterError('Nonexistent token.')
 
         if (request.method == 'POST'):
             # try to stream POST data
             hash_iterable = ijson.items(request.stream, 'hashes.item')
 
-            pair_iterator = get_contract_iter(hash_iterable)
+            batch_iterator = get_contract_batches(hash_iterable)
         else:
-            def get_all():
+            def get_all(bufsz=100):
                 contracts = Contract.query.filter(
-                    Contract.token_id == db_token.id).all()
-                for c in contracts:
-                    yield (c, c.id)
+                    Contract.token_id == token_info.id).all()
+                for i in range(0, len(contracts), bufsz):
+                    yield [(c, c.id) for c in contracts[i:i + bufsz]]
 
-            pair_iterator = get_all()
+            batch_iterator = get_all()
 
         if (app.mongo_logger is not None):
             app.mongo_logger.log_event('challenge',
@@ -418,7 +472,7 @@ def api_downstream_chunk_contract_status(token):
                                         'response': 'REDACTED (streaming)'})
 
         response = dict(
-            challenges=get_challenges(pair_iterator, db_token.id))
+            challenges=get_challenges(batch_iterator, token_info.id))
 
         return Response(stream_with_context(StreamEncoder(stream=True)
                                             .iterencode(response)),
@@ -427,41 +481,53 @@ def api_downstream_chunk_contract_status(token):
     return handler.response
 
 
-def get_verification_reports(pair_iterator, beat, token_id):
-    for (db_contract, item) in pair_iterator:
-        if (db_contract is None or
-                db_contract.token_id != token_id):
-            r = dict(file_hash=item['file_hash'],
-                     error='contract not found')
-            yield r
-            continue
+def get_verification_reports(batch_iterator, beat, token_id):
+    """checks the proofs in each batch of contracts together with
+    verify_proofs() and yields a report for each of them, in the order
+    they were posted.  The heartbeat counts are only handed to app.hbcounts
+    once the answers have been committed.
+    """
+    hbcount = 0
+    for batch in batch_iterator:
+        reports = list()
+        pairs = list()
+        pending = list()
+        for (db_contract, item) in batch:
+            if (db_contract is None or
+                    db_contract.token_id != token_id):
+                reports.append(dict(file_hash=item['file_hash'],
+                                    error='contract not found'))
+                continue
 
-        r = dict(file_hash=db_contract.id)
+            r = dict(file_hash=db_contract.id)
+            reports.append(r)
 
-        try:
-            proof = beat.proof_type().fromdict(
-                item['proof'])
-        except:
-            r['error'] = 'Proof corrupted'
-            yield r
-            continue
+            try:
+                proof = beat.proof_type().fromdict(
+                    item['proof'])
+            except:
+                r['error'] = 'Proof corrupted'
+                continue
 
-        try:
-            if (not verify_proof(db_contract,
-                                 proof,
-                                 datetime.utcnow())):
+            pairs.append((db_contract, proof))
+            pending.append(r)
+
+        results = verify_proofs(pairs, datetime.utcnow())
+
+        for (r, result) in zip(pending, results):
+            if (isinstance(result, InvalidParameterError)):
+                r['error'] = str(result)
+            elif (not result):
                 r['error'] = 'Invalid proof'
-                yield r
-                continue
-        except InvalidParameterError as ex:
-            r['error'] = str(ex)
-            yield r
-            continue
+            else:
+                r['status'] = 'ok'
+                hbcount += 1
 
-        r['status'] = 'ok'
-        yield r
+        for r in reports:
+            yield r
 
     db.session.commit()
+    app.hbcounts.committed({token_id: hbcount} if hbcount > 0 else None)
 
 
 @app.route('/answer/<token>', methods=['POST'])
@@ -470,18 +536,20 @@ def api_downstream_challenge_answer(token):
         handler.context['token'] = token
         handler.context['remote_addr'] = request.remote_addr
 
-        db_token = Token.query.filter(Token.token == token).first()
+        assert_rate_limit('answer', request.remote_addr)
 
-        if (db_token is None):
+        token_info = resolve_token(token)
+
+        if (token_info is None):
             raise InvalidParameterError('Nonexistent token.')
 
-        process_token_ip_address(db_token, request.remote_addr)
+        process_token_ip_address(token_info, request.remote_addr)
 
         beat = app.heartbeat
 
         hash_iterable = ijson.items(request.stream, 'proofs.item')
 
-        pair_iterator = get_contract_iter(
+        batch_iterator = get_contract_batches(
             hash_iterable, key='file_hash')
 
         if (app.mongo_logger is not None):
@@ -490,7 +558,9 @@ def api_downstream_challenge_answer(token):
                                         'response': 'REDACTED (streaming)'})
 
         response = dict(
-            report=get_verification_reports(pair_iterator, beat, db_token.id))
+            report=get_verification_reports(batch_iterator,
+                                            beat,
+                                            token_info.id))
 
         return Response(stream_with_context(StreamEncoder(stream=True)
                                             .iterencode(response)),
@@ -508,16 +578,83 @@ def api_downstream_tag(key, hash):
         if (key != app.config['TAG_KEY']):
             raise InvalidParameterError('Invalid key')
 
-        tag_path = os.path.join(app.config['TAGS_PATH'], hash)
-        with open(tag_path, 'rb') as f:
-            binary_tag = f.read()
-
-        # delete the tag
+        # the tag is sent straight from its pack file, with sendfile() if
+        # the server supports it, and is removed from the store once it has
+        # been sent in full.  see TagReader for when that can be told.  a
+        # HEAD request sends nothing, so it leaves the tag in place.
         # this is obviously problematic because if the db does not delete
-        # the tag, then the tag wont be on file next time the db needs it
-        os.remove(tag_path)
+        # the tag, then the tag wont be in the store next time the db needs
+        # it
+        try:
+            reader = app.tag_store.open(hash,
+                                        consume=(request.method != 'HEAD'))
+        except KeyError:
+            raise NotFoundError('Tag not found.')
+
+        response = Response(wrap_file(request.environ, reader),
+                            mimetype='application/octet-stream',
+                            direct_passthrough=True)
+        response.content_length = reader.length
+        return response
+
+    return handler.response
+
+
+@app.route('/tag/<key>', methods=['POST'])
+def api_downstream_tags(key):
+    """Multi-get of tags, see node.get_tags().  Expects a JSON object with
+    the list of the hashes of the tags, and responds with the tags that were
+    found framed by tagcodec.pack_tags()"""
+    with HttpHandler(app.mongo_logger) as handler:
+        handler.context['remote_addr'] = request.remote_addr
+
+        if (key != app.config['TAG_KEY']):
+            raise InvalidParameterError('Invalid key')
+
+        try:
+            hashes = request.get_json(force=True)['hashes']
+        except:
+            raise InvalidParameterError('Request body must be a JSON object '
+                                        'with a list of hashes.')
+
+        if (not isinstance(hashes, list)):
+            raise InvalidParameterError('Request body must be a JSON object '
+                                        'with a list of hashes.')
+
+        if (len(hashes) > app.config['TAG_MULTI_GET_MAX']):
+            raise InvalidParameterError(
+                'At most {0} tags can be fetched at once.'
+                .format(app.config['TAG_MULTI_GET_MAX']))
+
+        handler.context['hashes'] = len(hashes)
+
+        # like the single tag route, tags are removed from the store as they
+        # are read
+        binary_tags = list()
+        for hash in hashes:
+            try:
+                binary_tags.append((hash, app.tag_store.pop(hash)))
+            except KeyError:
+                pass
+
+        return Response(pack_tags(binary_tags),
+                        mimetype='application/octet-stream')
+
+    return handler.response
+
+
+@app.route('/debug/caches')
+def api_downstream_debug_caches():
+    with HttpHandler(app.mongo_logger) as handler:
+        handler.context['remote_addr'] = request.remote_addr
+
+        if (not app.config['DEBUG']):
+            raise NotFoundError('Debugging is disabled.')
+
+        caches = dict((name, cache.stats())
+                      for (name, cache) in app.caches.items())
 
-        return make_response(binary_tag)
+        return jsonify(caches=caches)
 
     return handler.response
 
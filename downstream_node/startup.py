@@ -1,14 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import atexit
 import pickle
+import hashlib
 import requests
 
-from flask import Flask
+from collections import namedtuple
+from flask import Flask, json
 from flask.ext.sqlalchemy import SQLAlchemy
 
 from . import config
 from .log import mongolog
+from .geoip import GeoIPReader
+from .cache import LRUCache
+from .counters import CounterBuffer
+from .chunkpool import ChunkPoolNotifier
+from .workers import WorkerPool, init_proof_worker
+from .ratelimit import RateLimiter
+from .tagstore import TagStore
 
 app = Flask(__name__)
 app.config.from_object(config)
@@ -47,6 +57,27 @@ def load_heartbeat(constructor, path, check_fraction):
     return beat
 
 
+PublicHeartbeat = namedtuple('PublicHeartbeat',
+                             ['type', 'heartbeat', 'json', 'digest'])
+
+
+def load_public_heartbeat(beat):
+    """Precomputes the public part of the heartbeat that is sent to farmers
+    by /new and /heartbeat, since it only changes with the heartbeat itself.
+
+    :param beat: the node heartbeat
+    :returns: a PublicHeartbeat with the name of the heartbeat type, the
+        public heartbeat as a dictionary, its JSON encoding, and the hex
+        SHA-256 digest of the encoding
+    """
+    public = beat.get_public().todict()
+    encoded = json.dumps(public, sort_keys=True)
+    return PublicHeartbeat(type(beat).__name__,
+                           public,
+                           encoded,
+                           hashlib.sha256(encoded.encode('utf-8')).hexdigest())
+
+
 def load_logger(log, uri, server_alias):
     if (log):
         return mongolog(uri, server_alias)
@@ -58,10 +89,52 @@ app.heartbeat = load_heartbeat(
     app.config['HEARTBEAT_PATH'],
     app.config['HEARTBEAT_CHECK_FRACTION'])
 
+app.public_heartbeat = load_public_heartbeat(app.heartbeat)
+
 app.mongo_logger = load_logger(app.config['MONGO_LOGGING'],
                                app.config['MONGO_URI'],
                                app.config['SERVER_ALIAS'])
 
+app.geoip = GeoIPReader(app.config['MMDB_PATH'])
+
+app.signature_pool = WorkerPool(app.config['SIGNATURE_WORKERS'])
+
+app.chunk_notifier = ChunkPoolNotifier(
+    app.config['CHUNK_POOL_NOTIFY_ADDRESS'])
+
+app.tag_pool = WorkerPool(app.config['TAG_PREFETCH_THREADS'], threads=True)
+
+app.proof_pool = WorkerPool(app.config['PROOF_WORKERS'],
+                            init_proof_worker,
+                            (app.heartbeat,))
+
+# compaction is started by the serving process on its first request, see
+# routes.start_tag_compaction
+app.tag_store = TagStore(app.config['TAGS_PATH'],
+                         app.config['TAG_SEGMENT_SIZE'])
+
+app.rate_limiter = RateLimiter(app.config['RATE_LIMITS'],
+                               app.config['RATE_LIMIT_SHARED_PATH'],
+                               app.config['RATE_LIMIT_SLOTS'])
+
+# in process caches, by name.  their statistics are served by /debug/caches
+app.caches = dict(geoip=LRUCache(app.config['GEOIP_CACHE_SIZE'],
+                                 app.config['GEOIP_CACHE_TTL']),
+                  tokens=LRUCache(app.config['TOKEN_CACHE_SIZE'],
+                                  app.config['TOKEN_CACHE_TTL']),
+                  signatures=LRUCache(app.config['SIGNATURE_CACHE_SIZE']))
+
+
+from .whitelist import WhitelistIndex  # NOQA
+from .models import add_hbcounts  # NOQA
+
+app.whitelist = WhitelistIndex(app.config['WHITELIST_REFRESH_INTERVAL'])
+
+# heartbeat counts are written behind, and whatever is left is written
+# when the process exits
+app.hbcounts = CounterBuffer(add_hbcounts,
+                             app.config['HBCOUNT_FLUSH_INTERVAL'])
+atexit.register(app.hbcounts.close)
 
 from . import routes  # NOQA
 
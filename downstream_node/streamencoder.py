@@ -72,6 +72,22 @@ encode_basestring_ascii = (
     c_encode_basestring_ascii or py_encode_basestring_ascii)
 
 
+class RawJSON(object):
+
+    """JSON that is already encoded.  iterencode() splices it into its
+    output as is, without decoding or escaping it again."""
+
+    def __init__(self, encoded):
+        """Initialization method
+
+        :param encoded: the JSON encoding of a value, as a string
+        """
+        self.encoded = encoded
+
+    def __repr__(self):
+        return 'RawJSON({0!r})'.format(self.encoded)
+
+
 class JSONEncoder(object):
 
     """Extensible JSON <http://json.org> encoder for Python data structures.
@@ -444,6 +460,8 @@ def _make_iterencode(markers, _default, _encoder, _stream_encoder, _indent,
         elif isinstance(o, dict):
             for chunk in _iterencode_dict(o, _current_indent_level):
                 yield chunk
+        elif isinstance(o, RawJSON):
+            yield o.encoded
         elif stream and hasattr(o, 'read') and hasattr(o.read, '__call__'):
             yield '"'
             s = o.read(BUFSIZE)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import zlib
+import struct
+import pickle
+
+from .streamencoder import RawJSON
+
+try:
+    import lzma
+except ImportError:
+    # python 2
+    lzma = None
+
+# prefixes compressed tags.  a pickle never starts with a null byte, so tags
+# stored as plain pickles can still be told apart
+MAGIC = b'\x00TAG'
+# prefixes tags stored as their JSON encoding
+JSON_MAGIC = b'\x00TJS'
+
+CODECS = dict(zlib=1, lzma=2)
+
+
+def compress(data, compression, level=None):
+    """Compresses data with the named codec
+
+    :param data: the bytes to compress
+    :param compression: 'zlib' or 'lzma'
+    :param level: the compression level, or None for the codec default
+    """
+    if (compression == 'zlib'):
+        return zlib.compress(data, 6 if level is None else level)
+    if (compression == 'lzma'):
+        if (lzma is None):
+            raise ValueError('lzma is not available')
+        return lzma.compress(data, preset=level)
+    raise ValueError('Unknown tag compression {0}'.format(compression))
+
+
+def dump_tag(tag, compression=None, level=None):
+    """Serializes a tag for storage
+
+    :param tag: the heartbeat tag
+    :param compression: None to store the plain pickle, as before, or the
+        name of the codec to compress it with, 'zlib' or 'lzma'
+    :param level: the compression level, or None for the codec default
+    :returns: the binary tag
+    """
+    data = pickle.dumps(tag, pickle.HIGHEST_PROTOCOL)
+    if (compression is None):
+        return data
+    body = compress(data, compression, level)
+    return MAGIC + struct.pack('B', CODECS[compression]) + body
+
+
+def dump_tag_json(tag, compression=None, level=None):
+    """Serializes the JSON encoding of a tag for storage, as it is sent to
+    farmers, so that it can be spliced into responses as is
+
+    :param tag: the heartbeat tag
+    :param compression: None, or the name of the codec to compress the JSON
+        with, 'zlib' or 'lzma'
+    :param level: the compression level, or None for the codec default
+    :returns: the binary tag
+    """
+    data = json.dumps(tag.todict()).encode('utf-8')
+    if (compression is None):
+        return JSON_MAGIC + struct.pack('B', 0) + data
+    body = compress(data, compression, level)
+    return JSON_MAGIC + struct.pack('B', CODECS[compression]) + body
+
+
+def decompress(codec, body):
+    """Decompresses the body of a stored tag
+
+    :param codec: the codec id from the tag header, 0 if not compressed
+    :param body: the bytes following the header
+    """
+    if (codec == 0):
+        return body
+    if (codec == CODECS['zlib']):
+        return zlib.decompress(body)
+    if (codec == CODECS['lzma'] and lzma is not None):
+        return lzma.decompress(body)
+    raise ValueError('Unsupported tag codec {0}'.format(codec))
+
+
+def load_tag(data):
+    """Deserializes a tag stored by dump_tag() or dump_tag_json(),
+    compressed or not
+
+    :param data: the binary tag
+    :returns: the heartbeat tag, or a streamencoder.RawJSON of its JSON
+        encoding if it was stored by dump_tag_json()
+    """
+    magic = data[:len(MAGIC)]
+    if (magic == JSON_MAGIC):
+        (codec, ) = struct.unpack_from('B', data, len(JSON_MAGIC))
+        body = decompress(codec, data[len(JSON_MAGIC) + 1:])
+        return RawJSON(body.decode('utf-8'))
+    if (magic != MAGIC):
+        return pickle.loads(data)
+    (codec, ) = struct.unpack_from('B', data, len(MAGIC))
+    # compressed pickles always have a codec
+    if (codec == 0):
+        raise ValueError('Unsupported tag codec {0}'.format(codec))
+    return pickle.loads(decompress(codec, data[len(MAGIC) + 1:]))
+
+
+# frames tags in a multi-get response: the hex hash, then the length of the
+# binary tag that follows
+frame = struct.Struct('!64sI')
+
+
+def pack_tags(items):
+    """Frames binary tags for a multi-get response
+
+    :param items: an iterable of (hash, binary tag) tuples
+    :returns: the framed tags
+    """
+    return b''.join(frame.pack(hash.encode('ascii'), len(data)) + data
+                    for (hash, data) in items)
+
+
+def unpack_tags(data):
+    """Reads the binary tags framed by pack_tags()
+
+    :param data: the framed tags
+    :returns: a dictionary mapping hashes to binary tags
+    """
+    tags = dict()
+    offset = 0
+    while (offset < len(data)):
+        if (len(data) - offset < frame.size):
+            raise ValueError('Truncated tag frame')
+        (hash, length) = frame.unpack_from(data, offset)
+        offset += frame.size
+        if (len(data) - offset < length):
+            raise ValueError('Truncated tag frame')
+        tags[hash.decode('ascii')] = data[offset:offset + length]
+        offset += length
+    return tags
@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import re
+import fcntl
+import struct
+import hashlib
+import binascii
+import threading
+import traceback
+
+from contextlib import contextmanager
+
+
+class TagReader(object):
+
+    """A file like view of one tag in its segment, for sending a tag with
+    wsgi.file_wrapper without reading it into memory.  fileno() lets the
+    server send it with sendfile(), and read() never reads past the end of
+    the tag.  Like fileno(), seek() and tell() work with offsets into the
+    segment file, so the reader starts positioned at the tag's offset.
+
+    When consumed, the tag is deleted from the store once the reader is
+    closed, but only if it was sent in full, which is told from the
+    position the reader was left at: either read to the end, or sent with
+    socket.sendfile(), which seeks the reader to the end of what it sent.
+    A reader closed before the whole tag was sent, or sent by a server that
+    does not report back how much it sent, leaves the tag in the store.
+    """
+
+    def __init__(self, store, hash, f, length, consume=False):
+        self.store = store
+        self.hash = hash
+        self.length = length
+        self.consume = consume
+        self._file = f
+        self._end = f.tell() + length
+        self._closed = False
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if (whence == os.SEEK_CUR):
+            offset += self._file.tell()
+        elif (whence == os.SEEK_END):
+            offset += self._end
+        return self._file.seek(offset)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        remaining = max(0, self._end - self._file.tell())
+        if (size is None or size < 0 or size > remaining):
+            size = remaining
+        return self._file.read(size)
+
+    def close(self):
+        if (self._closed):
+            return
+        self._closed = True
+        sent = self._file.tell() >= self._end
+        self._file.close()
+        if (self.consume and sent):
+            self.store.delete([self.hash])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class TagStore(object):
+
+    """An append only store of tags, keyed by the hex SHA-256 digest of the
+    tag.
+
+    Tags are appended to pack files, called segments, which are sealed once
+    they reach segment_size bytes.  Where each tag is stored is recorded in
+    an index log of fixed size records, one per put, and a tombstone record
+    is appended when a tag is consumed or deleted.  The log is replayed into
+    an in memory dictionary, and records appended by other processes are
+    picked up on the next operation.
+
+    Consumed tags leave dead bytes behind in their segments.  compact()
+    moves the live tags out of sealed segments that are mostly dead,
+    rewrites the index log with only the live tags and then removes those
+    segments.
+
+    Writes are serialized across processes with an exclusive lock on a lock
+    file in the store directory, and reads take a shared lock.
+    """
+
+    record = struct.Struct('<B32sIQI')
+    PUT = 1
+    TOMBSTONE = 2
+
+    segment_pattern = re.compile(r'^segment-([0-9]{8})\.pack$')
+    legacy_pattern = re.compile('^[0-9a-f]{64}$')
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024):
+        """Initialization method.  Nothing is read or created until the
+        store is first used.
+
+        :param path: the directory of the store
+        :param segment_size: the size in bytes beyond which a segment is
+            sealed and a new one started
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._lock_file = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._readers = dict()
+        self._reset()
+
+    def _reset(self):
+        # digest -> (segment, offset, length)
+        self._index = dict()
+        # segment -> number of live bytes
+        self._live = dict()
+        self._index_id = None
+        self._index_pos = 0
+        self._close_readers()
+
+    def _close_readers(self):
+        for f in self._readers.values():
+            f.close()
+        self._readers = dict()
+
+    def _index_path(self):
+        return os.path.join(self.path, 'index.log')
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, 'segment-{0:08d}.pack'.format(segment))
+
+    def _segments(self):
+        segments = list()
+        for name in os.listdir(self.path):
+            match = self.segment_pattern.match(name)
+            if (match is not None):
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def _open(self):
+        # the lock file and readers are per process, so they are reopened
+        # in processes forked after the store was used
+        if (self._pid == os.getpid()):
+            return
+        if (not os.path.isdir(self.path)):
+            os.makedirs(self.path)
+        self._lock_file = open(os.path.join(self.path, 'lock'), 'a')
+        self._reset()
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self, exclusive):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._lock_file,
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self._sync()
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _sync(self):
+        # applies the records appended to the index log since it was last
+        # read.  if the log was replaced by compaction, it is read afresh
+        path = self._index_path()
+        try:
+            st = os.stat(path)
+        except OSError:
+            if (self._index_id is not None):
+                self._reset()
+            return
+        if ((st.st_dev, st.st_ino) != self._index_id or
+                st.st_size < self._index_pos):
+            self._reset()
+            self._index_id = (st.st_dev, st.st_ino)
+        if (st.st_size - self._index_pos < self.record.size):
+            return
+        with open(path, 'rb') as f:
+            f.seek(self._index_pos)
+            data = f.read(st.st_size - self._index_pos)
+        count = len(data) // self.record.size
+        for i in range(0, count):
+            self._apply(*self.record.unpack_from(data, i * self.record.size))
+        self._index_pos += count * self.record.size
+
+    def _apply(self, op, digest, segment, offset, length):
+        old = self._index.pop(digest, None)
+        if (old is not None):
+            self._live[old[0]] -= old[2]
+        if (op == self.PUT):
+            self._index[digest] = (segment, offset, length)
+            self._live[segment] = self._live.get(segment, 0) + length
+
+    def _write_records(self, records):
+        # must hold the exclusive lock
+        data = b''.join(self.record.pack(*r) for r in records)
+        with open(self._index_path(), 'ab') as f:
+            st = os.fstat(f.fileno())
+            if (self._index_id is None):
+                self._index_id = (st.st_dev, st.st_ino)
+            if (st.st_size > self._index_pos):
+                # a partial record left behind by a crashed writer
+                f.truncate(self._index_pos)
+            f.write(data)
+        for r in records:
+            self._apply(*r)
+        self._index_pos += len(data)
+
+    def _append(self, data):
+        # must hold the exclusive lock
+        segments = self._segments()
+        segment = segments[-1] if len(segments) > 0 else 1
+        path = self._segment_path(segment)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if (size > 0 and size + len(data) > self.segment_size):
+            segment += 1
+            path = self._segment_path(segment)
+        with open(path, 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+        return (segment, offset)
+
+    def _read(self, segment, offset, length):
+        f = self._readers.get(segment)
+        if (f is None):
+            f = open(self._segment_path(segment), 'rb')
+            self._readers[segment] = f
+        f.seek(offset)
+        data = f.read(length)
+        if (len(data) != length):
+            raise IOError('Tag truncated in segment {0}'.format(segment))
+        return data
+
+    @staticmethod
+    def _digest(hash):
+        try:
+            digest = binascii.unhexlify(hash)
+        except (TypeError, ValueError):
+            raise KeyError(hash)
+        if (len(digest) != 32):
+            raise KeyError(hash)
+        return digest
+
+    def __contains__(self, hash):
+        try:
+            digest = self._digest(hash)
+        except KeyError:
+            return False
+        with self._locked(False):
+            return digest in self._index
+
+    def __len__(self):
+        with self._locked(False):
+            return len(self._index)
+
+    def put(self, data):
+        """Stores a tag.  Storing a tag that is already stored does nothing.
+
+        :param data: the binary tag
+        :returns: the hex SHA-256 digest of the tag, its key in the store
+        """
+        digest = hashlib.sha256(data).digest()
+        with self._locked(True):
+            if (digest not in self._index):
+                (segment, offset) = self._append(data)
+                self._write_records(
+                    [(self.PUT, digest, segment, offset, len(data))])
+        return binascii.hexlify(digest).decode('ascii')
+
+    def get(self, hash):
+        """Reads a tag
+
+        :param hash: the hex digest of the tag
+        :returns: the binary tag
+        :raises KeyError: if the tag is not stored
+        """
+        digest = self._digest(hash)
+        with self._locked(False):
+            return self._read(*self._index[digest])
+
+    def open(self, hash, consume=False):
+        """Opens a tag for reading, without reading it into memory
+
+        :param hash: the hex digest of the tag
+        :param consume: whether to delete the tag once it has been sent, see
+            TagReader
+        :returns: a TagReader positioned at the start of the tag
+        :raises KeyError: if the tag is not stored
+        """
+        digest = self._digest(hash)
+        with self._locked(False):
+            (segment, offset, length) = self._index[digest]
+            # a new file, since the reader is handed over to the server.  it
+            # stays readable even if compaction removes the segment
+            f = open(self._segment_path(segment), 'rb')
+        f.seek(offset)
+        return TagReader(self, hash, f, length, consume)
+
+    def pop(self, hash):
+        """Reads a tag and tombstones it, so that it is only handed out once
+
+        :param hash: the hex digest of the tag
+        :returns: the binary tag
+        :raises KeyError: if the tag is not stored
+        """
+        digest = self._digest(hash)
+        with self._locked(True):
+            (segment, offset, length) = self._index[digest]
+            data = self._read(segment, offset, length)
+            self._write_records(
+                [(self.TOMBSTONE, digest, segment, offset, length)])
+            return data
+
+    def delete(self, hashes):
+        """Tombstones tags
+
+        :param hashes: a list of the hex digests of the tags to delete
+        :returns: the number of tags that were deleted
+        """
+        digests = list()
+        for hash in hashes:
+            try:
+                digests.append(self._digest(hash))
+            except KeyError:
+                pass
+        with self._locked(True):
+            records = list()
+            for digest in set(digests):
+                location = self._index.get(digest)
+                if (location is not None):
+                    records.append((self.TOMBSTONE, digest) + location)
+            if (len(records) > 0):
+                self._write_records(records)
+            return len(records)
+
+    def compact(self, threshold=0.5, batch_size=4 * 1024 * 1024):
+        """Moves the live tags out of the sealed segments in which less than
+        threshold of the bytes are live, rewrites the index log with only
+        the live tags and removes those segments.
+
+        The tags are moved in batches of about batch_size bytes, each
+        recorded in the index log like any other put, and the lock is
+        released between batches so that other operations are not held up
+        for the whole compaction.  Only the index swap at the end holds the
+        lock for longer than a batch.
+
+        :param threshold: the fraction of live bytes below which a segment
+            is compacted
+        :param batch_size: the number of bytes to move while holding the
+            lock
+        :returns: the number of segments removed
+        """
+        with self._locked(False):
+            segments = self._segments()
+            victims = set()
+            for segment in segments[:-1]:
+                size = os.path.getsize(self._segment_path(segment))
+                if (self._live.get(segment, 0) < threshold * size):
+                    victims.add(segment)
+            pending = [digest for (digest, location) in self._index.items()
+                       if location[0] in victims]
+        if (len(victims) == 0):
+            return 0
+
+        while (len(pending) > 0):
+            self._move_batch(victims, pending, batch_size)
+
+        with self._locked(True):
+            # only segments that nothing points into any more are removed
+            for location in self._index.values():
+                victims.discard(location[0])
+            if (len(victims) == 0):
+                return 0
+
+            # write the live tags to a new index log and swap it in, so
+            # that other processes reread it
+            tmp_path = self._index_path() + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for (digest, location) in self._index.items():
+                    f.write(self.record.pack(self.PUT, digest, *location))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._index_path())
+
+            self._reset()
+            self._sync()
+            removed = 0
+            for segment in victims:
+                try:
+                    os.remove(self._segment_path(segment))
+                    removed += 1
+                except OSError:
+                    # removed by a compaction in another process
+                    pass
+            return removed
+
+    def _move_batch(self, victims, pending, batch_size):
+        # moves up to about batch_size bytes of the pending tags out of the
+        # victim segments, removing them from pending
+        with self._locked(True):
+            records = list()
+            written = set()
+            moved = 0
+            while (len(pending) > 0 and moved < batch_size):
+                digest = pending.pop()
+                # it may have been consumed since
+                location = self._index.get(digest)
+                if (location is None or location[0] not in victims):
+                    continue
+                data = self._read(*location)
+                (segment, offset) = self._append(data)
+                written.add(segment)
+                records.append((self.PUT, digest, segment, offset,
+                                location[2]))
+                moved += location[2]
+            if (len(records) == 0):
+                return
+            # the moved tags must be on disk before the index points at them
+            for segment in written:
+                with open(self._segment_path(segment), 'ab') as f:
+                    os.fsync(f.fileno())
+            self._write_records(records)
+
+    def start_compaction(self, interval, threshold=0.5):
+        """Starts compacting the store every interval seconds from a
+        background thread.  Does nothing if it is already running, so it is
+        cheap to call on every request.
+
+        :param interval: the number of seconds between compactions
+        :param threshold: see compact()
+        """
+        if (self._thread is not None):
+            return
+        with self._lock:
+            if (self._thread is not None):
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            args=(interval, threshold))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self, interval, threshold):
+        while (not self._stop.wait(interval)):
+            try:
+                self.compact(threshold)
+            except:
+                traceback.print_exc()
+
+    def import_files(self, directory, remove=True):
+        """Imports tags stored one per file, named by their hex SHA-256
+        digest, as they were before the store.  Files whose name does not
+        match their contents are left alone.
+
+        :param directory: the directory the tag files are in
+        :param remove: whether to remove the files once imported
+        :returns: the number of tags imported
+        """
+        count = 0
+        for name in os.listdir(directory):
+            if (self.legacy_pattern.match(name) is None):
+                continue
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if (self.put(data) != name):
+                continue
+            if (remove):
+                os.remove(path)
+            count += 1
+        return count
+
+    def close(self):
+        """Stops the background compaction and closes open files"""
+        self._stop.set()
+        if (self._thread is not None):
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._close_readers()
+            if (self._lock_file is not None):
+                self._lock_file.close()
+            self._lock_file = None
+            self._pid = None
@@ -179,3 +179,69 @@ class MonopolyDistribution(Distribution):
         :returns: the distribution of missing items
         """
         return self.subtract(Distribution(from_list=other_list))
+
+
+def plan_chunk_reservation(inventory, size, max_count=0):
+    """Picks the chunks to hand out to fill size from the pool, greedily,
+    largest chunks first.
+
+    :param inventory: a dictionary mapping chunk sizes to the number of
+        available chunks of that size
+    :param size: the total size to fill
+    :param max_count: the maximum number of chunks to pick.  0 for no limit
+    :returns: a dictionary mapping chunk sizes to the number of chunks of
+        that size to take
+    """
+    plan = dict()
+    remaining = size
+    count = 0
+    for chunk_size in sorted(inventory.keys(), reverse=True):
+        if (chunk_size <= 0):
+            continue
+        n = min(inventory[chunk_size], remaining // chunk_size)
+        if (max_count > 0):
+            n = min(n, max_count - count)
+        if (n > 0):
+            plan[chunk_size] = n
+            remaining -= n * chunk_size
+            count += n
+    return plan
+
+
+class BoundedReadStream(object):
+
+    """Wraps a seekable stream so that no single sized read returns more
+    than buffer_size bytes, which bounds the memory used by a consumer that
+    reads the stream in large pieces, such as a heartbeat encoding a large
+    chunk.
+
+    Sized reads may therefore be short, so this should only be given to
+    consumers that keep reading until they have what they need.  A read
+    with no size still reads the rest of the stream.
+    """
+
+    def __init__(self, stream, buffer_size=65536):
+        """Initialization method
+
+        :param stream: the stream to wrap.  should support `read()`,
+            `seek()` and `tell()`
+        :param buffer_size: the maximum number of bytes returned by a read
+        """
+        self.stream = stream
+        self.buffer_size = buffer_size
+
+    def read(self, size=-1):
+        """Reads at most min(size, buffer_size) bytes from the stream
+
+        :param size: the number of bytes wanted.  if None or negative, reads
+            the rest of the stream
+        """
+        if (size is None or size < 0):
+            return self.stream.read()
+        return self.stream.read(min(size, self.buffer_size))
+
+    def seek(self, offset, whence=0):
+        return self.stream.seek(offset, whence)
+
+    def tell(self):
+        return self.stream.tell()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+from sqlalchemy.sql import select
+
+from .startup import db, app
+from .models import Address, WhitelistVersion
+
+
+def get_whitelist_version():
+    """Gets the current whitelist version from the database
+
+    :returns: the whitelist version, 0 if it has never been set
+    """
+    versions = WhitelistVersion.__table__
+    version = db.engine.execute(
+        select([versions.c.version]).where(versions.c.id == 1)).scalar()
+
+    if (version is None):
+        return 0
+
+    return version
+
+
+def bump_whitelist_version():
+    """Increments the whitelist version in the database.  This must be called
+    after the addresses table is modified so that running nodes reload their
+    in memory whitelist.
+    """
+    versions = WhitelistVersion.__table__
+    result = db.engine.execute(
+        versions.update().where(versions.c.id == 1).
+        values(version=versions.c.version + 1))
+
+    if (result.rowcount == 0):
+        db.engine.execute(versions.insert().values(id=1, version=1))
+
+
+class WhitelistIndex(object):
+
+    """An in memory snapshot of the addresses that are eligible for tokens,
+    i.e. the addresses in the addresses table with at least the
+    MIN_SJCX_BALANCE.
+
+    The snapshot is loaded on first use, and whenever the whitelist version
+    in the database has changed, which is checked at most once every
+    refresh_interval seconds.  A new snapshot is swapped in atomically, so
+    lookups never see a partially loaded whitelist.
+    """
+
+    def __init__(self, refresh_interval=10):
+        """Initialization method
+
+        :param refresh_interval: the minimum number of seconds between checks
+            of the whitelist version.  if None, the snapshot is only loaded
+            once
+        """
+        self.refresh_interval = refresh_interval
+        self._addresses = None
+        self._version = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Loads a new snapshot of the whitelist from the database"""
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        version = get_whitelist_version()
+        addresses = Address.__table__
+        rows = db.engine.execute(
+            select([addresses.c.address]).
+            where(addresses.c.crowdsale_balance >=
+                  app.config['MIN_SJCX_BALANCE'])).fetchall()
+        self._addresses = frozenset(r[0] for r in rows)
+        self._version = version
+        self._checked = time.time()
+
+    def _refresh(self):
+        if (self._addresses is not None and
+                (self.refresh_interval is None or
+                 time.time() - self._checked < self.refresh_interval)):
+            return
+
+        with self._lock:
+            # another thread may have refreshed while we were waiting
+            if (self._addresses is None):
+                self._load()
+            elif (self.refresh_interval is not None and
+                    time.time() - self._checked >= self.refresh_interval):
+                if (get_whitelist_version() != self._version):
+                    self._load()
+                else:
+                    self._checked = time.time()
+
+    def __contains__(self, address):
+        self._refresh()
+        return address in self._addresses
+
+    def __len__(self):
+        self._refresh()
+        return len(self._addresses)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import multiprocessing
+import multiprocessing.pool
+
+# the heartbeat used by verify_proof_task(), set in each proof verification
+# worker process by init_proof_worker()
+_heartbeat = None
+
+
+def init_proof_worker(beat):
+    """Initializer for proof verification worker processes
+
+    :param beat: the node heartbeat
+    """
+    global _heartbeat
+    _heartbeat = beat
+
+
+def verify_proof_task(args, beat=None):
+    """Checks a heartbeat proof.  Any error raised while checking it counts
+    as an invalid proof, so that one bad proof does not fail its batch.
+
+    :param args: a (proof, challenge, state) tuple
+    :param beat: the heartbeat to check with.  defaults to the one set by
+        init_proof_worker()
+    :returns: True if the proof is valid, False otherwise
+    """
+    if (beat is None):
+        beat = _heartbeat
+    (proof, challenge, state) = args
+    try:
+        return bool(beat.verify(proof, challenge, state))
+    except Exception:
+        return False
+
+
+class InlineResult(object):
+
+    """The result of a call run inline by WorkerPool.apply_async(), with the
+    same get() as the results of a multiprocessing pool"""
+
+    def __init__(self, func, args):
+        try:
+            self._value = func(*args)
+            self._error = None
+        except Exception as ex:
+            self._error = ex
+
+    def get(self, timeout=None):
+        if (self._error is not None):
+            raise self._error
+        return self._value
+
+
+class WorkerPool(object):
+
+    """A lazily started pool of worker processes for CPU bound work, such as
+    signature and proof verification, that would otherwise hold the GIL and
+    stall every other thread in the server.  With threads=True, the pool uses
+    threads instead, for I/O bound work.
+
+    If the pool is configured with no processes, work is run inline in the
+    calling thread.
+    """
+
+    def __init__(self, processes=0, initializer=None, initargs=(),
+                 threads=False):
+        """Initialization method
+
+        :param processes: the number of worker processes.  if 0, work is run
+            inline
+        :param initializer: optional function called in each worker process
+            when it starts
+        :param initargs: arguments for the initializer
+        :param threads: whether to use worker threads instead of processes
+        """
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.threads = threads
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if (self._pool is None):
+                if (self.threads):
+                    pool_type = multiprocessing.pool.ThreadPool
+                else:
+                    pool_type = multiprocessing.Pool
+                self._pool = pool_type(self.processes,
+                                       self.initializer,
+                                       self.initargs)
+            return self._pool
+
+    def apply(self, func, args=(), timeout=None):
+        """Calls func with args in a worker process and waits for the result
+
+        :param func: a picklable, module level function
+        :param args: the arguments to pass to func
+        :param timeout: maximum number of seconds to wait for the result.
+            raises multiprocessing.TimeoutError if it is exceeded
+        :returns: the result of the call
+        """
+        if (self.processes == 0):
+            return func(*args)
+        return self._get_pool().apply_async(func, args).get(timeout)
+
+    def apply_async(self, func, args=()):
+        """Starts calling func with args in a worker without waiting for the
+        result
+
+        :param func: a picklable, module level function
+        :param args: the arguments to pass to func
+        :returns: a result whose get(timeout) method waits for the result of
+            the call and returns it, or raises the error it raised
+        """
+        if (self.processes == 0):
+            return InlineResult(func, args)
+        return self._get_pool().apply_async(func, args)
+
+    def map(self, func, iterable, timeout=None):
+        """Calls func on each item of iterable in the worker processes and
+        returns a list of the results, in order.
+
+        :param func: a picklable, module level function
+        :param iterable: the items to pass to func
+        :param timeout: maximum number of seconds to wait for all the results.
+            raises multiprocessing.TimeoutError if it is exceeded
+        :returns: a list of results
+        """
+        if (self.processes == 0):
+            return [func(i) for i in iterable]
+        return self._get_pool().map_async(func, iterable).get(timeout)
+
+    def close(self):
+        """Stops the worker processes.  They will be restarted if the pool
+        is used again."""
+        with self._lock:
+            if (self._pool is not None):
+                self._pool.terminate()
+                self._pool.join()
+            self._pool = None
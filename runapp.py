@@ -5,9 +5,11 @@
 # Not for production use.
 
 import os
+import sys
 import argparse
 import csv
 import time
+import signal
 import base58
 import traceback
 from flask import Flask, jsonify
@@ -19,7 +21,10 @@ from sqlalchemy import select, engine, update, insert, bindparam, true, func, an
 from downstream_node.startup import app, db
 from downstream_node.models import Contract, Address, Token, File, Chunk, update_uptime_summary
 from downstream_node import node
-from downstream_node.utils import MonopolyDistribution, Distribution
+from downstream_node.whitelist import bump_whitelist_version
+from downstream_node.workers import WorkerPool
+from downstream_node.chunkpool import ChunkPoolMaintainer
+from downstream_node.utils import MonopolyDistribution
 
 def initdb():   
     db.create_all()
@@ -29,10 +34,15 @@ def cleandb():
     # update uptime summary
     update_uptime_summary()
 
-    # delete expired contracts and files
-    s = Contract.__table__.delete().where(Contract.cached == true())
-    
-    db.engine.execute(s)
+    # delete expired contracts, and release their sizes from the addresses
+    # holding them
+    contracts = Contract.__table__
+    ids = [id for (id, ) in db.session.execute(
+        select([contracts.c.id]).where(contracts.c.cached == true()))]
+    if (len(ids) > 0):
+        node.release_allocated_bytes(contracts.c.id.in_(ids))
+        db.session.execute(contracts.delete().where(contracts.c.id.in_(ids)))
+    db.session.commit()
     
     # and delete unreferenced files
     s = File.__table__.delete().where(~File.__table__.c.id.in_(select([Contract.__table__.c.file_id])
@@ -41,40 +51,57 @@ def cleandb():
     
     db.engine.execute(s)
 
-def get_available_sizes():
-    available_sizes_stmt = select([File.__table__.c.size]).select_from(Chunk.__table__.join(File.__table__))
-    available_sizes_result = db.engine.execute(available_sizes_stmt).fetchall()
-    available_sizes = [a[0] for a in available_sizes_result]
-    return available_sizes
-    
-def maintain_capacity(min_chunk_size, max_chunk_size, size, base):
+    # and return chunks claimed by failed requests to the pool
+    node.release_stale_claims(app.config['CHUNK_CLAIM_TIMEOUT'])
+
+def exit_on_sigterm(signum, frame):
+    # the default action for SIGTERM kills the server without running the
+    # atexit handlers, which write the buffered heartbeat counts
+    sys.exit(128 + signum)
+
+def maintain_capacity(min_chunk_size, max_chunk_size, size, base, pool):
     # maintains a certain size of available chunks
+    try:
+        dist = MonopolyDistribution(min_chunk_size, max_chunk_size, size, base)
+    except:
+        print('No chunk sizes in that range will be created.')
+        sys.exit(1)
+    # print('Desired distribution: {0}'.format(dist))
+    maintainer = ChunkPoolMaintainer(dist.get_counts(),
+                                     app.config['CHUNK_POOL_LOW_WATER'],
+                                     app.config['CHUNK_POOL_NOTIFY_ADDRESS'],
+                                     app.config['CHUNK_POOL_RESYNC_INTERVAL'])
     while(1):
-        available_sizes = get_available_sizes()
-        available_dist = Distribution(from_list=available_sizes)
-        # print('Sizes already available: {0}'.format(available_dist))
-        # print('Total size available: {0}'.format(available_dist.get_total()))
-        try:
-            dist = MonopolyDistribution(min_chunk_size, max_chunk_size, size, base)
-        except:
-            print('No chunk sizes in that range will be created.')
-            sys.exit(1)
-        # print('Desired distribution: {0}'.format(dist))
-        missing = dist.subtract(available_dist)
-        # print('Missing: {0}'.format(missing))
-        missing_list = missing.get_alternating_list()
+        if (maintainer.needs_resync()):
+            maintainer.resync(node.get_chunk_inventory())
+        missing_list = maintainer.deficits()
         if (len(missing_list) > 0):
             print('Generating chunks: {0}'.format(missing_list))
-        for chunk_size in missing_list:
-            generate_chunks(chunk_size)
-        if (len(missing_list) > 0):
+            generate_chunks(missing_list, pool)
+            maintainer.generated(missing_list)
             print('Done.')
-        time.sleep(2)
+        else:
+            # sleep until chunks are taken or the pool is due to be recounted
+            maintainer.wait()
     
-def generate_chunks(size, number=1):
-    # generates a test chunk
-    for i in range(0,number):
-        node.generate_test_file(size)
+def precompute_challenges(lookahead, batch):
+    # keeps the next challenge of contracts that are coming due generated
+    while(1):
+        count = node.precompute_challenges(lookahead, batch)
+        if (count < batch):
+            time.sleep(2)
+
+def generate_chunks(sizes, pool):
+    # generates test chunks in the worker pool and reports the throughput
+    start = time.time()
+    count = node.generate_test_files(sizes, pool)
+    elapsed = max(time.time() - start, 1e-6)
+    print('Generated {0} chunks ({1:.1f} MB) in {2:.1f} s: {3:.2f} chunks/s, '
+          '{4:.2f} MB/s'.format(count,
+                                sum(sizes) / 1e6,
+                                elapsed,
+                                count / elapsed,
+                                sum(sizes) / 1e6 / elapsed))
 
 def clear_chunks():
     tag_stmt = select([Chunk.__table__.c.tag_path])
@@ -86,11 +113,10 @@ def clear_chunks():
     db.engine.execute(s)
     
     # now delete tags
-    for (path, ) in tags:
-        try:
-            os.remove(path)
-        except:
-            print('Failed to delete {0} (it was probably already deleted)'.format(path))
+    deleted = app.tag_store.delete([hash for (hash, ) in tags])
+    if (deleted < len(tags)):
+        print('Failed to delete {0} tags (they were probably already deleted)'.format(len(tags) - deleted))
+    app.tag_store.compact(app.config['TAG_COMPACT_THRESHOLD'])
     
     cleandb()
 
@@ -117,6 +143,7 @@ def updatewhitelist(arg):
             db.engine.execute(Address.__table__.insert().\
                 values(address=arg,
                        crowdsale_balance=bal))
+        bump_whitelist_version()
         return
     with open(arg,'r') as f:
         r = csv.reader(f)
@@ -149,6 +176,9 @@ def updatewhitelist(arg):
                         where(Token.id == t.id))
                 db.engine.execute(Address.__table__.delete().\
                     where(Address.id == row.id))
+        # tokens may have been deleted above
+        node.rebuild_ip_token_counts()
+        bump_whitelist_version()
 
 
 def eval_args(args):
@@ -158,21 +188,42 @@ def eval_args(args):
         cleandb()
     elif args.clearchunks:
         clear_chunks()
+    elif args.repair_ip_counts:
+        node.rebuild_ip_token_counts()
+    elif args.reconcile_allocated_bytes:
+        count = node.reconcile_allocated_bytes()
+        print('Corrected the allocated bytes of {0} addresses'.format(count))
+    elif args.import_tags:
+        count = app.tag_store.import_files(app.config['TAGS_PATH'])
+        print('Imported {0} tags into the tag store'.format(count))
+    elif args.compact_tags:
+        count = app.tag_store.compact(app.config['TAG_COMPACT_THRESHOLD'])
+        print('Removed {0} tag pack files'.format(count))
+    elif args.precompute:
+        print('Precomputing challenges due within {0} seconds'.format(
+            app.config['CHALLENGE_PRECOMPUTE_LOOKAHEAD']))
+        precompute_challenges(app.config['CHALLENGE_PRECOMPUTE_LOOKAHEAD'],
+                              app.config['CHALLENGE_PRECOMPUTE_BATCH'])
     elif (args.whitelist is not None):
         updatewhitelist(args.whitelist)
     elif (args.generate_chunk is not None):
-        generate_chunks(args.generate_chunk)
+        pool = WorkerPool(args.workers)
+        generate_chunks([args.generate_chunk] * args.count, pool)
+        pool.close()
     elif (args.maintain is not None):
         print('Maintaining total size: {0}, min chunk size: {1}, max chunk size: {2}'.format(
             args.maintain[2],
             args.maintain[0],
             args.maintain[1]))
-        maintain_capacity(int(args.maintain[0]), int(args.maintain[1]), int(args.maintain[2]), int(args.maintain[3]))
+        pool = WorkerPool(args.workers)
+        maintain_capacity(int(args.maintain[0]), int(args.maintain[1]), int(args.maintain[2]), int(args.maintain[3]), pool)
     else:
         debug_root = Flask(__name__)
         debug_root.debug = True
         debug_root.add_url_rule('/','index',lambda: jsonify(msg='debugging'))
         prefixed_app = DispatcherMiddleware(debug_root, {app.config['APPLICATION_ROOT']:app})
+        app.whitelist.load()
+        signal.signal(signal.SIGTERM, exit_on_sigterm)
         run_simple('localhost', 5000, prefixed_app, use_reloader=True, threaded=True)
 
 
@@ -193,8 +244,31 @@ def parse_args():
     parser.add_argument('--maintain', help='Maintain available chunk capacity'
         'Specify three values (min chunk size, max chunk size, total pre-gen '
         'size)', nargs=4)
+    parser.add_argument('--count', help='Number of chunks to generate with '
+                        '--generate-chunk', type=int, default=1)
+    parser.add_argument('--workers', help='Number of worker processes used '
+                        'to encode chunks for --generate-chunk and --maintain.'
+                        '  If 0, chunks are encoded in this process',
+                        type=int, default=app.config['GENERATION_WORKERS'])
     parser.add_argument('--clearchunks', help='Removes all chunks from '
                         ' the database', action='store_true')
+    parser.add_argument('--repair-ip-counts', help='Rebuilds the per IP '
+                        'address token counts from the tokens table',
+                        action='store_true')
+    parser.add_argument('--reconcile-allocated-bytes', help='Recounts the '
+                        'bytes allocated to each address from its contracts '
+                        'and corrects any that have drifted',
+                        action='store_true')
+    parser.add_argument('--import-tags', help='Moves tags stored one per '
+                        'file in TAGS_PATH into the tag store',
+                        action='store_true')
+    parser.add_argument('--compact-tags', help='Reclaims the space of the '
+                        'tags that were handed out from the tag store',
+                        action='store_true')
+    parser.add_argument('--precompute', help='Continuously generates the '
+                        'next challenge for contracts whose current '
+                        'challenge is about to come due, so that /challenge '
+                        'only has to swap it in', action='store_true')
     return parser.parse_args()
 
 
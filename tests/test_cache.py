@@ -0,0 +1,69 @@
+import unittest
+
+from mock import patch
+
+from downstream_node.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 'default'), 'default')
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        # touch a so that b is the least recently used
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_expire(self):
+        cache = LRUCache(2, ttl=10)
+        with patch('downstream_node.cache.time.time') as p:
+            p.return_value = 100
+            cache.put('a', 1)
+            p.return_value = 109
+            self.assertEqual(cache.get('a'), 1)
+            p.return_value = 110
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.invalidate('a')
+        cache.invalidate('nonexistent')
+        self.assertIsNone(cache.get('a'))
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_stats(self):
+        cache = LRUCache(1, ttl=5)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.put('b', 2)
+        stats = cache.stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['maxsize'], 1)
+        self.assertEqual(stats['ttl'], 5)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
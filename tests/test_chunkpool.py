@@ -0,0 +1,98 @@
+import time
+import unittest
+
+from downstream_node.chunkpool import ChunkPoolNotifier, ChunkPoolMaintainer
+
+
+class TestChunkPoolMaintainer(unittest.TestCase):
+
+    def setUp(self):
+        self.maintainer = ChunkPoolMaintainer({10: 4, 100: 2}, 0.5)
+
+    def test_needs_resync(self):
+        self.assertTrue(self.maintainer.needs_resync())
+        self.maintainer.resync(dict())
+        self.assertFalse(self.maintainer.needs_resync())
+        self.maintainer.resync_interval = 0
+        self.assertTrue(self.maintainer.needs_resync())
+
+    def test_deficits_empty(self):
+        self.maintainer.resync(dict())
+        self.assertEqual(sorted(self.maintainer.deficits()),
+                         [10, 10, 10, 10, 100, 100])
+
+    def test_deficits_low_water(self):
+        self.maintainer.resync({10: 2, 100: 2})
+        self.assertEqual(self.maintainer.deficits(), [])
+        self.maintainer.consumed({10: 1})
+        self.assertEqual(self.maintainer.deficits(), [10, 10, 10])
+
+    def test_generated(self):
+        self.maintainer.resync({10: 1, 100: 2})
+        self.maintainer.generated(self.maintainer.deficits())
+        self.assertEqual(self.maintainer.counts, {10: 4, 100: 2})
+        self.assertEqual(self.maintainer.deficits(), [])
+
+    def test_consumed_not_negative(self):
+        self.maintainer.resync({10: 1})
+        self.maintainer.consumed({10: 3, 1000: 1})
+        self.assertEqual(self.maintainer.counts[10], 0)
+        self.assertEqual(self.maintainer.counts[1000], 0)
+
+    def test_wait_without_socket(self):
+        self.maintainer.resync(dict())
+        self.assertFalse(self.maintainer.wait(0.01))
+
+
+class TestChunkPoolNotifications(unittest.TestCase):
+
+    def setUp(self):
+        self.maintainer = ChunkPoolMaintainer({10: 4}, 0.5,
+                                              ('127.0.0.1', 0))
+        self.maintainer.resync({10: 4})
+        self.notifier = ChunkPoolNotifier(self.maintainer.address)
+
+    def tearDown(self):
+        self.notifier.close()
+        self.maintainer.close()
+
+    def test_notify(self):
+        self.notifier.notify({10: 2})
+        self.notifier.notify({10: 1})
+        received = False
+        for i in range(0, 100):
+            received = self.maintainer.wait(0.01) or received
+            if (self.maintainer.counts[10] == 1):
+                break
+        self.assertTrue(received)
+        self.assertEqual(self.maintainer.counts[10], 1)
+        self.assertEqual(self.maintainer.deficits(), [10, 10, 10])
+
+    def test_wait_timeout(self):
+        start = time.time()
+        self.assertFalse(self.maintainer.wait(0.05))
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+    def test_wait_until_resync(self):
+        self.maintainer.resync_interval = 0
+        start = time.time()
+        self.assertFalse(self.maintainer.wait(10))
+        self.assertLess(time.time() - start, 1)
+
+    def test_ignores_garbage(self):
+        self.notifier.notify({10: 1})
+        self.notifier._socket.sendto(b'not json', self.maintainer.address)
+        for i in range(0, 100):
+            self.maintainer.wait(0.01)
+            if (self.maintainer.counts[10] == 3):
+                break
+        self.assertEqual(self.maintainer.counts[10], 3)
+
+    def test_notify_nothing(self):
+        self.notifier.notify(dict())
+        self.assertIsNone(self.notifier._socket)
+
+    def test_notify_disabled(self):
+        notifier = ChunkPoolNotifier(None)
+        notifier.notify({10: 1})
+        self.assertIsNone(notifier._socket)
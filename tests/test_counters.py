@@ -0,0 +1,79 @@
+import time
+import unittest
+
+from downstream_node.counters import CounterBuffer
+
+
+class TestCounterBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.flushed = list()
+
+    def flush(self, counts):
+        self.flushed.append(counts)
+
+    def test_add(self):
+        buffer = CounterBuffer(self.flush)
+        buffer.add(1)
+        buffer.add(1)
+        buffer.add(2, 5)
+        self.assertEqual(buffer.pending(), {1: 2, 2: 5})
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(self.flushed, [])
+
+    def test_flush(self):
+        buffer = CounterBuffer(self.flush)
+        buffer.add(1)
+        buffer.add(2, 3)
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(self.flushed, [{1: 1, 2: 3}])
+        self.assertEqual(len(buffer), 0)
+        # nothing to flush
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(len(self.flushed), 1)
+
+    def test_flush_failure_keeps_counts(self):
+        def fail(counts):
+            raise RuntimeError('test error')
+        buffer = CounterBuffer(fail)
+        buffer.add(1)
+        with self.assertRaises(RuntimeError):
+            buffer.flush()
+        buffer.add(1)
+        self.assertEqual(buffer.pending(), {1: 2})
+
+    def test_committed(self):
+        buffer = CounterBuffer(self.flush)
+        buffer.add(1)
+        buffer.committed()
+        self.assertEqual(self.flushed, [{1: 1}])
+
+    def test_committed_counts(self):
+        buffer = CounterBuffer(self.flush)
+        buffer.add(1)
+        buffer.committed({1: 2, 2: 1})
+        self.assertEqual(self.flushed, [{1: 3, 2: 1}])
+
+    def test_committed_periodic(self):
+        buffer = CounterBuffer(self.flush, 60)
+        buffer.add(1)
+        buffer.committed()
+        self.assertEqual(self.flushed, [])
+        buffer.close()
+        self.assertEqual(self.flushed, [{1: 1}])
+
+    def test_periodic(self):
+        buffer = CounterBuffer(self.flush, 0.01)
+        buffer.add(1)
+        for i in range(0, 100):
+            if (len(self.flushed) > 0):
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.flushed, [{1: 1}])
+        buffer.close()
+
+    def test_close(self):
+        buffer = CounterBuffer(self.flush)
+        buffer.add(1)
+        buffer.close()
+        self.assertEqual(self.flushed, [{1: 1}])
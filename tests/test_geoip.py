@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+import maxminddb
+
+from mock import patch
+
+from downstream_node.geoip import GeoIPReader
+
+
+class TestGeoIPReader(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.close(fd)
+        self.reader = GeoIPReader(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_lazy_open(self):
+        with patch('downstream_node.geoip.maxminddb.Reader') as p:
+            self.assertFalse(p.called)
+            p.return_value.get.return_value = 'location'
+            self.assertEqual(self.reader.get('1.2.3.4'), 'location')
+            p.assert_called_once_with(self.path, maxminddb.MODE_MMAP)
+
+    def test_shared(self):
+        with patch('downstream_node.geoip.maxminddb.Reader') as p:
+            for i in range(0, 10):
+                self.reader.get('1.2.3.4')
+            self.assertEqual(p.call_count, 1)
+            self.assertEqual(p.return_value.get.call_count, 10)
+
+    def test_reopen_on_change(self):
+        with patch('downstream_node.geoip.maxminddb.Reader') as p:
+            self.reader.get('1.2.3.4')
+            mtime = os.path.getmtime(self.path)
+            os.utime(self.path, (mtime + 10, mtime + 10))
+            self.reader.get('1.2.3.4')
+            self.assertEqual(p.call_count, 2)
+
+    def test_close(self):
+        with patch('downstream_node.geoip.maxminddb.Reader') as p:
+            self.reader.get('1.2.3.4')
+            self.reader.close()
+            p.return_value.close.assert_called_once_with()
+            self.reader.get('1.2.3.4')
+            self.assertEqual(p.call_count, 2)
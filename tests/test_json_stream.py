@@ -1,6 +1,7 @@
+import json
 import unittest
 
-from downstream_node.streamencoder import JSONEncoder
+from downstream_node.streamencoder import JSONEncoder, RawJSON
 
 
 class TestJsonStream(unittest.TestCase):
@@ -40,6 +41,15 @@ class TestJsonStream(unittest.TestCase):
 
         self.assertEqual(''.join(e.iterencode(d1)), e.encode(d2))
 
+    def test_raw_json(self):
+        raw = RawJSON('{"tag": [1, 2, "\\u00e9"]}')
+        e = JSONEncoder(stream=True)
+        encoded = ''.join(e.iterencode(dict(chunks=iter([dict(tag=raw)]),
+                                            raw=raw)))
+        self.assertEqual(json.loads(encoded),
+                         dict(chunks=[dict(tag=json.loads(raw.encoded))],
+                              raw=json.loads(raw.encoded)))
+
 
 if (__name__ == '__main__'):
     unittest.main()
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from downstream_node.ratelimit import (take_token, LocalBucketTable,
+                                       SharedBucketTable, RateLimiter)
+
+
+def take_shared(path, count):
+    table = SharedBucketTable(path, 16)
+    allowed = 0
+    for i in range(0, count):
+        if (table.take('key', 0, 10, 0)):
+            allowed += 1
+    table.close()
+    return allowed
+
+
+class TestTakeToken(unittest.TestCase):
+
+    def test_take(self):
+        self.assertEqual(take_token(2, 0, 0, 1, 2), (True, 1))
+        self.assertEqual(take_token(0.5, 0, 0, 1, 2), (False, 0.5))
+
+    def test_refill(self):
+        self.assertEqual(take_token(0, 0, 1, 1, 2), (True, 0))
+        self.assertEqual(take_token(0, 0, 0.5, 1, 2), (False, 0.5))
+
+    def test_refill_capped_at_burst(self):
+        self.assertEqual(take_token(0, 0, 100, 1, 2), (True, 1))
+
+    def test_clock_going_backwards(self):
+        self.assertEqual(take_token(1, 10, 5, 1, 2), (True, 0))
+
+
+class TestLocalBucketTable(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        table = LocalBucketTable()
+        self.assertTrue(table.take('a', 1, 2, 0))
+        self.assertTrue(table.take('a', 1, 2, 0))
+        self.assertFalse(table.take('a', 1, 2, 0))
+        self.assertFalse(table.take('a', 1, 2, 0.5))
+        self.assertTrue(table.take('a', 1, 2, 1))
+
+    def test_keys_independent(self):
+        table = LocalBucketTable()
+        self.assertTrue(table.take('a', 0, 1, 0))
+        self.assertFalse(table.take('a', 0, 1, 0))
+        self.assertTrue(table.take('b', 0, 1, 0))
+
+    def test_maxsize(self):
+        table = LocalBucketTable(2)
+        self.assertTrue(table.take('a', 0, 1, 0))
+        self.assertTrue(table.take('b', 0, 1, 0))
+        self.assertTrue(table.take('c', 0, 1, 0))
+        self.assertEqual(len(table), 2)
+        # a was dropped, so it starts with a full bucket again
+        self.assertTrue(table.take('a', 0, 1, 0))
+        self.assertFalse(table.take('c', 0, 1, 0))
+
+
+class TestSharedBucketTable(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'ratelimit')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_burst_then_rate(self):
+        table = SharedBucketTable(self.path, 16)
+        self.assertTrue(table.take('a', 1, 2, 0))
+        self.assertTrue(table.take('a', 1, 2, 0))
+        self.assertFalse(table.take('a', 1, 2, 0))
+        self.assertTrue(table.take('a', 1, 2, 1))
+        table.close()
+
+    def test_file_size(self):
+        SharedBucketTable(self.path, 16).close()
+        self.assertEqual(os.path.getsize(self.path),
+                         16 * SharedBucketTable.slot.size)
+
+    def test_shared_between_tables(self):
+        first = SharedBucketTable(self.path, 16)
+        second = SharedBucketTable(self.path, 16)
+        self.assertTrue(first.take('a', 0, 1, 0))
+        self.assertFalse(second.take('a', 0, 1, 0))
+        first.close()
+        second.close()
+
+    def test_shared_between_processes(self):
+        pool = multiprocessing.Pool(4)
+        try:
+            results = [pool.apply_async(take_shared, (self.path, 10))
+                       for i in range(0, 4)]
+            allowed = [r.get(10) for r in results]
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(sum(allowed), 10)
+
+    def test_hash_key_nonzero(self):
+        self.assertNotEqual(SharedBucketTable.hash_key('a'), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_unlimited(self):
+        limiter = RateLimiter(dict(chunk=None))
+        for i in range(0, 100):
+            self.assertTrue(limiter.allow('chunk', '1.2.3.4'))
+            self.assertTrue(limiter.allow('new', '1.2.3.4'))
+
+    def test_limited(self):
+        limiter = RateLimiter(dict(chunk=(1, 2)))
+        self.assertTrue(limiter.allow('chunk', '1.2.3.4', 0))
+        self.assertTrue(limiter.allow('chunk', '1.2.3.4', 0))
+        self.assertFalse(limiter.allow('chunk', '1.2.3.4', 0))
+        self.assertTrue(limiter.allow('chunk', '5.6.7.8', 0))
+        self.assertTrue(limiter.allow('chunk', '1.2.3.4', 1))
+
+    def test_routes_independent(self):
+        limiter = RateLimiter(dict(chunk=(0, 1), new=(0, 1)))
+        self.assertTrue(limiter.allow('chunk', '1.2.3.4', 0))
+        self.assertFalse(limiter.allow('chunk', '1.2.3.4', 0))
+        self.assertTrue(limiter.allow('new', '1.2.3.4', 0))
+
+    def test_shared(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'ratelimit')
+            limiter = RateLimiter(dict(chunk=(0, 1)), path, 16)
+            self.assertIsInstance(limiter.table, SharedBucketTable)
+            self.assertTrue(limiter.allow('chunk', '1.2.3.4', 0))
+            other = RateLimiter(dict(chunk=(0, 1)), path, 16)
+            self.assertFalse(other.allow('chunk', '1.2.3.4', 0))
+            limiter.table.close()
+            other.table.close()
+        finally:
+            shutil.rmtree(d)
@@ -0,0 +1,84 @@
+import json
+import pickle
+import unittest
+
+from downstream_node import tagcodec
+from downstream_node.streamencoder import RawJSON
+from downstream_node.tagcodec import (MAGIC, JSON_MAGIC, dump_tag,
+                                      dump_tag_json, load_tag, pack_tags,
+                                      unpack_tags)
+
+
+class FakeTag(object):
+
+    def __init__(self, leaves):
+        self.leaves = leaves
+
+    def todict(self):
+        return dict(leaves=self.leaves)
+
+
+class TestTagCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.tag = dict(leaves=[str(i) * 20 for i in range(0, 100)])
+
+    def test_plain(self):
+        data = dump_tag(self.tag)
+        self.assertEqual(data, pickle.dumps(self.tag,
+                                            pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(load_tag(data), self.tag)
+
+    def test_zlib(self):
+        data = dump_tag(self.tag, 'zlib', 9)
+        self.assertTrue(data.startswith(MAGIC))
+        self.assertLess(len(data), len(dump_tag(self.tag)))
+        self.assertEqual(load_tag(data), self.tag)
+
+    @unittest.skipIf(tagcodec.lzma is None, 'lzma is not available')
+    def test_lzma(self):
+        data = dump_tag(self.tag, 'lzma', 1)
+        self.assertTrue(data.startswith(MAGIC))
+        self.assertLess(len(data), len(dump_tag(self.tag)))
+        self.assertEqual(load_tag(data), self.tag)
+
+    def test_legacy_pickles(self):
+        for protocol in range(0, pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(load_tag(pickle.dumps(self.tag, protocol)),
+                             self.tag)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            dump_tag(self.tag, 'bz2')
+        with self.assertRaises(ValueError):
+            load_tag(MAGIC + b'\xff')
+        with self.assertRaises(ValueError):
+            load_tag(MAGIC + b'\x00')
+        with self.assertRaises(ValueError):
+            load_tag(JSON_MAGIC + b'\xff')
+
+    def test_json(self):
+        tag = FakeTag(self.tag['leaves'])
+        for (compression, level) in [(None, None), ('zlib', 9)]:
+            data = dump_tag_json(tag, compression, level)
+            self.assertTrue(data.startswith(JSON_MAGIC))
+            loaded = load_tag(data)
+            self.assertIsInstance(loaded, RawJSON)
+            self.assertEqual(json.loads(loaded.encoded), tag.todict())
+
+
+class TestTagFraming(unittest.TestCase):
+
+    def test_round_trip(self):
+        items = [('a' * 64, b'first tag'), ('b' * 64, b''),
+                 ('c' * 64, b'\x00' * 1000)]
+        self.assertEqual(unpack_tags(pack_tags(items)), dict(items))
+
+    def test_empty(self):
+        self.assertEqual(unpack_tags(pack_tags([])), dict())
+
+    def test_truncated(self):
+        data = pack_tags([('a' * 64, b'first tag')])
+        for end in [10, len(data) - 1]:
+            with self.assertRaises(ValueError):
+                unpack_tags(data[:end])
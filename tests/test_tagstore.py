@@ -0,0 +1,283 @@
+import os
+import shutil
+import socket
+import hashlib
+import tempfile
+import unittest
+import multiprocessing
+
+import mock
+
+from downstream_node.tagstore import TagStore
+
+
+def put_tags(path, prefix, count):
+    store = TagStore(path, 256)
+    hashes = [store.put('{0} {1}'.format(prefix, i).encode('utf-8'))
+              for i in range(0, count)]
+    store.close()
+    return hashes
+
+
+class TestTagStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tags')
+        self.store = TagStore(self.path, 256)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def segments(self):
+        return [n for n in os.listdir(self.path) if n.endswith('.pack')]
+
+    def test_put_get(self):
+        hash = self.store.put(b'tag data')
+        self.assertEqual(hash, hashlib.sha256(b'tag data').hexdigest())
+        self.assertIn(hash, self.store)
+        self.assertEqual(self.store.get(hash), b'tag data')
+        self.assertEqual(len(self.store), 1)
+
+    def test_put_twice(self):
+        first = self.store.put(b'tag data')
+        second = self.store.put(b'tag data')
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.store), 1)
+
+    def test_get_missing(self):
+        with self.assertRaises(KeyError):
+            self.store.get(hashlib.sha256(b'missing').hexdigest())
+        with self.assertRaises(KeyError):
+            self.store.get('not a hash')
+        self.assertNotIn('not a hash', self.store)
+
+    def test_pop(self):
+        hash = self.store.put(b'tag data')
+        self.assertEqual(self.store.pop(hash), b'tag data')
+        self.assertNotIn(hash, self.store)
+        with self.assertRaises(KeyError):
+            self.store.pop(hash)
+
+    def test_open(self):
+        hash = self.store.put(b'first tag')
+        self.store.put(b'second tag')
+        with self.store.open(hash) as reader:
+            self.assertEqual(reader.length, len(b'first tag'))
+            self.assertEqual(reader.read(5), b'first')
+            # never reads past the tag
+            self.assertEqual(reader.read(), b' tag')
+            self.assertEqual(reader.read(), b'')
+        self.assertIn(hash, self.store)
+        with self.assertRaises(KeyError):
+            self.store.open(hashlib.sha256(b'missing').hexdigest())
+
+    def test_open_fileno(self):
+        self.store.put(b'first tag')
+        hash = self.store.put(b'second tag')
+        # positioned at the tag, as sendfile() expects
+        with self.store.open(hash) as reader:
+            self.assertEqual(os.lseek(reader.fileno(), 0, os.SEEK_CUR), 9)
+            self.assertEqual(os.read(reader.fileno(), 10), b'second tag')
+
+    def test_open_consume(self):
+        hash = self.store.put(b'tag data')
+        # read to the end
+        with self.store.open(hash, consume=True) as reader:
+            reader.read(100)
+        self.assertNotIn(hash, self.store)
+
+        hash = self.store.put(b'tag data')
+        # aborted part way
+        with self.store.open(hash, consume=True) as reader:
+            reader.read(3)
+        self.assertIn(hash, self.store)
+
+        # closed without sending anything
+        self.store.open(hash, consume=True).close()
+        self.assertIn(hash, self.store)
+
+    def sendfile(self, reader, count):
+        # sends the tag as gunicorn does, from the position of the reader
+        (sender, receiver) = socket.socketpair()
+        try:
+            sent = sender.sendfile(reader, reader.tell(), count)
+            received = b''
+            while (len(received) < sent):
+                received += receiver.recv(sent - len(received))
+            return received
+        finally:
+            sender.close()
+            receiver.close()
+
+    @unittest.skipIf(not hasattr(socket.socket, 'sendfile'),
+                     'socket.sendfile() is not available')
+    def test_open_consume_sendfile(self):
+        self.store.put(b'first tag')
+        hash = self.store.put(b'second tag')
+        # sendfile() failed part way
+        with self.store.open(hash, consume=True) as reader:
+            self.assertEqual(self.sendfile(reader, 4), b'seco')
+        self.assertIn(hash, self.store)
+
+        with self.store.open(hash, consume=True) as reader:
+            self.assertEqual(self.sendfile(reader, reader.length),
+                             b'second tag')
+        self.assertNotIn(hash, self.store)
+
+    def test_open_seek_tell(self):
+        self.store.put(b'first tag')
+        hash = self.store.put(b'second tag')
+        with self.store.open(hash) as reader:
+            self.assertEqual(reader.tell(), 9)
+            reader.seek(-3, os.SEEK_END)
+            self.assertEqual(reader.read(), b'tag')
+            reader.seek(9)
+            self.assertEqual(reader.read(6), b'second')
+
+    def test_delete(self):
+        hashes = [self.store.put(b'a'), self.store.put(b'b')]
+        self.assertEqual(self.store.delete(hashes + ['not a hash']), 2)
+        self.assertEqual(self.store.delete(hashes), 0)
+        self.assertEqual(len(self.store), 0)
+
+    def test_segments_roll(self):
+        hashes = [self.store.put(os.urandom(100)) for i in range(0, 10)]
+        self.assertEqual(len(self.segments()), 5)
+        for hash in hashes:
+            self.assertEqual(len(self.store.get(hash)), 100)
+
+    def test_reopen(self):
+        hash = self.store.put(b'tag data')
+        popped = self.store.put(b'popped')
+        self.store.pop(popped)
+        store = TagStore(self.path, 256)
+        self.assertEqual(store.get(hash), b'tag data')
+        self.assertNotIn(popped, store)
+        store.close()
+
+    def test_shared_between_stores(self):
+        other = TagStore(self.path, 256)
+        hash = self.store.put(b'tag data')
+        self.assertEqual(other.pop(hash), b'tag data')
+        self.assertNotIn(hash, self.store)
+        other.close()
+
+    def test_truncated_record_ignored(self):
+        hash = self.store.put(b'tag data')
+        with open(os.path.join(self.path, 'index.log'), 'ab') as f:
+            f.write(b'partial')
+        store = TagStore(self.path, 256)
+        self.assertEqual(store.get(hash), b'tag data')
+        other = store.put(b'other')
+        store.close()
+        store = TagStore(self.path, 256)
+        self.assertEqual(store.get(other), b'other')
+        store.close()
+
+    def test_compact(self):
+        hashes = [self.store.put(os.urandom(100)) for i in range(0, 10)]
+        kept = dict((h, self.store.get(h)) for h in hashes[::4])
+        self.store.delete([h for h in hashes if h not in kept])
+        other = TagStore(self.path, 256)
+        self.assertEqual(len(other), 3)
+
+        # two tags to a segment.  the second and fourth are dead, the first
+        # and third are half live and the fifth is still being appended to
+        self.assertEqual(self.store.compact(), 2)
+        self.assertEqual(self.store.compact(), 0)
+        self.assertEqual(len(self.segments()), 3)
+        for (hash, data) in kept.items():
+            self.assertEqual(self.store.get(hash), data)
+            # other stores pick up the compacted index
+            self.assertEqual(other.get(hash), data)
+        self.assertEqual(len(other), 3)
+        other.close()
+
+    def test_compact_in_batches(self):
+        hashes = [self.store.put(os.urandom(100)) for i in range(0, 10)]
+        kept = dict((h, self.store.get(h)) for h in hashes[::4])
+        self.store.delete([h for h in hashes if h not in kept])
+
+        exclusive = list()
+        locked = self.store._locked
+
+        def count_locked(exclusive_lock):
+            if (exclusive_lock):
+                exclusive.append(True)
+            return locked(exclusive_lock)
+
+        with mock.patch.object(self.store, '_locked', count_locked):
+            self.assertEqual(self.store.compact(0.6, batch_size=1), 4)
+        # the lock is released after each of the two half live tags is
+        # moved, then taken once more to swap the index
+        self.assertEqual(len(exclusive), 3)
+        for (hash, data) in kept.items():
+            self.assertEqual(self.store.get(hash), data)
+
+    def test_compact_tag_consumed_during_compaction(self):
+        hashes = [self.store.put(os.urandom(100)) for i in range(0, 6)]
+        # the first segment is half live, the second dead
+        self.store.delete(hashes[1:4])
+        other = TagStore(self.path, 256)
+        move_batch = self.store._move_batch
+
+        def consume_then_move(victims, pending, batch_size):
+            # another process consumes the tag before it is moved
+            other.pop(hashes[0])
+            return move_batch(victims, pending, batch_size)
+
+        with mock.patch.object(self.store, '_move_batch', consume_then_move):
+            self.assertEqual(self.store.compact(0.6), 2)
+        self.assertNotIn(hashes[0], self.store)
+        self.assertEqual(len(self.store), 2)
+        other.close()
+
+    def test_compact_keeps_active_segment(self):
+        hash = self.store.put(b'tag data')
+        self.store.delete([hash])
+        self.assertEqual(self.store.compact(), 0)
+        self.assertEqual(len(self.segments()), 1)
+
+    def test_start_compaction_once(self):
+        self.store.start_compaction(3600)
+        thread = self.store._thread
+        self.store.start_compaction(3600)
+        self.assertIs(self.store._thread, thread)
+        self.assertTrue(thread.is_alive())
+        self.store.close()
+        self.assertFalse(thread.is_alive())
+
+    def test_shared_between_processes(self):
+        pool = multiprocessing.Pool(4)
+        try:
+            results = [pool.apply_async(put_tags, (self.path, i, 20))
+                       for i in range(0, 4)]
+            hashes = sum([r.get(10) for r in results], [])
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(len(self.store), 80)
+        for (i, hash) in enumerate(hashes):
+            self.assertEqual(self.store.get(hash), '{0} {1}'.format(
+                i // 20, i % 20).encode('utf-8'))
+
+    def test_import_files(self):
+        legacy = os.path.join(self.dir, 'legacy')
+        os.makedirs(legacy)
+        hashes = list()
+        for data in [b'a', b'b']:
+            hash = hashlib.sha256(data).hexdigest()
+            with open(os.path.join(legacy, hash), 'wb') as f:
+                f.write(data)
+            hashes.append(hash)
+        # neither a tag name nor matching its contents
+        for name in ['.gitignore', hashlib.sha256(b'c').hexdigest()]:
+            with open(os.path.join(legacy, name), 'wb') as f:
+                f.write(b'not c')
+
+        self.assertEqual(self.store.import_files(legacy), 2)
+        self.assertEqual(self.store.get(hashes[0]), b'a')
+        self.assertEqual(self.store.get(hashes[1]), b'b')
+        self.assertEqual(len(os.listdir(legacy)), 2)
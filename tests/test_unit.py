@@ -3,31 +3,48 @@
 import json
 import os
 import pickle
+import hashlib
 import unittest
 import io
 import base58
+import threading
+import multiprocessing
 import maxminddb
 
 import mock
-from mock import Mock, patch
+from mock import patch
 from datetime import datetime, timedelta
 
 import heartbeat
 from RandomIO import RandomIO
 
-from downstream_node.startup import app, db, load_heartbeat, load_logger
+from downstream_node.startup import (app, db, load_heartbeat, load_logger,
+                                     load_public_heartbeat)
 from downstream_node import models
 from downstream_node import node
+from downstream_node import routes
 from downstream_node import config
 from downstream_node import uptime
 from downstream_node import log
+from downstream_node.whitelist import bump_whitelist_version
+from downstream_node.workers import WorkerPool
+from downstream_node.ratelimit import RateLimiter
+from downstream_node.counters import CounterBuffer
+from downstream_node.tagcodec import dump_tag, pack_tags, unpack_tags
+from downstream_node.streamencoder import RawJSON
 from downstream_node.exc import (InvalidParameterError,
+                                 ServiceUnavailableError,
+                                 RateLimitError,
                                  HttpHandler)
 
 app.config[
     'SQLALCHEMY_DATABASE_URI'] = \
     'mysql+pymysql://localhost/test_downstream?charset=utf8'
 
+# tables dropped and recreated around each test
+TABLES = ('contracts,chunks,tokens,addresses,files,ip_token_counts,'
+          'whitelist_version')
+
 
 class TestStartup(unittest.TestCase):
 
@@ -58,6 +75,15 @@ class TestStartup(unittest.TestCase):
         self.assertEqual(loaded_beat, beat)
         os.remove(test_file)
 
+    def test_load_public_heartbeat(self):
+        pub_beat = load_public_heartbeat(app.heartbeat)
+        self.assertEqual(pub_beat.type, type(app.heartbeat).__name__)
+        self.assertEqual(pub_beat.heartbeat,
+                         app.heartbeat.get_public().todict())
+        self.assertEqual(json.loads(pub_beat.json), pub_beat.heartbeat)
+        self.assertEqual(pub_beat.digest, load_public_heartbeat(
+            app.heartbeat).digest)
+
     def test_log_startup_log(self):
         mock_alias = 'mock_alias'
         logger = load_logger(True,
@@ -80,19 +106,18 @@ class TestDownstreamModels(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
         app.config['TESTING'] = True
-        db.engine.execute(
-            'DROP TABLE IF EXISTS contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE IF EXISTS ' + TABLES)
         db.create_all()
         self.test_address = base58.b58encode_check(b'\x00' + os.urandom(20))
         address = models.Address(
             address=self.test_address, crowdsale_balance=20000)
         db.session.add(address)
         db.session.commit()
-        pass
+        app.whitelist.load()
 
     def tearDown(self):
         db.session.close()
-        db.engine.execute('DROP TABLE contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE ' + TABLES)
         pass
 
     def test_uptime_zero(self):
@@ -109,8 +134,7 @@ class TestDownstreamRoutes(unittest.TestCase):
         self.app = app.test_client()
         app.config['TESTING'] = True
         app.config['REQUIRE_SIGNATURE'] = False
-        db.engine.execute(
-            'DROP TABLE IF EXISTS contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE IF EXISTS ' + TABLES)
         db.create_all()
         self.testfile = RandomIO().genfile(1000)
 
@@ -123,10 +147,11 @@ class TestDownstreamRoutes(unittest.TestCase):
             address=self.test_address, crowdsale_balance=10000)
         db.session.add(address)
         db.session.commit()
+        app.whitelist.load()
 
     def tearDown(self):
         db.session.close()
-        db.engine.execute('DROP TABLE contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE ' + TABLES)
         os.remove(self.testfile)
         del self.app
 
@@ -140,6 +165,21 @@ class TestDownstreamRoutes(unittest.TestCase):
 
         self.assertEqual(r_json['msg'], 'ok')
 
+    def test_api_debug_caches(self):
+        app.config['DEBUG'] = True
+        r = self.app.get('/debug/caches')
+        self.assertEqual(r.status_code, 200)
+
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertIn('geoip', r_json['caches'])
+        self.assertIn('hit_rate', r_json['caches']['geoip'])
+
+        app.config['DEBUG'] = False
+        r = self.app.get('/debug/caches')
+        self.assertEqual(r.status_code, 404)
+        app.config['DEBUG'] = True
+
     def test_api_downstream_new(self):
         app.mongo_logger = mock.MagicMock()
         with patch('downstream_node.routes.request') as request:
@@ -180,6 +220,111 @@ class TestDownstreamRoutes(unittest.TestCase):
             self.assertEqual(r.status_code, 200)
             self.assertEqual(r.content_type, 'application/json')
 
+    def test_api_downstream_new_signed_pool(self):
+        app.config['REQUIRE_SIGNATURE'] = True
+        pool = WorkerPool(1)
+        with patch('downstream_node.routes.request') as request,\
+                patch.object(app, 'signature_pool', pool):
+            request.remote_addr = 'test.ip.address'
+            request.method = 'POST'
+            request.get_json.return_value = dict(
+                {'signature': self.test_signature,
+                 'message': self.test_message})
+            with patch('downstream_node.node.get_ip_location') as p:
+                p.return_value = dict()
+                r = self.app.get('/new/{0}'.format(self.test_address))
+        pool.close()
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content_type, 'application/json')
+
+    def test_api_downstream_new_signed_timeout(self):
+        app.config['REQUIRE_SIGNATURE'] = True
+        app.caches['signatures'].clear()
+        with patch('downstream_node.routes.request') as request,\
+                patch.object(app, 'signature_pool') as pool:
+            pool.apply.side_effect = multiprocessing.TimeoutError()
+            request.remote_addr = 'test.ip.address'
+            request.method = 'POST'
+            request.get_json.return_value = dict(
+                {'signature': self.test_signature,
+                 'message': self.test_message})
+            r = self.app.get('/new/{0}'.format(self.test_address))
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(r.content_type, 'application/json')
+
+    def test_api_rate_limited(self):
+        limiter = RateLimiter(dict(chunk=(0, 2)))
+        with patch.object(app, 'rate_limiter', limiter):
+            for i in range(0, 2):
+                r = self.app.get('/chunk/invalidtoken')
+                self.assertEqual(r.status_code, 400)
+            r = self.app.get('/chunk/invalidtoken')
+            self.assertEqual(r.status_code, 429)
+            self.assertEqual(r.content_type, 'application/json')
+            # other routes are not limited
+            r = self.app.get('/heartbeat/invalidtoken')
+            self.assertEqual(r.status_code, 404)
+
+    def test_api_downstream_tag(self):
+        tag_hash = app.tag_store.put(b'test tag')
+        with patch.dict(app.config, TAG_KEY='testkey'):
+            r = self.app.get('/tag/testkey/{0}'.format(tag_hash))
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.content_length, len(b'test tag'))
+            self.assertEqual(r.data, b'test tag')
+            r.close()
+            self.assertNotIn(tag_hash, app.tag_store)
+
+            # the tag is only handed out once
+            r = self.app.get('/tag/testkey/{0}'.format(tag_hash))
+            self.assertEqual(r.status_code, 404)
+
+    def test_api_downstream_tag_head(self):
+        tag_hash = app.tag_store.put(b'test tag')
+        with patch.dict(app.config, TAG_KEY='testkey'):
+            r = self.app.head('/tag/testkey/{0}'.format(tag_hash))
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.content_length, len(b'test tag'))
+            r.close()
+        # nothing was sent, so the tag is kept
+        self.assertIn(tag_hash, app.tag_store)
+        app.tag_store.delete([tag_hash])
+
+    def test_api_downstream_tag_invalid_key(self):
+        tag_hash = app.tag_store.put(b'test tag')
+        with patch.dict(app.config, TAG_KEY='testkey'):
+            r = self.app.get('/tag/invalidkey/{0}'.format(tag_hash))
+        self.assertEqual(r.status_code, 400)
+        self.assertIn(tag_hash, app.tag_store)
+        app.tag_store.delete([tag_hash])
+
+    def test_api_downstream_tags(self):
+        hashes = [app.tag_store.put(b'first tag'),
+                  app.tag_store.put(b'second tag')]
+        missing = hashlib.sha256(b'missing').hexdigest()
+        with patch.dict(app.config, TAG_KEY='testkey'):
+            r = self.app.post('/tag/testkey',
+                              data=json.dumps(dict(hashes=hashes + [missing])))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(unpack_tags(r.data),
+                         {hashes[0]: b'first tag', hashes[1]: b'second tag'})
+        for hash in hashes:
+            self.assertNotIn(hash, app.tag_store)
+
+    def test_api_downstream_tags_invalid(self):
+        with patch.dict(app.config, TAG_KEY='testkey', TAG_MULTI_GET_MAX=2):
+            r = self.app.post('/tag/invalidkey',
+                              data=json.dumps(dict(hashes=[])))
+            self.assertEqual(r.status_code, 400)
+            r = self.app.post('/tag/testkey', data='not json')
+            self.assertEqual(r.status_code, 400)
+            r = self.app.post('/tag/testkey',
+                              data=json.dumps(dict(hashes='a')))
+            self.assertEqual(r.status_code, 400)
+            r = self.app.post('/tag/testkey',
+                              data=json.dumps(dict(hashes=['a'] * 3)))
+            self.assertEqual(r.status_code, 400)
+
     def test_api_downstream_new_signed_invalid_object(self):
         app.config['REQUIRE_SIGNATURE'] = True
         with patch('downstream_node.routes.request') as request:
@@ -285,6 +430,18 @@ class TestDownstreamRoutes(unittest.TestCase):
 
         self.assertEqual(r_beat2, r_beat)
 
+        # revalidate with the etag
+        etag = r.headers['ETag']
+        r = self.app.get('/heartbeat/{0}'.format(r_token),
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.headers['ETag'], etag)
+        self.assertEqual(r.data, b'')
+
+        r = self.app.get('/heartbeat/{0}'.format(r_token),
+                         headers={'If-None-Match': '"other"'})
+        self.assertEqual(r.status_code, 200)
+
         # test nonexistant token
         r = self.app.get('/heartbeat/nonexistenttoken')
         self.assertEqual(r.status_code, 404)
@@ -363,8 +520,10 @@ class TestDownstreamRoutes(unittest.TestCase):
     def test_api_downstream_chunk_contract_no_chunks(self):
         with patch('downstream_node.routes.get_chunk_contracts') as p,\
                 patch('downstream_node.routes.process_token_ip_address'),\
+                patch('downstream_node.routes.resolve_token') as p2,\
                 patch('downstream_node.routes.Token') as p3:
-            p3.query.filter.return_value.first.return_value = 'dummy_token'
+            p2.return_value = mock.MagicMock()
+            p3.query.get.return_value = 'dummy_token'
             p.return_value = []
             r = self.app.get('/chunk/test_token')
         self.assertEqual(r.status_code, 200, r.data)
@@ -374,6 +533,26 @@ class TestDownstreamRoutes(unittest.TestCase):
 
         self.assertEqual(r_json['chunks'], [])
 
+    def test_api_downstream_chunk_contract_missing_tag(self):
+        db_contract = mock.MagicMock()
+        db_contract.tag_path = 'missing'
+        with patch('downstream_node.routes.get_chunk_contracts') as p,\
+                patch('downstream_node.routes.prefetch_tags') as p1,\
+                patch('downstream_node.routes.process_token_ip_address'),\
+                patch('downstream_node.routes.resolve_token') as p2,\
+                patch('downstream_node.routes.Token') as p3:
+            p2.return_value = mock.MagicMock()
+            p3.query.get.return_value = 'dummy_token'
+            p.return_value = [db_contract]
+            p1.return_value = iter([None])
+            r = self.app.get('/chunk/test_token')
+        self.assertEqual(r.status_code, 200, r.data)
+        p1.assert_called_once_with(['missing'])
+
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertEqual(r_json['chunks'], [])
+
     def test_api_downstream_challenge(self):
         with patch('downstream_node.node.get_ip_location') as p:
             p.return_value = dict()
@@ -532,13 +711,59 @@ class TestDownstreamRoutes(unittest.TestCase):
         self.assertEqual(r_json['report'], [])
 
 
+class TestDownstreamNodeSignature(unittest.TestCase):
+
+    def setUp(self):
+        self.test_address = '19qVgG8C6eXwKMMyvVegsi3xCsKyk3Z3jV'
+        self.test_signature = ('HyzVUenXXo4pa+kgm1vS8PNJM83eIXFC5r0q86FGbqFcdl'
+                               'a6rcw72/ciXiEPfjli3ENfwWuESHhv6K9esI0dl5I=')
+        self.test_message = 'test message'
+        app.caches['signatures'].clear()
+
+    def test_verify_signature(self):
+        self.assertTrue(node.verify_signature(self.test_message,
+                                              self.test_signature,
+                                              self.test_address))
+        self.assertFalse(node.verify_signature('other message',
+                                               self.test_signature,
+                                               self.test_address))
+
+    def test_verify_signature_cached(self):
+        with patch('downstream_node.node.siggy.verify_signature') as p:
+            p.return_value = True
+            for i in range(0, 3):
+                self.assertTrue(node.verify_signature(self.test_message,
+                                                      self.test_signature,
+                                                      self.test_address))
+        self.assertEqual(p.call_count, 1)
+        self.assertEqual(app.caches['signatures'].hits, 2)
+
+    def test_verify_signature_failure_not_cached(self):
+        with patch('downstream_node.node.siggy.verify_signature') as p:
+            p.return_value = False
+            for i in range(0, 3):
+                self.assertFalse(node.verify_signature(self.test_message,
+                                                       self.test_signature,
+                                                       self.test_address))
+        self.assertEqual(p.call_count, 3)
+
+    def test_verify_signature_cache_key_unambiguous(self):
+        # the signature and message overlap when joined with a newline
+        with patch('downstream_node.node.siggy.verify_signature') as p:
+            p.side_effect = lambda m, s, a: (m == 'message')
+            self.assertTrue(node.verify_signature('message', 'sig\nmore',
+                                                  self.test_address))
+            self.assertFalse(node.verify_signature('more\nmessage', 'sig',
+                                                   self.test_address))
+        self.assertEqual(p.call_count, 2)
+
+
 class TestDownstreamNodeStatus(unittest.TestCase):
 
     def setUp(self):
         self.app = app.test_client()
         app.config['TESTING'] = True
-        db.engine.execute(
-            'DROP TABLE IF EXISTS contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE IF EXISTS ' + TABLES)
         db.create_all()
 
         self.assertEqual(db.session.query(models.Token).count(), 0)
@@ -624,7 +849,7 @@ class TestDownstreamNodeStatus(unittest.TestCase):
 
     def tearDown(self):
         db.session.close()
-        db.engine.execute('DROP TABLE contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE ' + TABLES)
 
     def test_api_status_list(self):
         r = self.app.get('/status/list/')
@@ -845,8 +1070,7 @@ class TestDownstreamNodeStatus(unittest.TestCase):
 class TestDownstreamNodeFuncs(unittest.TestCase):
 
     def setUp(self):
-        db.engine.execute(
-            'DROP TABLE IF EXISTS contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE IF EXISTS ' + TABLES)
         db.create_all()
         self.test_size = 1000
         self.test_seed = 'test seed'
@@ -905,10 +1129,11 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
             address=self.test_address, crowdsale_balance=20000)
         db.session.add(address)
         db.session.commit()
+        app.whitelist.load()
 
     def tearDown(self):
         db.session.close()
-        db.engine.execute('DROP TABLE contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE ' + TABLES)
         os.remove(self.testfile)
         pass
 
@@ -965,11 +1190,11 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
             'Invalid address given: address must be in whitelist.')
 
     def test_get_ip_location(self):
-        with patch('downstream_node.node.maxminddb.Reader') as reader:
+        with patch.object(app, 'geoip') as reader:
             for l in [self.full_location, self.partial_location,
                       self.no_location]:
-                reader.return_value = Mock()
-                reader.return_value.get.return_value = l
+                reader.get.return_value = l
+                app.caches['geoip'].clear()
                 location = node.get_ip_location('testaddress')
                 if ('country' in l):
                     self.assertEqual(
@@ -999,6 +1224,48 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
                 else:
                     self.assertIsNone(location['zip'])
 
+    def test_get_ip_location_cached(self):
+        app.caches['geoip'].clear()
+        with patch.object(app, 'geoip') as reader:
+            reader.get.return_value = self.full_location
+            location = node.get_ip_location('testaddress')
+            location['country'] = 'modified'
+            location = node.get_ip_location('testaddress')
+        self.assertEqual(reader.get.call_count, 1)
+        self.assertEqual(
+            location['country'], self.full_location['country']['names']['en'])
+
+    def test_create_token_rejected_by_whitelist_index(self):
+        address = base58.b58encode_check(b'\x00' + os.urandom(20))
+        with patch('downstream_node.node.Address') as p,\
+                patch('downstream_node.node.get_ip_token_count') as c:
+            with self.assertRaises(InvalidParameterError) as ex:
+                node.create_token(address, 'ipaddress')
+            self.assertFalse(p.query.filter.called)
+            self.assertFalse(c.called)
+
+        self.assertEqual(
+            str(ex.exception),
+            'Invalid address given: address must be in whitelist.')
+
+    def test_whitelist_index_reload(self):
+        app.whitelist.refresh_interval = 0
+        address = base58.b58encode_check(b'\x00' + os.urandom(20))
+        self.assertNotIn(address, app.whitelist)
+
+        db.session.add(models.Address(address=address,
+                                      crowdsale_balance=20000))
+        db.session.commit()
+
+        # not reloaded until the version changes
+        self.assertNotIn(address, app.whitelist)
+
+        bump_whitelist_version()
+
+        self.assertIn(address, app.whitelist)
+        app.whitelist.refresh_interval = \
+            app.config['WHITELIST_REFRESH_INTERVAL']
+
     def test_create_token_duplicate_id(self):
         with patch('downstream_node.node.get_ip_location') as p:
             p.return_value = dict()
@@ -1011,6 +1278,62 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
                 'IP Disallowed, only {0} tokens are permitted per IP address'.
                 format(app.config['MAX_TOKENS_PER_IP']))
 
+    def test_ip_token_count(self):
+        with patch('downstream_node.node.get_ip_location') as p:
+            p.return_value = dict()
+            db_token = node.create_token(self.test_address, 'count.ip')
+            node.create_token(self.test_address, 'count.ip')
+
+        self.assertEqual(node.get_ip_token_count('count.ip'), 2)
+
+        with patch('downstream_node.node.get_ip_location') as p:
+            p.return_value = dict()
+            node.process_token_ip_address(db_token, 'other.ip', change=True)
+        db.session.commit()
+
+        self.assertEqual(node.get_ip_token_count('count.ip'), 1)
+        self.assertEqual(node.get_ip_token_count('other.ip'), 1)
+
+        node.delete_token(db_token.token)
+
+        self.assertEqual(node.get_ip_token_count('other.ip'), 0)
+        self.assertEqual(node.get_ip_token_count('unknown.ip'), 0)
+
+    def test_adjust_ip_token_count_concurrent(self):
+        errors = list()
+
+        def adjust():
+            with app.app_context():
+                try:
+                    node.adjust_ip_token_count('race.ip', 1)
+                    db.session.commit()
+                except Exception as ex:
+                    errors.append(ex)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=adjust) for i in range(0, 8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(node.get_ip_token_count('race.ip'), 8)
+
+    def test_rebuild_ip_token_counts(self):
+        with patch('downstream_node.node.get_ip_location') as p:
+            p.return_value = dict()
+            node.create_token(self.test_address, 'count.ip')
+
+        db.engine.execute(models.IPTokenCount.__table__.delete())
+
+        self.assertEqual(node.get_ip_token_count('count.ip'), 0)
+
+        node.rebuild_ip_token_counts()
+
+        self.assertEqual(node.get_ip_token_count('count.ip'), 1)
+
     def test_address_resolve(self):
         db_token = node.create_token(self.test_address, '17.0.0.1')
 
@@ -1047,6 +1370,62 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
 
         self.assertEqual(str(ex.exception), 'Nonexistent token.')
 
+    def test_resolve_token(self):
+        with patch('downstream_node.node.get_ip_location') as p:
+            p.return_value = dict()
+            db_token = node.create_token(self.test_address, 'resolve.ip')
+
+        token_info = node.resolve_token(db_token.token)
+
+        self.assertEqual(token_info.id, db_token.id)
+        self.assertEqual(token_info.address_id, db_token.address_id)
+        self.assertEqual(token_info.ip_address, 'resolve.ip')
+        self.assertEqual(token_info.farmer_id, db_token.farmer_id)
+
+        # the second resolution should come from the cache
+        with patch('downstream_node.node.db.session.execute') as p:
+            self.assertEqual(node.resolve_token(db_token.token), token_info)
+            self.assertFalse(p.called)
+
+        self.assertIsNone(node.resolve_token('nonexistent token'))
+
+    def test_resolve_token_invalidated(self):
+        with patch('downstream_node.node.get_ip_location') as p:
+            p.return_value = dict()
+            db_token = node.create_token(self.test_address, 'resolve.ip')
+
+            node.resolve_token(db_token.token)
+
+            node.process_token_ip_address(db_token, 'changed.ip', change=True)
+            db.session.commit()
+
+        self.assertEqual(node.resolve_token(db_token.token).ip_address,
+                         'changed.ip')
+
+        token = db_token.token
+        node.delete_token(token)
+
+        self.assertIsNone(node.resolve_token(token))
+
+    def test_resolve_token_invalidated_on_commit(self):
+        with patch('downstream_node.node.get_ip_location') as p:
+            p.return_value = dict()
+            db_token = node.create_token(self.test_address, 'resolve.ip')
+
+            node.process_token_ip_address(db_token, 'changed.ip', change=True)
+            # resolved again before the change is committed
+            node.resolve_token(db_token.token)
+            db.session.commit()
+
+        self.assertEqual(node.resolve_token(db_token.token).ip_address,
+                         'changed.ip')
+
+        with patch('downstream_node.node.get_ip_location') as p:
+            p.return_value = dict()
+            node.process_token_ip_address(db_token, 'other.ip', change=True)
+        db.session.rollback()
+        self.assertNotIn('invalidate_tokens', db.session().info)
+
     def test_add_file(self):
         db_file = node.add_file(self.test_seed, self.test_size)
 
@@ -1136,13 +1515,10 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
         self.assertEqual(db_contract.file, db_chunk.file)
 
         # check presence of tag
-        self.assertTrue(
-            os.path.isfile(
-                node.get_local_tag_path(
-                    db_contract.tag_path)))
+        self.assertIn(db_contract.tag_path, app.tag_store)
 
         # remove tag
-        os.remove(node.get_local_tag_path(db_contract.tag_path))
+        app.tag_store.delete([db_contract.tag_path])
 
     def test_get_chunk_contracts_limited_by_max_size(self):
         app.config['MAX_SIZE_PER_ADDRESS'] = self.test_size
@@ -1163,8 +1539,8 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
 
         self.assertEqual(db_contracts[0].file.size, self.test_size)
 
-        os.remove(node.get_local_tag_path(db_contracts[0].tag_path))
-        os.remove(node.get_local_tag_path(db_chunk2.tag_path))
+        app.tag_store.delete([db_contracts[0].tag_path])
+        app.tag_store.delete([db_chunk2.tag_path])
 
     def test_update_contract_expired(self):
         db_file = node.add_file(self.test_seed, self.test_size)
@@ -1249,12 +1625,240 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
         db_token = self.add_test_token()
         self.add_test_chunk()
 
-        with patch('downstream_node.node.contract_insert_next_challenge') as p:
-            p.return_value = False
+        with patch('downstream_node.node.app.heartbeat') as beat_patch:
+            beat_patch.gen_challenge.side_effect = heartbeat.HeartbeatError(
+                'test error')
+            contracts = list(
+                node.get_chunk_contracts(db_token, self.test_size))
+            self.assertEqual(len(contracts), 0)
+
+        # the chunk is removed from the pool, since it would fail again
+        self.assertEqual(node.get_chunk_inventory(), {})
+        self.assertEqual(models.Chunk.query.count(), 0)
+
+    def test_get_chunk_contracts_greedy(self):
+        db_token = self.add_test_token()
+        for size in [1, 2, 2, 4]:
+            node.generate_test_file(self.test_size * size)
+
+        db_contracts = node.get_chunk_contracts(db_token,
+                                                self.test_size * 7)
+
+        self.assertEqual([c.file.size for c in db_contracts],
+                         [self.test_size * s for s in [4, 2, 1]])
+        for db_contract in db_contracts:
+            self.assertEqual(db_contract.token_id, db_token.id)
+            self.assertFalse(db_contract.answered)
+            self.assertIsNotNone(db_contract.challenge)
+            self.assertAlmostEqual(
+                db_contract.due,
+                datetime.utcnow() +
+                timedelta(seconds=db_contract.file.interval),
+                delta=timedelta(seconds=5))
+            app.tag_store.delete([db_contract.tag_path])
+        self.assertEqual(node.get_chunk_inventory(),
+                         {self.test_size * 2: 1})
+
+    def test_get_chunk_contracts_max_chunk_count(self):
+        db_token = self.add_test_token()
+        for i in range(0, 3):
+            node.generate_test_file(self.test_size)
+
+        db_contracts = node.get_chunk_contracts(db_token,
+                                                self.test_size * 3, 2)
+
+        self.assertEqual(len(db_contracts), 2)
+        for db_contract in db_contracts:
+            app.tag_store.delete([db_contract.tag_path])
+        self.assertEqual(node.get_chunk_inventory(), {self.test_size: 1})
+
+    def get_chunk_contracts_concurrently(self, strategy):
+        with patch('downstream_node.node.get_ip_location') as p:
+            p.return_value = dict()
+            tokens = [node.resolve_token(
+                node.create_token(self.test_address,
+                                  'test.ip.{0}'.format(i)).token)
+                      for i in range(0, 10)]
+        for i in range(0, 20):
+            node.generate_test_file(self.test_size)
+        db.session.close()
+
+        file_ids = list()
+        errors = list()
+
+        def request(token_info):
+            with app.app_context():
+                try:
+                    db_contracts = node.get_chunk_contracts(
+                        token_info, self.test_size * 2, 2)
+                    file_ids.extend(c.file_id for c in db_contracts)
+                except Exception as ex:
+                    errors.append(ex)
+                finally:
+                    db.session.remove()
+
+        with patch.dict(app.config,
+                        CHUNK_CLAIM_STRATEGY=strategy,
+                        MAX_SIZE_PER_ADDRESS=self.test_size * 100):
+            threads = [threading.Thread(target=request, args=(t, ))
+                       for t in tokens]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(errors, [])
+        # no chunk was handed out twice, and none were lost
+        self.assertEqual(len(file_ids), len(set(file_ids)))
+        self.assertEqual(
+            len(file_ids) + node.get_chunk_inventory().get(self.test_size, 0),
+            20)
+        self.assertEqual(models.Chunk.query.filter(
+            models.Chunk.claim.isnot(None)).count(), 0)
+        for db_contract in models.Contract.query.all():
+            app.tag_store.delete([db_contract.tag_path])
+
+    def test_get_chunk_contracts_concurrent_update(self):
+        self.get_chunk_contracts_concurrently('update')
+
+    def test_get_chunk_contracts_concurrent_skip_locked(self):
+        if (not node.supports_skip_locked(db.engine)):
+            self.skipTest('SKIP LOCKED is not supported by the database')
+        self.get_chunk_contracts_concurrently('skip_locked')
+
+    def test_reserve_chunks_update_retry(self):
+        for i in range(0, 3):
+            self.add_test_chunk()
+        chunks = models.Chunk.__table__
+        claim_chunks = node.claim_chunks
+        calls = list()
+
+        def claim_racing(plan, held):
+            calls.append(dict(plan))
+            if (len(calls) == 1):
+                # another request claims two of the chunks first, and then
+                # returns them to the pool
+                db.engine.execute(chunks.update(mysql_limit=2).
+                                  values(claim='other claim',
+                                         claimed=datetime.utcnow()))
+                rows = claim_chunks(plan, held)
+                db.engine.execute(chunks.update().
+                                  where(chunks.c.claim == 'other claim').
+                                  values(claim=None, claimed=None))
+                return rows
+            return claim_chunks(plan, held)
+
+        with patch('downstream_node.node.claim_chunks', claim_racing):
+            rows = node.reserve_chunks(self.test_size * 3, 0,
+                                       strategy='update')
+
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(calls, [{self.test_size: 3}, {self.test_size: 2}])
+        for db_chunk in models.Chunk.query.all():
+            app.tag_store.delete([db_chunk.tag_path])
+
+    def test_get_chunk_contracts_init_failed_claimed(self):
+        db_token = self.add_test_token()
+        self.add_test_chunk()
+
+        with patch('downstream_node.node.app.heartbeat') as beat_patch,\
+                patch.dict(app.config, CHUNK_CLAIM_STRATEGY='update'):
+            beat_patch.gen_challenge.side_effect = heartbeat.HeartbeatError(
+                'test error')
             contracts = list(
                 node.get_chunk_contracts(db_token, self.test_size))
             self.assertEqual(len(contracts), 0)
 
+        # removed rather than left claimed
+        self.assertEqual(models.Chunk.query.count(), 0)
+
+    def test_release_stale_claims(self):
+        stale = self.add_test_chunk()
+        fresh = self.add_test_chunk()
+        stale_id = stale.id
+        chunks = models.Chunk.__table__
+        db.engine.execute(chunks.update().values(
+            claim='test claim',
+            claimed=datetime.utcnow() - timedelta(seconds=60)))
+        db.engine.execute(chunks.update().
+                          where(chunks.c.id == fresh.id).
+                          values(claimed=datetime.utcnow()))
+        self.assertEqual(node.get_chunk_inventory(), {})
+
+        self.assertEqual(node.release_stale_claims(30), 1)
+
+        self.assertEqual(node.get_chunk_inventory(), {self.test_size: 1})
+        db.session.expire_all()
+        self.assertIsNone(models.Chunk.query.get(stale_id).claim)
+        for db_chunk in models.Chunk.query.all():
+            app.tag_store.delete([db_chunk.tag_path])
+
+    def test_chunk_claim_strategy(self):
+        with patch.dict(app.config, CHUNK_CLAIM_STRATEGY='lock'):
+            self.assertEqual(node.chunk_claim_strategy(), 'lock')
+        with patch.dict(app.config, CHUNK_CLAIM_STRATEGY=None),\
+                patch('downstream_node.node.supports_skip_locked') as p:
+            p.return_value = True
+            self.assertEqual(node.chunk_claim_strategy(), 'skip_locked')
+            p.return_value = False
+            self.assertEqual(node.chunk_claim_strategy(), 'update')
+
+    def test_supports_skip_locked(self):
+        engine = mock.MagicMock()
+        engine.dialect._is_mariadb = False
+        engine.dialect.name = 'mysql'
+        engine.dialect.server_version_info = (5, 7, 30)
+        self.assertFalse(node.supports_skip_locked(engine))
+        engine.dialect.server_version_info = (8, 0, 21)
+        self.assertTrue(node.supports_skip_locked(engine))
+        engine.dialect.server_version_info = (10, 5, 4, 'MariaDB')
+        self.assertFalse(node.supports_skip_locked(engine))
+        engine.dialect.server_version_info = (10, 6, 4, 'MariaDB')
+        self.assertTrue(node.supports_skip_locked(engine))
+        engine.dialect.name = 'sqlite'
+        self.assertFalse(node.supports_skip_locked(engine))
+
+    def get_allocated_bytes(self):
+        db.session.expire_all()
+        return models.Address.query.filter(
+            models.Address.address == self.test_address).first().\
+            allocated_bytes
+
+    def test_allocated_bytes_delete_token(self):
+        db_token = self.add_test_token()
+        token = db_token.token
+        for size in [1, 2]:
+            node.generate_test_file(self.test_size * size)
+
+        db_contracts = node.get_chunk_contracts(db_token,
+                                                self.test_size * 3)
+        for db_contract in db_contracts:
+            app.tag_store.delete([db_contract.tag_path])
+        self.assertEqual(self.get_allocated_bytes(), self.test_size * 3)
+
+        node.delete_token(token)
+        self.assertEqual(self.get_allocated_bytes(), 0)
+
+    def test_allocated_bytes_remove_file(self):
+        db_token = self.add_test_token()
+        node.generate_test_file(self.test_size)
+
+        db_contracts = node.get_chunk_contracts(db_token, self.test_size)
+        app.tag_store.delete([db_contracts[0].tag_path])
+        self.assertEqual(self.get_allocated_bytes(), self.test_size)
+
+        node.remove_file(db_contracts[0].file.hash)
+        self.assertEqual(self.get_allocated_bytes(), 0)
+
+    def test_reconcile_allocated_bytes(self):
+        # created outside of the node functions
+        self.add_test_contract()
+        self.assertEqual(self.get_allocated_bytes(), 0)
+
+        self.assertEqual(node.reconcile_allocated_bytes(), 1)
+        self.assertEqual(self.get_allocated_bytes(), self.test_size)
+        self.assertEqual(node.reconcile_allocated_bytes(), 0)
+
     def test_update_contract_no_more_challenges(self):
         db_contract = self.add_test_contract()
 
@@ -1267,6 +1871,411 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
 
         self.assertIsNone(db_contract)
 
+    def add_due_contract(self):
+        db_token = self.add_test_token()
+        self.add_test_chunk()
+
+        db_contract = list(
+            node.get_chunk_contracts(db_token, self.test_size))[0]
+        db_contract.due = datetime.utcnow() - timedelta(seconds=1)
+        db_contract.answered = True
+        db.session.commit()
+
+        return db_contract
+
+    def test_precompute_challenges(self):
+        db_contract = self.add_due_contract()
+
+        self.assertEqual(node.precompute_challenges(0), 1)
+        db.session.expire_all()
+
+        self.assertIsNotNone(db_contract.next_challenge)
+        self.assertIsNotNone(db_contract.next_state)
+        self.assertEqual(db_contract.next_for, db_contract.due)
+
+        # nothing left to precompute
+        self.assertEqual(node.precompute_challenges(0), 0)
+
+        next_challenge = db_contract.next_challenge.todict()
+
+        with patch('downstream_node.node.contract_insert_next_challenge') as p:
+            db_contract = node.update_contract(db_contract)
+            self.assertFalse(p.called)
+
+        self.assertEqual(db_contract.challenge.todict(), next_challenge)
+        self.assertFalse(db_contract.answered)
+        self.assertGreater(db_contract.due, datetime.utcnow())
+        self.assertIsNone(db_contract.next_challenge)
+        self.assertIsNone(db_contract.next_for)
+
+        app.tag_store.delete([db_contract.tag_path])
+
+    def test_precompute_challenges_lookahead(self):
+        db_contract = self.add_due_contract()
+        db_contract.due = datetime.utcnow() + timedelta(seconds=60)
+        db.session.commit()
+
+        self.assertEqual(node.precompute_challenges(0), 0)
+        self.assertEqual(node.precompute_challenges(120), 1)
+
+        app.tag_store.delete([db_contract.tag_path])
+
+    def test_precompute_challenges_stale(self):
+        db_contract = self.add_due_contract()
+
+        node.precompute_challenges(0)
+        db.session.expire_all()
+
+        # the contract moves on before the precomputed challenge is used
+        db_contract.due = datetime.utcnow() - timedelta(seconds=2)
+        db.session.commit()
+
+        with patch('downstream_node.node.contract_insert_next_challenge') as p:
+            p.return_value = True
+            node.update_contract(db_contract)
+            p.assert_called_once_with(db_contract)
+
+        app.tag_store.delete([db_contract.tag_path])
+
+    def test_precompute_challenges_no_more_challenges(self):
+        db_contract = self.add_due_contract()
+
+        with patch('downstream_node.node.app.heartbeat') as beat_patch:
+            beat_patch.gen_challenge.side_effect = heartbeat.HeartbeatError(
+                'test error')
+            self.assertEqual(node.precompute_challenges(0), 1)
+        db.session.expire_all()
+
+        self.assertIsNone(db_contract.next_challenge)
+        self.assertEqual(db_contract.next_for, db_contract.due)
+        # not picked up again
+        self.assertEqual(node.precompute_challenges(0), 0)
+
+        app.tag_store.delete([db_contract.tag_path])
+
+    def test_generate_challenges(self):
+        due_contract = self.add_due_contract()
+        current_contract = self.add_due_contract()
+        current_contract.due = datetime.utcnow() + timedelta(seconds=60)
+        db.session.commit()
+        current_challenge = current_contract.challenge
+
+        old_challenge = due_contract.challenge
+        results = node.generate_challenges([due_contract, current_contract])
+        db.session.commit()
+
+        self.assertEqual(results, [True, True])
+        self.assertNotEqual(due_contract.challenge, old_challenge)
+        self.assertEqual(current_contract.challenge, current_challenge)
+
+        new_challenge = due_contract.challenge
+        new_due = due_contract.due
+
+        # the update was written to the database
+        db.session.expire_all()
+        self.assertEqual(due_contract.challenge, new_challenge)
+        self.assertAlmostEqual(due_contract.due, new_due,
+                               delta=timedelta(seconds=1))
+        self.assertFalse(due_contract.answered)
+
+        for c in [due_contract, current_contract]:
+            app.tag_store.delete([c.tag_path])
+
+    def test_generate_challenges_precomputed(self):
+        db_contract = self.add_due_contract()
+
+        node.precompute_challenges(0)
+        db.session.expire_all()
+        next_challenge = db_contract.next_challenge
+
+        with patch('downstream_node.node.app.heartbeat') as beat_patch:
+            results = node.generate_challenges([db_contract])
+            self.assertFalse(beat_patch.gen_challenge.called)
+        db.session.commit()
+
+        self.assertEqual(results, [True])
+        db.session.expire_all()
+        self.assertEqual(db_contract.challenge, next_challenge)
+        self.assertIsNone(db_contract.next_challenge)
+
+        app.tag_store.delete([db_contract.tag_path])
+
+    def test_generate_challenges_no_more_challenges(self):
+        db_contract = self.add_due_contract()
+        old_challenge = db_contract.challenge
+
+        with patch('downstream_node.node.app.heartbeat') as beat_patch:
+            beat_patch.gen_challenge.side_effect = heartbeat.HeartbeatError(
+                'test error')
+            results = node.generate_challenges([db_contract])
+
+        self.assertEqual(results, [False])
+        self.assertEqual(db_contract.challenge, old_challenge)
+
+        app.tag_store.delete([db_contract.tag_path])
+
+    def test_verify_proofs(self):
+        db_contract = self.add_due_contract()
+        answered_contract = self.add_due_contract()
+        expired_contract = self.add_due_contract()
+        for c in [db_contract, answered_contract, expired_contract]:
+            c.due = datetime.utcnow() + timedelta(seconds=60)
+            c.answered = False
+        answered_contract.answered = True
+        expired_contract.due = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+        hbcount = db_contract.token.hbcount
+        pairs = [(db_contract, 'proof'),
+                 (answered_contract, 'proof'),
+                 (expired_contract, 'proof')]
+
+        hbcounts = CounterBuffer(models.add_hbcounts)
+        with patch('downstream_node.node.app.heartbeat') as beat_patch,\
+                patch.object(app, 'hbcounts', hbcounts):
+            beat_patch.verify.return_value = True
+            results = node.verify_proofs(pairs, datetime.utcnow())
+            self.assertEqual(beat_patch.verify.call_count, 1)
+
+        self.assertIs(results[0], True)
+        self.assertEqual(str(results[1]), 'Challenge already answered.')
+        self.assertEqual(str(results[2]), 'Answer failed: contract expired.')
+        self.assertTrue(db_contract.answered)
+        # counted by the caller once the answers are committed
+        self.assertEqual(hbcounts.pending(), {})
+
+        db.session.commit()
+        self.assertEqual(db_contract.token.hbcount, hbcount)
+
+        for c in [db_contract, answered_contract, expired_contract]:
+            app.tag_store.delete([c.tag_path])
+
+    def test_get_verification_reports_counts_after_commit(self):
+        db_contract = self.add_due_contract()
+        token_id = db_contract.token_id
+        batch = [(db_contract, {'file_hash': db_contract.id, 'proof': {}})]
+
+        flushed = list()
+        hbcounts = CounterBuffer(flushed.append)
+        with patch('downstream_node.routes.verify_proofs') as verify,\
+                patch.object(app, 'hbcounts', hbcounts):
+            verify.return_value = [True]
+            with patch('downstream_node.routes.db.session.commit') as c:
+                c.side_effect = RuntimeError('test error')
+                with self.assertRaises(RuntimeError):
+                    list(routes.get_verification_reports(
+                        iter([batch]), mock.MagicMock(), token_id))
+            # the answers were not committed, so nothing is counted
+            self.assertEqual(hbcounts.pending(), {})
+            self.assertEqual(flushed, [])
+
+            db.session.rollback()
+            reports = list(routes.get_verification_reports(
+                iter([batch]), mock.MagicMock(), token_id))
+            self.assertEqual(reports[0]['status'], 'ok')
+            self.assertEqual(flushed, [{token_id: 1}])
+
+        app.tag_store.delete([db_contract.tag_path])
+
+    def test_get_chunk_inventory(self):
+        self.assertEqual(node.get_chunk_inventory(), dict())
+        node.generate_test_files([self.test_size, self.test_size,
+                                  self.test_size * 2], WorkerPool(0))
+        self.assertEqual(node.get_chunk_inventory(),
+                         {self.test_size: 2, self.test_size * 2: 1})
+        for c in models.Chunk.query.all():
+            app.tag_store.delete([c.tag_path])
+
+    def test_get_chunk_contracts_notifies(self):
+        db_token = self.add_test_token()
+        self.add_test_chunk()
+
+        with patch.object(app, 'chunk_notifier') as notifier:
+            db_contracts = list(
+                node.get_chunk_contracts(db_token, self.test_size))
+            notifier.notify.assert_called_once_with({self.test_size: 1})
+
+        app.tag_store.delete([db_contracts[0].tag_path])
+
+    def test_open_chunk_stream_bounded(self):
+        seed = b'encode seed'
+        size = 100000
+        beat = app.heartbeat
+
+        app.config['ENCODE_BUFFER_SIZE'] = None
+        stream = node.open_chunk_stream(self.test_seed, size)
+        self.assertEqual(len(stream.read(size)), size)
+        (tag, state) = beat.encode(node.open_chunk_stream(self.test_seed,
+                                                          size),
+                                   seed=seed, filesz=size)
+
+        app.config['ENCODE_BUFFER_SIZE'] = 1000
+        stream = node.open_chunk_stream(self.test_seed, size)
+        self.assertEqual(len(stream.read(size)), 1000)
+        (bounded_tag, bounded_state) = beat.encode(
+            node.open_chunk_stream(self.test_seed, size),
+            seed=seed, filesz=size)
+
+        app.config['ENCODE_BUFFER_SIZE'] = config.ENCODE_BUFFER_SIZE
+
+        self.assertEqual(bounded_state.root, state.root)
+
+    def put_pickled_tag(self, tag):
+        return app.tag_store.put(dump_tag(tag))
+
+    def test_put_get_tag(self):
+        with patch.dict(app.config, TAG_JSON=False):
+            tag_hash = node.put_tag(dict(tag='test'))
+        self.assertIn(tag_hash, app.tag_store)
+        self.assertEqual(node.get_tag(tag_hash), dict(tag='test'))
+        self.assertNotIn(tag_hash, app.tag_store)
+
+    def test_put_get_tag_json(self):
+        tag = mock.MagicMock()
+        tag.todict.return_value = dict(tag='test')
+        tag_hash = node.put_tag(tag)
+        loaded = node.get_tag(tag_hash)
+        self.assertIsInstance(loaded, RawJSON)
+        self.assertEqual(json.loads(loaded.encoded), dict(tag='test'))
+
+    def test_put_get_tag_compressed(self):
+        with patch.dict(app.config, TAG_COMPRESSION='zlib',
+                        TAG_COMPRESSION_LEVEL=9, TAG_JSON=False):
+            tag_hash = node.put_tag(dict(tag='test'))
+        self.assertTrue(app.tag_store.get(tag_hash).startswith(b'\x00TAG'))
+        # read back whatever the current setting
+        self.assertEqual(node.get_tag(tag_hash), dict(tag='test'))
+
+    def test_get_tags(self):
+        hashes = [self.put_pickled_tag(dict(tag='first')),
+                  self.put_pickled_tag(dict(tag='second'))]
+        self.assertEqual(node.get_tags(hashes + ['missing']),
+                         {hashes[0]: dict(tag='first'),
+                          hashes[1]: dict(tag='second')})
+        self.assertEqual(node.get_tags(hashes), dict())
+        self.assertEqual(node.get_tags([]), dict())
+
+    def test_get_tags_remote(self):
+        binary_tags = [('a' * 64, dump_tag(dict(tag='first'))),
+                       ('b' * 64, dump_tag(dict(tag='second')))]
+        with patch.dict(app.config, REMOTE_TAGS_PATH='http://tags/tag/key'),\
+                patch.object(node.tag_session, 'post') as p:
+            p.return_value.content = pack_tags(binary_tags)
+            tags = node.get_tags(['a' * 64, 'b' * 64])
+        self.assertEqual(tags, {'a' * 64: dict(tag='first'),
+                                'b' * 64: dict(tag='second')})
+        # one request for all the tags
+        self.assertEqual(p.call_count, 1)
+        self.assertEqual(p.call_args[0][0], 'http://tags/tag/key')
+        self.assertEqual(json.loads(p.call_args[1]['data']),
+                         dict(hashes=['a' * 64, 'b' * 64]))
+
+    def test_prefetch_tags(self):
+        hashes = [self.put_pickled_tag(dict(tag=i)) for i in range(0, 5)]
+        groups = list()
+        get_tags = node.get_tags
+
+        def record_get_tags(group):
+            groups.append(group)
+            return get_tags(group)
+
+        # an inline pool fetches each group as soon as it is submitted
+        with patch('downstream_node.node.get_tags',
+                   side_effect=record_get_tags),\
+                patch.object(app, 'tag_pool', WorkerPool(0)):
+            tags = node.prefetch_tags(hashes + ['missing'], 2)
+            self.assertEqual(next(tags), dict(tag=0))
+            # the second group is fetched ahead
+            self.assertEqual(groups, [hashes[0:2], hashes[2:4]])
+            self.assertEqual(list(tags), [dict(tag=i) for i in range(1, 5)] +
+                             [None])
+        self.assertEqual(groups, [hashes[0:2], hashes[2:4],
+                                  [hashes[4], 'missing']])
+
+    def test_prefetch_tags_at_once(self):
+        hashes = [self.put_pickled_tag(dict(tag=i)) for i in range(0, 3)]
+        with patch('downstream_node.node.get_tags',
+                   side_effect=node.get_tags) as p:
+            self.assertEqual(list(node.prefetch_tags(hashes, 0)),
+                             [dict(tag=i) for i in range(0, 3)])
+        p.assert_called_once_with(hashes)
+        self.assertEqual(list(node.prefetch_tags([], 0)), [])
+
+    def test_encode_chunk(self):
+        (seed, size, state, tag_hash) = node.encode_chunk(
+            (self.test_seed, self.test_size))
+        self.assertEqual(seed, self.test_seed)
+        self.assertEqual(size, self.test_size)
+        self.assertIn(tag_hash, app.tag_store)
+        self.assertIsNotNone(state)
+        app.tag_store.delete([tag_hash])
+
+    def generate_test_files(self, pool):
+        sizes = [self.test_size, self.test_size * 2, self.test_size]
+        self.assertEqual(node.generate_test_files(sizes, pool, 2), 3)
+
+        chunks = models.Chunk.query.all()
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(sorted([c.file.size for c in chunks]),
+                         sorted(sizes))
+        for c in chunks:
+            self.assertEqual(c.file.redundancy, 1)
+            self.assertEqual(c.file.interval, app.config['DEFAULT_INTERVAL'])
+            self.assertIn(c.tag_path, app.tag_store)
+            app.tag_store.delete([c.tag_path])
+
+    def test_generate_test_files(self):
+        self.generate_test_files(WorkerPool(0))
+
+    def test_generate_test_files_workers(self):
+        pool = WorkerPool(2)
+        try:
+            self.generate_test_files(pool)
+        finally:
+            pool.close()
+
+    def test_add_hbcounts(self):
+        first = self.add_test_token()
+        second = self.add_test_token()
+        models.add_hbcounts({first.id: 3, second.id: 1})
+        models.add_hbcounts({first.id: 2})
+        db.session.expire_all()
+        self.assertEqual(first.hbcount, 5)
+        self.assertEqual(second.hbcount, 1)
+
+    def test_verify_proofs_invalid(self):
+        db_contract = self.add_due_contract()
+        db_contract.due = datetime.utcnow() + timedelta(seconds=60)
+        db_contract.answered = False
+        db.session.commit()
+
+        with patch('downstream_node.node.app.heartbeat') as beat_patch:
+            beat_patch.verify.return_value = False
+            results = node.verify_proofs([(db_contract, 'proof')],
+                                         datetime.utcnow())
+
+        self.assertEqual(results, [False])
+        self.assertFalse(db_contract.answered)
+
+        app.tag_store.delete([db_contract.tag_path])
+
+    def test_verify_proofs_timeout(self):
+        db_contract = self.add_due_contract()
+        db_contract.due = datetime.utcnow() + timedelta(seconds=60)
+        db_contract.answered = False
+        db.session.commit()
+
+        with patch.object(app, 'proof_pool') as pool:
+            pool.processes = 2
+            pool.map.side_effect = multiprocessing.TimeoutError()
+            results = node.verify_proofs([(db_contract, 'proof')],
+                                         datetime.utcnow())
+
+        self.assertIsInstance(results[0], InvalidParameterError)
+        self.assertFalse(db_contract.answered)
+
+        app.tag_store.delete([db_contract.tag_path])
+
 
 class TestDownstreamUtils(unittest.TestCase):
 
@@ -1278,8 +2287,7 @@ class TestDownstreamUtils(unittest.TestCase):
             os.path.join(config.FILES_PATH, 'test.file'))
         with open(self.testfile, 'wb+') as f:
             f.write(os.urandom(1000))
-        db.engine.execute(
-            'DROP TABLE IF EXISTS contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE IF EXISTS ' + TABLES)
         db.create_all()
 
     def tearDown(self):
@@ -1302,6 +2310,22 @@ class TestDownstreamException(unittest.TestCase):
 
 class TestDownstreamHttpHandler(unittest.TestCase):
 
+    def test_service_unavailable(self):
+        with patch('downstream_node.exc.jsonify') as mock:
+            with HttpHandler() as handler:
+                raise ServiceUnavailableError('test exception')
+        mock.assert_called_with(status='error',
+                                message='test exception')
+        self.assertEqual(handler.response.status_code, 503)
+
+    def test_rate_limit(self):
+        with patch('downstream_node.exc.jsonify') as mock:
+            with HttpHandler() as handler:
+                raise RateLimitError('test exception')
+        mock.assert_called_with(status='error',
+                                message='test exception')
+        self.assertEqual(handler.response.status_code, 429)
+
     def test_logging(self):
         logger = mock.MagicMock()
         test_exception = Exception('test exception')
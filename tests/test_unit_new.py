@@ -4,6 +4,10 @@ import json
 
 from downstream_node.startup import app, db
 
+# tables dropped and recreated around each test
+TABLES = ('contracts,chunks,tokens,addresses,files,ip_token_counts,'
+          'whitelist_version')
+
 
 # new testing methodology.
 # we'll test each route.  we'll set up the database for the preconditions
@@ -18,14 +22,12 @@ class TestDownstreamNodeRoutes(unittest.TestCase):
         app.config['REQUIRE_SIGNATURE'] = False
         app.config['SQLALCHEMY_DATABASE_URI'] \
             = 'mysql+pymysql://localhost/test_downstream'
-        db.engine.execute(
-            'DROP TABLE IF EXISTS contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE IF EXISTS ' + TABLES)
         db.create_all()
 
     def tearDown(self):
         db.session.close()
-        db.engine.execute(
-            'DROP TABLE IF EXISTS contracts,chunks,tokens,addresses,files')
+        db.engine.execute('DROP TABLE IF EXISTS ' + TABLES)
 
 
 class TestApiIndex(TestDownstreamNodeRoutes):
@@ -1,3 +1,4 @@
+import io
 import unittest
 from downstream_node import utils
 
@@ -130,3 +131,56 @@ class TestMonopolyDistribution(unittest.TestCase):
         self.assertIn(left, missing)
         self.assertIn(right, missing)
         self.assertEqual(len(missing), 2)
+
+
+class TestPlanChunkReservation(unittest.TestCase):
+
+    def test_largest_first(self):
+        inventory = {100: 5, 30: 5, 10: 5}
+        self.assertEqual(utils.plan_chunk_reservation(inventory, 250),
+                         {100: 2, 30: 1, 10: 2})
+
+    def test_limited_by_inventory(self):
+        self.assertEqual(utils.plan_chunk_reservation({100: 1, 10: 3}, 250),
+                         {100: 1, 10: 3})
+
+    def test_max_count(self):
+        self.assertEqual(utils.plan_chunk_reservation({100: 5, 10: 5}, 250, 3),
+                         {100: 2, 10: 1})
+
+    def test_nothing_fits(self):
+        self.assertEqual(utils.plan_chunk_reservation({100: 5}, 99), dict())
+        self.assertEqual(utils.plan_chunk_reservation(dict(), 100), dict())
+        self.assertEqual(utils.plan_chunk_reservation({0: 5}, 100), dict())
+
+
+class TestBoundedReadStream(unittest.TestCase):
+
+    def setUp(self):
+        self.data = bytes(bytearray(range(0, 256))) * 10
+        self.stream = utils.BoundedReadStream(io.BytesIO(self.data), 100)
+
+    def test_read_bounded(self):
+        self.assertEqual(self.stream.read(1000), self.data[0:100])
+        self.assertEqual(self.stream.read(50), self.data[100:150])
+
+    def test_read_unsized(self):
+        self.stream.read(100)
+        # not bounded, since the caller asked for the rest of the stream
+        self.assertEqual(self.stream.read(), self.data[100:])
+        self.stream.seek(100)
+        self.assertEqual(self.stream.read(-1), self.data[100:])
+
+    def test_read_all(self):
+        pieces = list()
+        for piece in iter(lambda: self.stream.read(1000), b''):
+            self.assertLessEqual(len(piece), 100)
+            pieces.append(piece)
+        self.assertEqual(b''.join(pieces), self.data)
+
+    def test_seek_tell(self):
+        self.stream.seek(0, 2)
+        self.assertEqual(self.stream.tell(), len(self.data))
+        self.stream.seek(1000)
+        self.assertEqual(self.stream.tell(), 1000)
+        self.assertEqual(self.stream.read(10), self.data[1000:1010])
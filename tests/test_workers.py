@@ -0,0 +1,96 @@
+import os
+import time
+import unittest
+import multiprocessing
+
+from downstream_node.workers import (WorkerPool, init_proof_worker,
+                                     verify_proof_task)
+
+
+def get_pid(x=None):
+    return os.getpid()
+
+
+def square(x):
+    return x * x
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+class FakeHeartbeat(object):
+
+    def verify(self, proof, challenge, state):
+        if (proof is None):
+            raise ValueError('no proof')
+        return proof == challenge + state
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_inline(self):
+        pool = WorkerPool(0)
+        self.assertEqual(pool.apply(get_pid), os.getpid())
+        self.assertEqual(pool.map(square, [1, 2, 3]), [1, 4, 9])
+        self.assertIsNone(pool._pool)
+
+    def test_processes(self):
+        pool = WorkerPool(2)
+        try:
+            self.assertNotEqual(pool.apply(get_pid), os.getpid())
+            self.assertEqual(pool.apply(square, (3,)), 9)
+            self.assertEqual(pool.map(square, range(0, 100)),
+                             [x * x for x in range(0, 100)])
+        finally:
+            pool.close()
+        self.assertIsNone(pool._pool)
+
+    def test_timeout(self):
+        pool = WorkerPool(1)
+        try:
+            with self.assertRaises(multiprocessing.TimeoutError):
+                pool.apply(sleep, (1,), timeout=0.01)
+        finally:
+            pool.close()
+
+    def test_threads(self):
+        pool = WorkerPool(2, threads=True)
+        try:
+            self.assertEqual(pool.apply(get_pid), os.getpid())
+            self.assertEqual(pool.map(square, [1, 2, 3]), [1, 4, 9])
+        finally:
+            pool.close()
+
+    def test_apply_async(self):
+        for pool in [WorkerPool(0), WorkerPool(2, threads=True)]:
+            try:
+                results = [pool.apply_async(square, (x,))
+                           for x in range(0, 10)]
+                self.assertEqual([r.get(10) for r in results],
+                                 [x * x for x in range(0, 10)])
+                with self.assertRaises(TypeError):
+                    pool.apply_async(square, (None,)).get(10)
+            finally:
+                pool.close()
+
+
+class TestVerifyProofTask(unittest.TestCase):
+
+    def test_inline(self):
+        beat = FakeHeartbeat()
+        self.assertTrue(verify_proof_task((3, 1, 2), beat))
+        self.assertFalse(verify_proof_task((4, 1, 2), beat))
+
+    def test_error_is_invalid(self):
+        self.assertFalse(verify_proof_task((None, 1, 2), FakeHeartbeat()))
+
+    def test_pool(self):
+        pool = WorkerPool(2, init_proof_worker, (FakeHeartbeat(),))
+        try:
+            self.assertEqual(pool.map(verify_proof_task,
+                                      [(3, 1, 2), (4, 1, 2), (None, 1, 2),
+                                       (5, 2, 3)]),
+                             [True, False, False, True])
+        finally:
+            pool.close()